@@ -59,7 +59,11 @@ CSRCS = \
        src/pio.c                  \
        src/stdio.c                  \
        src/cmd.c                  \
+       src/memtest.c              \
 #       src/spiflash/at25d.c                  \
+#       src/spiflash/at25_spi.c               \
+#       src/spiflash/spid_dma.c               \
+#       src/spiflash/spiflash.c               \
 
 
 
@@ -8,6 +8,10 @@
 #include "stdio.h"
 #include "cmd.h"
 #include "dbgu_console.h"
+#include "board_sama5d3x.h"
+#if (CONFIGURE_CMD_MEMTEST != 0)
+#include "memtest.h"
+#endif
 
 
 #define PRINT_TRACE 0
@@ -20,6 +24,28 @@ unsigned char uart_rx_buffer_size;
 const cmd_t gen_commands[] = {
 	ADD_COMMAND(cmd_ping, CMD_PING),
 	ADD_COMMAND(cmd_exit, CMD_EXIT),
+#if (CONFIGURE_CMD_CHECKSUM != 0)
+	ADD_COMMAND(cmd_checksum, CMD_CHECKSUM),
+#endif
+#if (CONFIGURE_CMD_BLOCK != 0)
+	ADD_COMMAND(cmd_read_block, CMD_READ_BLOCK),
+	ADD_COMMAND(cmd_write_block, CMD_WRITE_BLOCK),
+#endif
+#if (CONFIGURE_CMD_DECOMPRESS != 0)
+	ADD_COMMAND(cmd_decompress, CMD_DECOMPRESS),
+#endif
+#if (CONFIGURE_CMD_BAUDRATE != 0)
+	ADD_COMMAND(cmd_set_baudrate, CMD_SET_BAUDRATE),
+#endif
+#if (CONFIGURE_CMD_MEMTEST != 0)
+	ADD_COMMAND(cmd_memtest, CMD_MEMTEST),
+#endif
+#if (CONFIGURE_SPI_FLASH != 0)
+	ADD_COMMAND(cmd_flash_init, CMD_FLASH_INIT),
+	ADD_COMMAND(cmd_flash_write, CMD_FLASH_WRITE),
+	ADD_COMMAND(cmd_flash_status, CMD_FLASH_STATUS),
+	ADD_COMMAND(cmd_flash_checksum, CMD_FLASH_CHECKSUM),
+#endif
 };
 
 int gen_commands_total = sizeof(gen_commands)/sizeof(gen_commands[0]);
@@ -75,9 +101,87 @@ static unsigned char checksum(unsigned char size)
  */
 char cmd_first_command = 1;
 
+int cmd_sequence = -1;
+
+/**
+ * Commands which arrive while the current command is handled. The response
+ * is built in the uart_rx_buffer and would overwrite them
+ */
+static unsigned char cmd_rx_pending[sizeof(uart_rx_buffer)];
+static unsigned char cmd_rx_pending_size;
+
+static void cmd_rx_pending_add(unsigned char c)
+{
+	if (cmd_block_rx.remaining != 0)
+	{
+		*cmd_block_rx.address = c;
+		cmd_block_rx.address++;
+		cmd_block_rx.remaining--;
+		return;
+	}
+
+	if (cmd_rx_pending_size < sizeof(cmd_rx_pending))
+	{
+		cmd_rx_pending[cmd_rx_pending_size] = c;
+		cmd_rx_pending_size++;
+	}
+}
+
+void cmd_rx_poll(void)
+{
+	unsigned char c;
+
+	while (DBGU_GetChar(&c))
+	{
+		cmd_rx_pending_add(c);
+	}
+}
+
+/**
+ * Move the data after the command to the pending buffer
+ */
+static void cmd_rx_pending_save(unsigned char offset)
+{
+	cmd_rx_pending_size = uart_rx_buffer_size - offset;
+	memcpy(cmd_rx_pending, &uart_rx_buffer[offset], cmd_rx_pending_size);
+	uart_rx_buffer_size = offset;
+}
+
+/**
+ * Move the pending data back to the uart_rx_buffer after the response is sent
+ */
+static void cmd_rx_pending_restore(void)
+{
+	memcpy(uart_rx_buffer, cmd_rx_pending, cmd_rx_pending_size);
+	uart_rx_buffer_size = cmd_rx_pending_size;
+	cmd_rx_pending_size = 0;
+}
+
+/**
+ * Same as DBGU_PutBuffer(), but the receiver is served while the transmitter is busy
+ */
+static void cmd_put_buffer(const uint8_t *s, uint32_t len)
+{
+	while (len-- > 0)
+	{
+		while (!DBGU_IsTxReady())
+			cmd_rx_poll();
+		DBGU_PutChar(*s);
+		s++;
+	}
+}
+
 unsigned char cmd_send_slave(unsigned char size)
 {
 	unsigned char cs;
+
+	if (cmd_sequence >= 0)
+	{
+		memmove(&uart_rx_buffer[PAYLOAD_OFFSET + SEQUENCE_SIZE], &uart_rx_buffer[PAYLOAD_OFFSET], size);
+		uart_rx_buffer[PAYLOAD_OFFSET] = cmd_sequence;
+		uart_rx_buffer[COMMAND_ID_OFFSET] |= CMD_SEQUENCE_FLAG;
+		size += SEQUENCE_SIZE;
+	}
 	
 	size += RAW_CMD_SIZE;
 
@@ -101,7 +205,7 @@ unsigned char cmd_send_slave(unsigned char size)
 		while (tc_sys_tick != tick) ;
 	}
 #endif
-	DBGU_PutBuffer(uart_rx_buffer, size);
+	cmd_put_buffer(uart_rx_buffer, size);
 
 	return 0;
 }
@@ -127,6 +231,71 @@ const cmd_t *cmd_find_command(unsigned char command_id)
 	return 0;
 }
 
+cmd_block_rx_t cmd_block_rx;
+
+#if (CONFIGURE_CMD_BAUDRATE != 0)
+/**
+ * Divisor of the rate the applet started with, zero if the rate was not changed
+ */
+static uint32_t cmd_baudrate_initial_divisor;
+static uint32_t cmd_baudrate_previous_divisor;
+static char cmd_baudrate_pending;
+static uint32_t cmd_baudrate_start;
+
+/**
+ * PIT counts master clock/16, one period is 2^20 ticks
+ */
+#define CMD_PIT_TICKS_MS   (CONFIGURE_MASTER_CLOCK/16/1000)
+
+static void cmd_timer_start(void)
+{
+	PIT->PIT_MR = PIT_MR_PIV(PIT_MR_PIV_Msk) | PIT_MR_PITEN;
+	// Reading of PIVR clears the counter of periods
+	(void)PIT->PIT_PIVR;
+	cmd_baudrate_start = PIT->PIT_PIIR & PIT_PIIR_CPIV_Msk;
+}
+
+static uint32_t cmd_timer_elapsed_ms(void)
+{
+	uint32_t piir = PIT->PIT_PIIR;
+	uint32_t periods = (piir & PIT_PIIR_PICNT_Msk) >> PIT_PIIR_PICNT_Pos;
+	uint32_t ticks = periods*(PIT_MR_PIV_Msk + 1) + (piir & PIT_PIIR_CPIV_Msk) - cmd_baudrate_start;
+
+	return ticks/CMD_PIT_TICKS_MS;
+}
+
+static void cmd_baudrate_confirm(void)
+{
+	cmd_baudrate_pending = 0;
+}
+
+static void cmd_baudrate_wait_tx(void)
+{
+	while (!DBGU_IsTxReady())
+		cmd_rx_poll();
+}
+
+void cmd_baudrate_poll(void)
+{
+	if (!cmd_baudrate_pending)
+		return;
+	if (cmd_timer_elapsed_ms() < CMD_BAUDRATE_CONFIRM_TIMEOUT)
+		return;
+
+	// The data received at the wrong rate is garbage
+	cmd_baudrate_pending = 0;
+	DBGU_SetDivisor(cmd_baudrate_previous_divisor);
+	uart_rx_buffer_size = 0;
+}
+
+void cmd_baudrate_restore(void)
+{
+	cmd_baudrate_wait_tx();
+	if (cmd_baudrate_initial_divisor != 0)
+		DBGU_SetDivisor(cmd_baudrate_initial_divisor);
+}
+#endif
+
 unsigned char process_command()
 {
 	unsigned char ret = 0;
@@ -134,9 +303,18 @@ unsigned char process_command()
 	const cmd_t *cmd;
 	unsigned char expected_size, command_size;
 	unsigned char command_id;
+	unsigned char sequence_size;
 
 	cmd_stat.process_command++;
 
+	if (cmd_block_rx_complete())
+	{
+		cmd_rx_pending_save(0);
+		cmd_write_block_done();
+		cmd_rx_pending_restore();
+		return 1;
+	}
+
 	while (1)
 	{
 
@@ -155,7 +333,8 @@ unsigned char process_command()
 		}
 
 		command_id = cmd_get_id(uart_rx_buffer);
-		cmd = cmd_find_command(command_id);
+		sequence_size = (command_id & CMD_SEQUENCE_FLAG) ? SEQUENCE_SIZE : 0;
+		cmd = cmd_find_command(command_id & ~CMD_SEQUENCE_FLAG);
 		if (cmd == 0)
 		{
 			cmd_stat.process_command_bad_id++;
@@ -166,7 +345,7 @@ unsigned char process_command()
 			continue;
 		}
 
-		expected_size = cmd->size;
+		expected_size = cmd->size + sequence_size;
 		command_size = uart_rx_buffer[PAYLOAD_SIZE_OFFSET] + PAYLOAD_OFFSET; // payload size + 4 bytes of header
 #if (PRINT_TRACE > 1)
 		cmd_printf("Cmd found: %x, cmd size = %d, exp. size = %d\r\n", command_id, command_size, expected_size);
@@ -199,11 +378,6 @@ unsigned char process_command()
 			continue;
 		}
 
-		cmd_stat.process_command_handler++;
-		// This is a legal command
-		cmd->handler(expected_size - RAW_CMD_SIZE );
-		cmd_stat.process_command_handler_done++;
-
 		if (expected_size < uart_rx_buffer_size)
 		{
 #if (PRINT_TRACE > 0)
@@ -211,7 +385,30 @@ unsigned char process_command()
 #endif
 			cmd_stat.process_command_buffer_ne++;
 		}
-		uart_rx_buffer_size = 0;
+		// Pipelined commands wait in the pending buffer
+		cmd_rx_pending_save(expected_size);
+
+		// Remove the sequence number, the handlers see the regular command
+		cmd_sequence = -1;
+		if (sequence_size)
+		{
+			cmd_sequence = uart_rx_buffer[PAYLOAD_OFFSET];
+			expected_size -= SEQUENCE_SIZE;
+			memmove(&uart_rx_buffer[PAYLOAD_OFFSET], &uart_rx_buffer[PAYLOAD_OFFSET + SEQUENCE_SIZE], expected_size - PAYLOAD_OFFSET);
+			uart_rx_buffer[COMMAND_ID_OFFSET] = command_id & ~CMD_SEQUENCE_FLAG;
+			uart_rx_buffer[PAYLOAD_SIZE_OFFSET] -= SEQUENCE_SIZE;
+		}
+
+#if (CONFIGURE_CMD_BAUDRATE != 0)
+		// A valid command arrived at the new rate
+		cmd_baudrate_confirm();
+#endif
+		cmd_stat.process_command_handler++;
+		// This is a legal command
+		cmd->handler(expected_size - RAW_CMD_SIZE );
+		cmd_stat.process_command_handler_done++;
+
+		cmd_rx_pending_restore();
 		cmd_first_command = 0;
 		ret = 1;
 
@@ -239,6 +436,248 @@ CMD_DECLARE_FUNCTION(cmd_exit)
 	return 0;
 }
 
+uint32_t cmd_crc32(uint32_t crc, const uint8_t *data, uint32_t size)
+{
+	int bit;
+
+	crc = ~crc;
+	while (size--)
+	{
+		// Calculation of a large block takes longer than a character on the line
+		if ((size & 0xFF) == 0)
+			cmd_rx_poll();
+		crc ^= *data++;
+		for (bit = 0;bit < 8;bit++)
+			crc = (crc >> 1) ^ (0xEDB88320 & (-(crc & 1)));
+	}
+
+	return ~crc;
+}
+
+#if (CONFIGURE_CMD_CHECKSUM != 0)
+/**
+ * Calculate CRC32 of every block in the range. The host compares
+ * the checksums with the image and uploads only blocks which differ
+ */
+CMD_DECLARE_FUNCTION(cmd_checksum)
+{
+	cmd_checksum_rq_t *rq = (cmd_checksum_rq_t*)uart_rx_buffer;
+	cmd_checksum_rs_t *rs = (cmd_checksum_rs_t*)uart_rx_buffer;
+	const uint8_t *address = (const uint8_t*)rq->address;
+	uint32_t block_size = rq->block_size;
+	uint8_t blocks = rq->blocks;
+	uint8_t i;
+
+	if (blocks > CMD_CHECKSUM_BLOCKS_MAX)
+		blocks = CMD_CHECKSUM_BLOCKS_MAX;
+
+	// The response overwrites the request
+	for (i = 0;i < blocks;i++,address += block_size)
+	{
+		rs->crc[i] = cmd_crc32(0, address, block_size);
+	}
+	cmd_send_slave(blocks*sizeof(rs->crc[0]));
+
+	return 0;
+}
+#endif
+
+#if (CONFIGURE_CMD_BLOCK != 0)
+CMD_DECLARE_FUNCTION(cmd_read_block)
+{
+	cmd_read_block_rq_t *rq = (cmd_read_block_rq_t*)uart_rx_buffer;
+	cmd_read_block_rs_t *rs = (cmd_read_block_rs_t*)uart_rx_buffer;
+	const uint8_t *address = (const uint8_t*)rq->address;
+	uint32_t block_size = rq->size;
+
+	rs->size = block_size;
+	rs->crc = cmd_crc32(0, address, block_size);
+	cmd_send_slave(sizeof(*rs) - sizeof(rs->hdr));
+	cmd_put_buffer(address, block_size);
+
+	return 0;
+}
+
+CMD_DECLARE_FUNCTION(cmd_write_block)
+{
+	cmd_write_block_rq_t *rq = (cmd_write_block_rq_t*)uart_rx_buffer;
+	uint32_t extra;
+
+	cmd_block_rx.start = (uint8_t*)rq->address;
+	cmd_block_rx.address = cmd_block_rx.start;
+	cmd_block_rx.size = rq->size;
+	cmd_block_rx.crc = rq->crc;
+	cmd_block_rx.sequence = cmd_sequence;
+
+	// Data which arrived together with the request
+	extra = cmd_rx_pending_size;
+	if (extra > cmd_block_rx.size)
+		extra = cmd_block_rx.size;
+	memcpy(cmd_block_rx.address, cmd_rx_pending, extra);
+	cmd_block_rx.address += extra;
+	cmd_rx_pending_size -= extra;
+	memmove(cmd_rx_pending, &cmd_rx_pending[extra], cmd_rx_pending_size);
+
+	cmd_block_rx.remaining = cmd_block_rx.size - extra;
+	cmd_block_rx.pending = 1;
+
+	return 0;
+}
+
+void cmd_write_block_done(void)
+{
+	cmd_write_block_rs_t *rs = (cmd_write_block_rs_t*)uart_rx_buffer;
+	uint32_t crc;
+
+	cmd_block_rx.pending = 0;
+	cmd_sequence = cmd_block_rx.sequence;
+	crc = cmd_crc32(0, cmd_block_rx.start, cmd_block_rx.size);
+
+	rs->hdr.cmd = CMD_WRITE_BLOCK;
+	rs->status = (crc == cmd_block_rx.crc) ? CMD_BLOCK_STATUS_OK : CMD_BLOCK_STATUS_BAD_CRC;
+	rs->crc = crc;
+	cmd_send_slave(sizeof(*rs) - sizeof(rs->hdr));
+}
+#endif
+
+#if (CONFIGURE_CMD_DECOMPRESS != 0)
+/**
+ * Length of a literal run or of a match, 15 in the token means that more bytes follow
+ */
+static uint32_t lz4_length(const uint8_t **src, const uint8_t *src_end, uint32_t length)
+{
+	uint8_t c;
+
+	if (length != 15)
+		return length;
+
+	do
+	{
+		if (*src >= src_end)
+			break;
+		c = **src;
+		(*src)++;
+		length += c;
+	}
+	while (c == 255);
+
+	return length;
+}
+
+/**
+ * Decode LZ4 block, bytes are copied one by one from the start, so the source can
+ * overlap the end of the destination. Returns number of bytes written or -1
+ */
+static int32_t lz4_decompress(const uint8_t *src, uint32_t src_size, uint8_t *dst, uint32_t dst_size)
+{
+	const uint8_t *src_end = src + src_size;
+	uint8_t *dst_start = dst;
+	uint8_t *dst_end = dst + dst_size;
+	const uint8_t *match;
+	uint32_t length;
+	uint32_t offset;
+	uint8_t token;
+
+	while (src < src_end)
+	{
+		// A long block takes longer than a character on the line
+		cmd_rx_poll();
+
+		token = *src++;
+		length = lz4_length(&src, src_end, token >> 4);
+		if ((length > (uint32_t)(src_end - src)) || (length > (uint32_t)(dst_end - dst)))
+			return -1;
+		while (length--)
+			*dst++ = *src++;
+
+		// The last sequence contains only literals
+		if (src == src_end)
+			break;
+
+		if ((src_end - src) < 2)
+			return -1;
+		offset = src[0] | (src[1] << 8);
+		src += 2;
+		length = lz4_length(&src, src_end, token & 0x0F) + 4;
+		if ((offset == 0) || (offset > (uint32_t)(dst - dst_start)) || (length > (uint32_t)(dst_end - dst)))
+			return -1;
+		match = dst - offset;
+		while (length--)
+			*dst++ = *match++;
+	}
+
+	return dst - dst_start;
+}
+
+/**
+ * The host loads the compressed image and the applet expands it in the memory
+ * The response contains CRC32 of the decompressed data
+ */
+CMD_DECLARE_FUNCTION(cmd_decompress)
+{
+	cmd_decompress_rq_t *rq = (cmd_decompress_rq_t*)uart_rx_buffer;
+	cmd_decompress_rs_t *rs = (cmd_decompress_rs_t*)uart_rx_buffer;
+	uint8_t *dst = (uint8_t*)rq->dst;
+	int32_t decompressed;
+
+	decompressed = lz4_decompress((const uint8_t*)rq->src, rq->src_size, dst, rq->dst_size);
+
+	rs->status = CMD_DECOMPRESS_STATUS_FORMAT;
+	rs->size = 0;
+	rs->crc = 0;
+	if (decompressed >= 0)
+	{
+		rs->status = CMD_DECOMPRESS_STATUS_OK;
+		rs->size = decompressed;
+		rs->crc = cmd_crc32(0, dst, decompressed);
+	}
+	cmd_send_slave(sizeof(*rs) - sizeof(rs->hdr));
+
+	return 0;
+}
+#endif
+
+#if (CONFIGURE_CMD_BAUDRATE != 0)
+CMD_DECLARE_FUNCTION(cmd_set_baudrate)
+{
+	cmd_set_baudrate_rq_t *rq = (cmd_set_baudrate_rq_t*)uart_rx_buffer;
+	cmd_set_baudrate_rs_t *rs = (cmd_set_baudrate_rs_t*)uart_rx_buffer;
+	uint32_t baudrate = rq->baudrate;
+	uint32_t divisor = 0;
+	uint32_t actual = 0;
+	uint32_t error;
+	uint8_t status = CMD_BAUDRATE_STATUS_UNSUPPORTED;
+
+	if (baudrate != 0)
+		divisor = (CONFIGURE_MASTER_CLOCK + 8*baudrate)/(16*baudrate);
+	if ((divisor != 0) && (divisor <= 0xFFFF))
+	{
+		actual = CONFIGURE_MASTER_CLOCK/(16*divisor);
+		error = (actual > baudrate) ? (actual - baudrate) : (baudrate - actual);
+		// UART tolerates about 2% of mismatch
+		if (error*50 <= baudrate)
+			status = CMD_BAUDRATE_STATUS_OK;
+	}
+
+	rs->status = status;
+	rs->baudrate = actual;
+	cmd_send_slave(sizeof(*rs) - sizeof(rs->hdr));
+	if (status != CMD_BAUDRATE_STATUS_OK)
+		return 0;
+
+	// The response leaves at the current rate
+	cmd_baudrate_wait_tx();
+	cmd_baudrate_previous_divisor = DBGU_GetDivisor();
+	if (cmd_baudrate_initial_divisor == 0)
+		cmd_baudrate_initial_divisor = cmd_baudrate_previous_divisor;
+	DBGU_SetDivisor(divisor);
+	cmd_timer_start();
+	cmd_baudrate_pending = 1;
+
+	return 0;
+}
+#endif
+
 int cmd_printf(const char *fmt,  ... )
 {
     va_list ap;
@@ -261,3 +700,41 @@ void cmd_mem_printf(const char *fmt,  ... )
     vsnprintf((char*)0x308000, 80, fmt, ap);
     va_end(ap);
 }
+
+#if (CONFIGURE_CMD_MEMTEST != 0)
+/**
+ * Fill, verify or test the memory on the target, the host gets the summary
+ * of the errors instead of the memory content
+ */
+CMD_DECLARE_FUNCTION(cmd_memtest)
+{
+	cmd_memtest_rq_t *rq = (cmd_memtest_rq_t*)uart_rx_buffer;
+	cmd_memtest_rs_t *rs = (cmd_memtest_rs_t*)uart_rx_buffer;
+	memtest_result_t result;
+	memtest_t test = (memtest_t)rq->test;
+	uint32_t address = rq->address;
+	uint32_t memory_size = rq->size;
+	uint32_t pattern = rq->pattern;
+
+	// The response overwrites the request
+	rs->status = CMD_MEMTEST_STATUS_BAD_ARGS;
+	result.errors = 0;
+	result.first_address = 0;
+	result.expected = 0;
+	result.actual = 0;
+	result.error_bits = 0;
+	if ((test < MEMTEST_LAST) && ((address & 0x3) == 0) && ((memory_size & 0x3) == 0) && (memory_size != 0))
+	{
+		memtest_run(test, address, memory_size, pattern, &result);
+		rs->status = (result.errors == 0) ? CMD_MEMTEST_STATUS_OK : CMD_MEMTEST_STATUS_ERRORS;
+	}
+	rs->errors = result.errors;
+	rs->first_address = result.first_address;
+	rs->expected = result.expected;
+	rs->actual = result.actual;
+	rs->error_bits = result.error_bits;
+	cmd_send_slave(sizeof(*rs) - sizeof(rs->hdr));
+
+	return 0;
+}
+#endif
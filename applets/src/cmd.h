@@ -15,6 +15,14 @@ extern char cmd_first_command;
 
 #define CMD_FULL_SIZE(payload_size)   (RAW_CMD_SIZE + payload_size)
 
+/**
+ * If the bit is set in the command identifier the first byte of the payload
+ * is a sequence number. The response carries the same sequence number, and
+ * the host can send the next commands without waiting for the response
+ */
+#define CMD_SEQUENCE_FLAG    0x40
+#define SEQUENCE_SIZE        1
+
 /**
  * Read/write memory location commands can contain
  * this values
@@ -57,6 +65,16 @@ enum
 	CMD_ERROR									= 0x00, // 0x00 - Reserved
 	CMD_PING									= 0x03, // 0x03 - Ping
 	CMD_EXIT									,       // 0x04 - Exit main loop
+	CMD_CHECKSUM								,       // 0x05 - CRC32 of memory blocks
+	CMD_READ_BLOCK								,       // 0x06 - Read memory, raw data follows the response
+	CMD_WRITE_BLOCK								,       // 0x07 - Write memory, raw data follows the request
+	CMD_FLASH_INIT								,       // 0x08 - Detect the serial flash
+	CMD_FLASH_WRITE								,       // 0x09 - Start erase and program of the serial flash
+	CMD_FLASH_STATUS							,       // 0x0A - State of the serial flash job
+	CMD_DECOMPRESS								,       // 0x0B - Decompress LZ4 block in the memory
+	CMD_SET_BAUDRATE							,       // 0x0C - Switch DBGU to another rate
+	CMD_MEMTEST									,       // 0x0D - Fill or test a memory range
+	CMD_FLASH_CHECKSUM							,       // 0x0E - CRC32 of serial flash blocks
 	CMD_LAST_COMMON 							= 0x2B, // 0x2B - Last common command
 };
 
@@ -336,8 +354,37 @@ extern cmd_stat_t cmd_stat;
 extern unsigned char uart_rx_buffer[255];
 extern unsigned char uart_rx_buffer_size;
 
+/**
+ * Raw data of CMD_WRITE_BLOCK goes directly to the memory
+ */
+typedef struct
+{
+	uint8_t *start;
+	uint8_t *address;
+	uint32_t size;
+	uint32_t remaining;
+	uint32_t crc;
+	int sequence;
+	char pending;
+} cmd_block_rx_t;
+
+extern cmd_block_rx_t cmd_block_rx;
+
+static inline unsigned char cmd_block_rx_complete(void)
+{
+	return (cmd_block_rx.pending && (cmd_block_rx.remaining == 0));
+}
+
 static inline void uart_rx_buffer_add(unsigned char c)
 {
+	if (cmd_block_rx.remaining != 0)
+	{
+		*cmd_block_rx.address = c;
+		cmd_block_rx.address++;
+		cmd_block_rx.remaining--;
+		return;
+	}
+
 	uart_rx_buffer[uart_rx_buffer_size] = c;
 	uart_rx_buffer_size++;
 	if (uart_rx_buffer_size >= sizeof(uart_rx_buffer))
@@ -377,8 +424,274 @@ typedef struct __attribute__ ((__packed__))
 } cmd_exit_rs_t;
 
 
+/**
+ * Maximum number of blocks in the checksum request, the response
+ * should fit the uart_rx_buffer
+ */
+#define CMD_CHECKSUM_BLOCKS_MAX  32
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint32_t address;
+	uint32_t block_size;
+	uint8_t blocks;
+
+}cmd_checksum_rq_t;
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint32_t crc[CMD_CHECKSUM_BLOCKS_MAX];
+
+} cmd_checksum_rs_t;
+
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint32_t address;
+	uint32_t size;
+
+}cmd_read_block_rq_t;
+
+/**
+ * 'size' bytes of raw data follow the response
+ */
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint32_t size;
+	uint32_t crc;
+
+} cmd_read_block_rs_t;
+
+/**
+ * 'size' bytes of raw data follow the request
+ */
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint32_t address;
+	uint32_t size;
+	uint32_t crc;
+
+}cmd_write_block_rq_t;
+
+#define CMD_BLOCK_STATUS_OK         0
+#define CMD_BLOCK_STATUS_BAD_CRC    1
+
+/**
+ * The response is sent after all data is received
+ */
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint8_t status;
+	uint32_t crc;
+
+} cmd_write_block_rs_t;
+
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+
+}cmd_flash_init_rq_t;
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint8_t status;
+	uint32_t jedec_id;
+	uint32_t size;
+	uint32_t page_size;
+	uint32_t erase_size;
+
+} cmd_flash_init_rs_t;
+
+/**
+ * Program 'size' bytes from the buffer in SRAM or DDR to the serial flash
+ * The response is sent when the job starts, see cmd_flash_status
+ */
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint32_t flash_address;
+	uint32_t buffer_address;
+	uint32_t size;
+
+}cmd_flash_write_rq_t;
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint8_t status;
+
+} cmd_flash_write_rs_t;
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+
+}cmd_flash_status_rq_t;
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint8_t state;
+	uint8_t status;
+	uint32_t done;
+
+} cmd_flash_status_rs_t;
+
+/**
+ * CRC32 of every block in the range of the serial flash, the host checks
+ * the programmed image without reading it back
+ */
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint32_t flash_address;
+	uint32_t block_size;
+	uint8_t blocks;
+
+}cmd_flash_checksum_rq_t;
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint8_t status;
+	uint32_t crc[CMD_CHECKSUM_BLOCKS_MAX];
+
+} cmd_flash_checksum_rs_t;
+
+
+/**
+ * Decompress LZ4 block from 'src' to 'dst'. The source can be inside of the
+ * destination buffer if the host placed it far enough from the beginning
+ */
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint32_t src;
+	uint32_t src_size;
+	uint32_t dst;
+	uint32_t dst_size;
+
+}cmd_decompress_rq_t;
+
+#define CMD_DECOMPRESS_STATUS_OK       0
+#define CMD_DECOMPRESS_STATUS_FORMAT   1
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint8_t status;
+	uint32_t size;
+	uint32_t crc;
+
+} cmd_decompress_rs_t;
+
+/**
+ * The response is sent at the current rate, then the applet switches to the
+ * new rate. If there is no valid command at the new rate for
+ * CMD_BAUDRATE_CONFIRM_TIMEOUT ms the applet returns to the previous rate
+ */
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint32_t baudrate;
+
+}cmd_set_baudrate_rq_t;
+
+#define CMD_BAUDRATE_STATUS_OK           0
+#define CMD_BAUDRATE_STATUS_UNSUPPORTED  1
+
+#define CMD_BAUDRATE_CONFIRM_TIMEOUT     500
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint8_t status;
+	uint32_t baudrate;
+
+} cmd_set_baudrate_rs_t;
+
+/**
+ * Run the test of the memory range, see memtest_t in memtest.h
+ * The response is sent when the test is finished
+ */
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint8_t test;
+	uint32_t address;
+	uint32_t size;
+	uint32_t pattern;
+
+}cmd_memtest_rq_t;
+
+#define CMD_MEMTEST_STATUS_OK          0
+#define CMD_MEMTEST_STATUS_ERRORS      1
+#define CMD_MEMTEST_STATUS_BAD_ARGS    2
+
+typedef struct __attribute__ ((__packed__))
+{
+	cmd_hdr_t hdr;
+	uint8_t status;
+	uint32_t errors;
+	uint32_t first_address;
+	uint32_t expected;
+	uint32_t actual;
+	uint32_t error_bits;
+
+} cmd_memtest_rs_t;
+
+
 extern CMD_DECLARE_FUNCTION (cmd_ping);
 extern CMD_DECLARE_FUNCTION (cmd_exit);
+extern CMD_DECLARE_FUNCTION (cmd_checksum);
+extern CMD_DECLARE_FUNCTION (cmd_read_block);
+extern CMD_DECLARE_FUNCTION (cmd_write_block);
+extern CMD_DECLARE_FUNCTION (cmd_flash_init);
+extern CMD_DECLARE_FUNCTION (cmd_flash_write);
+extern CMD_DECLARE_FUNCTION (cmd_flash_status);
+extern CMD_DECLARE_FUNCTION (cmd_flash_checksum);
+extern CMD_DECLARE_FUNCTION (cmd_decompress);
+extern CMD_DECLARE_FUNCTION (cmd_set_baudrate);
+extern CMD_DECLARE_FUNCTION (cmd_memtest);
+
+/**
+ * Return to the previous rate if the host does not confirm the new one
+ */
+extern void cmd_baudrate_poll(void);
+
+/**
+ * Return to the rate the applet started with, called before exit to SAM-BA monitor
+ */
+extern void cmd_baudrate_restore(void);
+
+/**
+ * Sequence number of the command being handled, -1 if the command has no sequence number
+ */
+extern int cmd_sequence;
+
+/**
+ * Keep the characters which arrive while a command is handled.
+ * Long handlers call this function often enough to avoid the receiver overrun
+ */
+extern void cmd_rx_poll(void);
+
+/**
+ * Send response to CMD_WRITE_BLOCK when all data is received
+ */
+extern void cmd_write_block_done(void);
+
+/**
+ * CRC32 (IEEE 802.3), the same as zlib crc32() and Python binascii.crc32()
+ */
+extern uint32_t cmd_crc32(uint32_t crc, const uint8_t *data, uint32_t size);
 
 extern int cmd_exit_main_loop_flag;
 
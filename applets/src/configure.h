@@ -38,6 +38,43 @@
  */
 #define CONFIGURE_CMD_PING             1
 
+/**
+ * Enable command 'checksum' - CRC32 of memory blocks
+ */
+#define CONFIGURE_CMD_CHECKSUM         1
+
+/**
+ * Enable commands 'read block' and 'write block' - raw memory transfers
+ */
+#define CONFIGURE_CMD_BLOCK            1
+
+/**
+ * Enable command 'decompress' - LZ4 block decoder
+ */
+#define CONFIGURE_CMD_DECOMPRESS       1
+
+/**
+ * Enable command 'set baudrate' - the host switches the line to a faster rate
+ * Uses the PIT for the confirmation timeout
+ */
+#define CONFIGURE_CMD_BAUDRATE         1
+
+/**
+ * Enable command 'memtest' - fill and test memory ranges on the target
+ */
+#define CONFIGURE_CMD_MEMTEST          1
+
+/**
+ * Master clock of DBGU
+ */
+#define CONFIGURE_MASTER_CLOCK         47923200
+
+/**
+ * Enable serial flash commands: init, write, status, checksum
+ * Requires the AT25 and SPI DMA drivers in applets/mk/config.mk
+ */
+#define CONFIGURE_SPI_FLASH            0
+
 /**
  * Enable debug statistics
  */
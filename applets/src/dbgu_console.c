@@ -200,6 +200,35 @@ extern uint32_t DBGU_GetChar(unsigned char *c)
     return res;
 }
 
+/**
+ * \brief Check if the transmitter accepts the next character.
+ *
+ * \return true if DBGU_PutChar() will not wait.
+ */
+extern uint32_t DBGU_IsTxReady( void )
+{
+    return (CONSOLE_DBGU->DBGU_SR & DBGU_SR_TXEMPTY) > 0 ;
+}
+
+/**
+ * \brief Get clock divisor of the baudrate generator.
+ */
+extern uint32_t DBGU_GetDivisor( void )
+{
+    return CONSOLE_DBGU->DBGU_BRGR ;
+}
+
+/**
+ * \brief Change the baudrate without reset of the receiver and transmitter.
+ *
+ * \note The transmitter should be empty.
+ * \param divisor  Master clock divided by 16*baudrate.
+ */
+extern void DBGU_SetDivisor( uint32_t divisor )
+{
+    CONSOLE_DBGU->DBGU_BRGR = divisor ;
+}
+
 /**
  * \brief Check if there is Input from DBGU line.
  *
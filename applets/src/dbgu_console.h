@@ -48,5 +48,8 @@ extern void DBGU_PutStr(const char* s);
 extern void DBGU_PutBuffer(const uint8_t* s, int len);
 uint32_t DBGU_GetChar(unsigned char *c) ;
 extern uint32_t DBGU_IsRxReady( void ) ;
+extern uint32_t DBGU_IsTxReady( void ) ;
+extern uint32_t DBGU_GetDivisor( void ) ;
+extern void DBGU_SetDivisor( uint32_t dwDivisor ) ;
 
 #endif /* _DBGU_CONSOLE_ */
@@ -3,6 +3,7 @@
 #include "configure.h"
 #include "board.h"
 #include "ddr.h"
+#include "memtest.h"
 
 
 #if (BOARD == BOARD_SAMA5D3X)
@@ -283,44 +284,16 @@ void ddr_test()
 #if CONFIGURE_DDR_TEST
     uint32_t *ptr;
     int i;
-    uint32_t size = CONFIGURE_DDR_TEST_SIZE;
+    memtest_result_t result;
 
     ptr = (uint32_t *) DDR_CS_ADDR;
 
-    for (i = 0; i < size; ++i) {
-
-        if (i & 1) {
-            ptr[i] = 0x55AA55AA | (1 << i);
-        }
-        else {
-            ptr[i] = 0xAA55AA55 | (1 << i);
-        }
-    }
-
-    for (i = 0; i < size; ++i) {
-        if (i & 1) {
-            if (ptr[i] != (0x55AA55AA | (1 << i))) {
-                return ;
-            }
-        }
-        else {
-            if (ptr[i] != (0xAA55AA55 | (1 << i))) {
-                return ;
-            }
-        }
-    }
-
-
-    for (i = 0; i < size; ++i)
-    {
-        ptr[i] = (uint32_t)(&ptr[i]);
+    if (memtest_run(MEMTEST_DATA_BUS, DDR_CS_ADDR, sizeof(uint32_t), 0, &result) != 0) {
+        return;
     }
 
-    for (i = 0; i < size; ++i) {
-        if (ptr[i] != (uint32_t)(&ptr[i]))
-		{
-        	return;
-		}
+    if (memtest_run(MEMTEST_PATTERN, DDR_CS_ADDR, CONFIGURE_DDR_TEST_SIZE*sizeof(uint32_t), 0x55AA55AA, &result) != 0) {
+        return;
     }
 
     for (i = 0; i < 10; ++i)
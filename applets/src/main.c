@@ -11,6 +11,10 @@
 #define LC_INCLUDE "lc-addrlabels.h"
 #include "pt.h"
 
+#if (CONFIGURE_SPI_FLASH != 0)
+#include "spiflash/spiflash.h"
+#endif
+
 
 #if (CONFIGURE_MAIN_LOOP != 0) && (CONFIGURE_CMD != 0)
 static unsigned char pt_uart_rx(struct pt *pt)
@@ -42,7 +46,7 @@ static unsigned char pt_uart_tx(struct pt *pt)
 
 	while (1)
 	{
-		PT_YIELD_UNTIL(pt, uart_rx_buffer_size != 0);
+		PT_YIELD_UNTIL(pt, (uart_rx_buffer_size != 0) || cmd_block_rx_complete());
 		process_command();
 	}
 
@@ -55,6 +59,10 @@ static struct pt pt_uart_rx_state;
 static struct pt pt_uart_tx_state;
 #endif
 
+#if (CONFIGURE_MAIN_LOOP != 0) && (CONFIGURE_SPI_FLASH != 0)
+static struct pt pt_spiflash_state;
+#endif
+
 static void main_configure_cs(void)
 {
 
@@ -82,7 +90,7 @@ int main(int argc, char **argv)
 
 #if defined(CONFIGURE_TRACE) && (CONFIGURE_TRACE_PORT == TRACE_PORT_DBGU)
 	DBGU_ConsoleUseDBGU();
-	DBGU_Configure(115200, 47923200); // BOARD_MAINOSC/4); // 47923200? 166000000, 165000000 BOARD_MCK
+	DBGU_Configure(CONSOLE_BAUDRATE, CONFIGURE_MASTER_CLOCK); // BOARD_MAINOSC/4); // 47923200? 166000000, 165000000 BOARD_MCK
 #endif
 
 	TRACE_DEBUG("%s %s", __TIME__, __DATE__);
@@ -102,6 +110,9 @@ int main(int argc, char **argv)
 	PT_INIT(&pt_uart_rx_state);
 	PT_INIT(&pt_uart_tx_state);
 #endif
+#if (CONFIGURE_SPI_FLASH != 0)
+	PT_INIT(&pt_spiflash_state);
+#endif
 #endif
 
 	TRACE_DEBUG("Main loop");
@@ -111,9 +122,21 @@ int main(int argc, char **argv)
 	{
 		pt_uart_rx(&pt_uart_rx_state);
 		pt_uart_tx(&pt_uart_tx_state);
+#if (CONFIGURE_SPI_FLASH != 0)
+		// Erase and program while the UART receives the next buffer
+		pt_spiflash(&pt_spiflash_state);
+#endif
+#if (CONFIGURE_CMD_BAUDRATE != 0)
+		cmd_baudrate_poll();
+#endif
 	}
 #endif
 
+#if (CONFIGURE_CMD_BAUDRATE != 0)
+	// SAM-BA monitor expects the original rate
+	cmd_baudrate_restore();
+#endif
+
 
 	return 0;
 }
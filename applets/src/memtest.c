@@ -0,0 +1,185 @@
+#include <stdint.h>
+
+#include "configure.h"
+#include "memtest.h"
+#if (CONFIGURE_CMD != 0)
+#include "cmd.h"
+#endif
+
+/**
+ * Testing of a large range takes longer than a character on the line
+ */
+#if (CONFIGURE_CMD != 0)
+#define MEMTEST_POLL(i)    if (((i) & 0x3FF) == 0) cmd_rx_poll()
+#else
+#define MEMTEST_POLL(i)
+#endif
+
+static void memtest_error(memtest_result_t *result, volatile uint32_t *address, uint32_t expected, uint32_t actual, uint32_t bits)
+{
+	if (result->errors == 0)
+	{
+		result->first_address = (uint32_t)address;
+		result->expected = expected;
+		result->actual = actual;
+	}
+	result->errors++;
+	result->error_bits |= bits;
+}
+
+static void memtest_fill(volatile uint32_t *p, uint32_t words, uint32_t pattern)
+{
+	uint32_t i;
+
+	for (i = 0;i < words;i++)
+	{
+		MEMTEST_POLL(i);
+		p[i] = pattern;
+	}
+}
+
+static void memtest_verify(volatile uint32_t *p, uint32_t words, uint32_t pattern, memtest_result_t *result)
+{
+	uint32_t i;
+	uint32_t value;
+
+	for (i = 0;i < words;i++)
+	{
+		MEMTEST_POLL(i);
+		value = p[i];
+		if (value != pattern)
+			memtest_error(result, &p[i], pattern, value, value ^ pattern);
+	}
+}
+
+/**
+ * Every data line is set alone and cleared alone
+ */
+static void memtest_data_bus(volatile uint32_t *p, memtest_result_t *result)
+{
+	uint32_t bit;
+	uint32_t pattern;
+	uint32_t value;
+
+	for (bit = 0;bit < 32;bit++)
+	{
+		pattern = 1u << bit;
+		*p = pattern;
+		value = *p;
+		if (value != pattern)
+			memtest_error(result, p, pattern, value, value ^ pattern);
+
+		*p = ~pattern;
+		value = *p;
+		if (value != ~pattern)
+			memtest_error(result, p, ~pattern, value, value ^ ~pattern);
+	}
+}
+
+/**
+ * Write the pattern to the words at power of two offsets, then write the
+ * inverted pattern to one offset at a time. A word which changes shares
+ * an address line with the written one
+ */
+static void memtest_address_bus(volatile uint32_t *p, uint32_t words, uint32_t pattern, memtest_result_t *result)
+{
+	uint32_t offset;
+	uint32_t test_offset;
+	uint32_t value;
+	uint32_t antipattern = ~pattern;
+
+	for (offset = 1;offset < words;offset <<= 1)
+		p[offset] = pattern;
+
+	// Address lines stuck high
+	p[0] = antipattern;
+	for (offset = 1;offset < words;offset <<= 1)
+	{
+		value = p[offset];
+		if (value != pattern)
+			memtest_error(result, &p[offset], pattern, value, offset << 2);
+	}
+	p[0] = pattern;
+
+	// Address lines stuck low or shorted
+	for (test_offset = 1;test_offset < words;test_offset <<= 1)
+	{
+		p[test_offset] = antipattern;
+		value = p[0];
+		if (value != pattern)
+			memtest_error(result, &p[test_offset], pattern, value, test_offset << 2);
+		for (offset = 1;offset < words;offset <<= 1)
+		{
+			value = p[offset];
+			if ((offset != test_offset) && (value != pattern))
+				memtest_error(result, &p[test_offset], pattern, value, test_offset << 2);
+		}
+		p[test_offset] = pattern;
+	}
+}
+
+/**
+ * Own address in every word finds aliasing of the memory regions
+ */
+static void memtest_pattern(volatile uint32_t *p, uint32_t words, uint32_t pattern, memtest_result_t *result)
+{
+	uint32_t pass;
+	uint32_t i;
+	uint32_t expected;
+	uint32_t value;
+
+	for (pass = 0;pass < 2;pass++)
+	{
+		for (i = 0;i < words;i++)
+		{
+			MEMTEST_POLL(i);
+			expected = ((uint32_t)&p[i]) ^ pattern;
+			p[i] = (pass == 0) ? expected : ~expected;
+		}
+		for (i = 0;i < words;i++)
+		{
+			MEMTEST_POLL(i);
+			expected = ((uint32_t)&p[i]) ^ pattern;
+			if (pass != 0)
+				expected = ~expected;
+			value = p[i];
+			if (value != expected)
+				memtest_error(result, &p[i], expected, value, value ^ expected);
+		}
+	}
+}
+
+uint32_t memtest_run(memtest_t test, uint32_t address, uint32_t size, uint32_t pattern, memtest_result_t *result)
+{
+	volatile uint32_t *p = (volatile uint32_t *)address;
+	uint32_t words = size/sizeof(uint32_t);
+
+	result->errors = 0;
+	result->first_address = 0;
+	result->expected = 0;
+	result->actual = 0;
+	result->error_bits = 0;
+
+	switch (test)
+	{
+	case MEMTEST_FILL:
+		memtest_fill(p, words, pattern);
+		break;
+	case MEMTEST_VERIFY:
+		memtest_verify(p, words, pattern, result);
+		break;
+	case MEMTEST_DATA_BUS:
+		memtest_data_bus(p, result);
+		break;
+	case MEMTEST_ADDRESS_BUS:
+		memtest_address_bus(p, words, pattern, result);
+		break;
+	case MEMTEST_PATTERN:
+		memtest_pattern(p, words, pattern, result);
+		break;
+	default:
+		break;
+	}
+
+	return result->errors;
+}
@@ -0,0 +1,40 @@
+#ifndef _MEMTEST_H_INCLUDED_
+#define _MEMTEST_H_INCLUDED_
+
+#include <stdint.h>
+
+/**
+ * Tests of the memory range, see memtest_run()
+ */
+typedef enum
+{
+	MEMTEST_FILL            = 0,    // Write the pattern to every word
+	MEMTEST_VERIFY          = 1,    // Compare every word with the pattern
+	MEMTEST_DATA_BUS        = 2,    // Walking ones and walking zeros in the first word
+	MEMTEST_ADDRESS_BUS     = 3,    // Words at power of two offsets, finds stuck and shorted address lines
+	MEMTEST_PATTERN         = 4,    // Own address XOR pattern in every word, then the inverted value
+	MEMTEST_LAST
+} memtest_t;
+
+/**
+ * Summary of the errors
+ * For the address bus test 'error_bits' contains the offsets of the failed
+ * address lines, for the rest of the tests it contains the failed data lines
+ */
+typedef struct
+{
+	uint32_t errors;
+	uint32_t first_address;
+	uint32_t expected;
+	uint32_t actual;
+	uint32_t error_bits;
+
+} memtest_result_t;
+
+/**
+ * The address and the size are aligned to words
+ * Returns number of errors
+ */
+extern uint32_t memtest_run(memtest_t test, uint32_t address, uint32_t size, uint32_t pattern, memtest_result_t *result);
+
+#endif // _MEMTEST_H_INCLUDED_
@@ -7,6 +7,8 @@
 #include <board.h>
 #include <libspiflash.h>
 #include <string.h>
+#include "cmd.h"
+#include "spiflash.h"
 /*----------------------------------------------------------------------------
  *        Internal definitions
  *----------------------------------------------------------------------------*/
@@ -65,9 +67,13 @@ static uint32_t bufferSize;
 /**Size of the block to be erased in bytes. */
 static uint32_t eraseBlockSize;
 
-void spiflah_init(void)
+/** JEDEC ID of the detected flash, 0 if there is no flash */
+static uint32_t flashJedecId;
+
+unsigned char spiflah_init(void)
 {
     uint32_t jedecId;
+    flashJedecId = 0;
     DMAD_Initialize( &dmad, 1 );
     /* Initialize the SPI and serial flash */
     SPID_Configure(&spid, SPI0, ID_SPI0, &dmad);
@@ -90,8 +96,202 @@ void spiflah_init(void)
 
         pageSize = AT25_PageSize(&at25);
         blockSize = AT25_BlockSize(&at25);
+        flashJedecId = jedecId;
         TRACE_DEBUG("Page %d, block %d\n\r", pageSize, blockSize);
     }
     while (0);
+
+    return (flashJedecId != 0) ? SPIFLASH_STATUS_OK : SPIFLASH_STATUS_NO_DEVICE;
+}
+
+/**
+ * Programming job. The host loads the next buffer while the job runs
+ */
+static struct
+{
+    uint32_t flashAddress;
+    uint8_t *data;
+    uint32_t size;
+    uint32_t done;
+    uint32_t eraseAddress;
+    uint8_t state;
+    uint8_t status;
+} job;
+
+/** Blocks in this range are erased, the job does not erase them again */
+static uint32_t erasedStart, erasedEnd;
+
+/** Status register of the flash, read by DMA */
+static uint8_t flashStatus;
+
+/** Size of the reads of the checksum command */
+#define CHECKSUM_READ_SIZE  256
+
+/** Data of the checksum command, read by DMA */
+static uint8_t checksumBuffer[CHECKSUM_READ_SIZE];
+
+/**
+ * Read the status register until the flash is ready, yield while the SPI is busy
+ */
+#define PT_SPIFLASH_WAIT_READY(pt)                                                     \
+    do {                                                                               \
+        AT25_SendCommand(&at25, AT25_READ_STATUS, 1, &flashStatus, 1, 0, 0, 0);       \
+        PT_YIELD_UNTIL(pt, !AT25_IsBusy(&at25));                                      \
+    } while ((flashStatus & AT25_STATUS_RDYBSY) == AT25_STATUS_RDYBSY_BUSY)
+
+unsigned char pt_spiflash(struct pt *pt)
+{
+    static uint32_t writeSize;
+
+    PT_BEGIN(pt);
+
+    while (1)
+    {
+        PT_YIELD_UNTIL(pt, job.state == SPIFLASH_STATE_BUSY);
+
+        // Erase the blocks which are not erased yet
+        while (job.eraseAddress < (job.flashAddress + job.size))
+        {
+            if ((job.eraseAddress < erasedStart) || (job.eraseAddress >= erasedEnd))
+            {
+                AT25D_EnableWrite(&at25);
+                AT25_SendCommand(&at25, AT25_BLOCK_ERASE_64K, 4, 0, 0, job.eraseAddress, 0, 0);
+                PT_YIELD_UNTIL(pt, !AT25_IsBusy(&at25));
+                PT_SPIFLASH_WAIT_READY(pt);
+
+                if (job.eraseAddress != erasedEnd)
+                {
+                    erasedStart = job.eraseAddress;
+                }
+                erasedEnd = job.eraseAddress + SPIFLASH_ERASE_BLOCK_SIZE;
+            }
+            job.eraseAddress += SPIFLASH_ERASE_BLOCK_SIZE;
+        }
+
+        // Program one page after the other
+        while (job.done < job.size)
+        {
+            writeSize = min(job.size - job.done, pageSize - ((job.flashAddress + job.done) % pageSize));
+
+            AT25D_EnableWrite(&at25);
+            AT25_SendCommand(&at25, AT25_BYTE_PAGE_PROGRAM, 4, job.data + job.done, writeSize, job.flashAddress + job.done, 0, 0);
+            PT_YIELD_UNTIL(pt, !AT25_IsBusy(&at25));
+            PT_SPIFLASH_WAIT_READY(pt);
+
+            if ((flashStatus & AT25_STATUS_EPE) == AT25_STATUS_EPE_ERROR)
+            {
+                job.status = SPIFLASH_STATUS_PROGRAM;
+                break;
+            }
+            job.done += writeSize;
+        }
+
+        AT25D_DisableWrite(&at25);
+        job.state = (job.status == SPIFLASH_STATUS_OK) ? SPIFLASH_STATE_IDLE : SPIFLASH_STATE_ERROR;
+    }
+
+    PT_END(pt);
+}
+
+CMD_DECLARE_FUNCTION(cmd_flash_init)
+{
+    cmd_flash_init_rs_t *rs = (cmd_flash_init_rs_t*)uart_rx_buffer;
+
+    rs->status = spiflah_init();
+    rs->jedec_id = flashJedecId;
+    rs->size = (flashJedecId != 0) ? AT25_Size(&at25) : 0;
+    rs->page_size = pageSize;
+    rs->erase_size = SPIFLASH_ERASE_BLOCK_SIZE;
+    job.state = SPIFLASH_STATE_IDLE;
+    erasedStart = erasedEnd = 0;
+    cmd_send_slave(sizeof(*rs) - sizeof(rs->hdr));
+
+    return 0;
+}
+
+CMD_DECLARE_FUNCTION(cmd_flash_write)
+{
+    cmd_flash_write_rq_t *rq = (cmd_flash_write_rq_t*)uart_rx_buffer;
+    cmd_flash_write_rs_t *rs = (cmd_flash_write_rs_t*)uart_rx_buffer;
+    unsigned char status = SPIFLASH_STATUS_OK;
+
+    if (flashJedecId == 0)
+        status = SPIFLASH_STATUS_NO_DEVICE;
+    else if (job.state == SPIFLASH_STATE_BUSY)
+        status = SPIFLASH_STATUS_BUSY;
+    else if ((rq->flash_address + rq->size) > AT25_Size(&at25))
+        status = SPIFLASH_STATUS_RANGE;
+
+    if (status == SPIFLASH_STATUS_OK)
+    {
+        job.flashAddress = rq->flash_address;
+        job.data = (uint8_t*)rq->buffer_address;
+        job.size = rq->size;
+        job.done = 0;
+        job.eraseAddress = job.flashAddress - (job.flashAddress % SPIFLASH_ERASE_BLOCK_SIZE);
+        job.status = SPIFLASH_STATUS_OK;
+        job.state = SPIFLASH_STATE_BUSY;
+    }
+
+    // The job starts in the main loop after the response
+    rs->status = status;
+    cmd_send_slave(sizeof(*rs) - sizeof(rs->hdr));
+
+    return 0;
+}
+
+CMD_DECLARE_FUNCTION(cmd_flash_status)
+{
+    cmd_flash_status_rs_t *rs = (cmd_flash_status_rs_t*)uart_rx_buffer;
+
+    rs->state = job.state;
+    rs->status = job.status;
+    rs->done = job.done;
+    cmd_send_slave(sizeof(*rs) - sizeof(rs->hdr));
+
+    return 0;
+}
+
+CMD_DECLARE_FUNCTION(cmd_flash_checksum)
+{
+    cmd_flash_checksum_rq_t *rq = (cmd_flash_checksum_rq_t*)uart_rx_buffer;
+    cmd_flash_checksum_rs_t *rs = (cmd_flash_checksum_rs_t*)uart_rx_buffer;
+    // The response overwrites the request
+    uint32_t address = rq->flash_address;
+    uint32_t block_size = rq->block_size;
+    uint8_t blocks = rq->blocks;
+    uint8_t status = SPIFLASH_STATUS_OK;
+    uint32_t crc, done, readSize;
+    uint8_t i;
+
+    if (blocks > CMD_CHECKSUM_BLOCKS_MAX)
+        blocks = CMD_CHECKSUM_BLOCKS_MAX;
+
+    if (flashJedecId == 0)
+        status = SPIFLASH_STATUS_NO_DEVICE;
+    else if (job.state == SPIFLASH_STATE_BUSY)
+        status = SPIFLASH_STATUS_BUSY;
+    else if ((address + block_size*blocks) > AT25_Size(&at25))
+        status = SPIFLASH_STATUS_RANGE;
+
+    if (status != SPIFLASH_STATUS_OK)
+        blocks = 0;
+
+    for (i = 0;i < blocks;i++)
+    {
+        crc = 0;
+        for (done = 0;done < block_size;done += readSize)
+        {
+            readSize = min(block_size - done, CHECKSUM_READ_SIZE);
+            AT25D_Read(&at25, checksumBuffer, readSize, address + done);
+            crc = cmd_crc32(crc, checksumBuffer, readSize);
+        }
+        rs->crc[i] = crc;
+        address += block_size;
+    }
+    rs->status = status;
+    cmd_send_slave(sizeof(rs->status) + blocks*sizeof(rs->crc[0]));
+
+    return 0;
 }
 
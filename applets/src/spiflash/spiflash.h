@@ -0,0 +1,47 @@
+#ifndef _SPIFLASH_H_INCLUDED_
+#define _SPIFLASH_H_INCLUDED_
+
+#define LC_INCLUDE "lc-addrlabels.h"
+#include "pt.h"
+
+/**
+ * The job erases all 64KB blocks it touches unless the block was erased
+ * by an earlier job
+ */
+#define SPIFLASH_ERASE_BLOCK_SIZE    (64*1024)
+
+/**
+ * State of the programming job
+ */
+enum
+{
+	SPIFLASH_STATE_IDLE          = 0,
+	SPIFLASH_STATE_BUSY          = 1,
+	SPIFLASH_STATE_ERROR         = 2,
+};
+
+/**
+ * Status in the responses of the flash commands
+ */
+enum
+{
+	SPIFLASH_STATUS_OK           = 0,
+	SPIFLASH_STATUS_NO_DEVICE    = 1,
+	SPIFLASH_STATUS_BUSY         = 2,
+	SPIFLASH_STATUS_PROGRAM      = 3,
+	SPIFLASH_STATUS_RANGE        = 4,
+};
+
+/**
+ * Detect the serial flash and remove the protection
+ * Returns SPIFLASH_STATUS_OK if the flash is ready
+ */
+extern unsigned char spiflah_init(void);
+
+/**
+ * The programming job. Erase and program steps start SPI DMA transfers and
+ * yield while the flash is busy, the UART is served in the meantime
+ */
+extern unsigned char pt_spiflash(struct pt *pt);
+
+#endif // _SPIFLASH_H_INCLUDED_
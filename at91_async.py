@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Drive many devices from one thread
+
+All I/O is non-blocking. Every device operation is a generator (a task)
+which yields requests to the Reactor, similar to protothreads of the applet:
+  Read(connection, count, timeout) - resume when count bytes arrived or timeout expired,
+                                     the received data is sent back to the task
+  Sleep(seconds)                   - resume after the delay
+  generator                        - run another task as a subroutine
+  Result(value)                    - return value to the caller task
+
+Example:
+    reactor = Reactor()
+    boards = [AsyncAT91(device) for device in ["/dev/ttyUSB0", "/dev/ttyUSB1"]]
+    tasks = [reactor.spawn(board.dump(0x308000, 4096)) for board in boards]
+    reactor.run()
+    for task in tasks:
+        (result, data) = task.result
+'''
+
+import os
+import time
+import types
+import select
+import serial
+
+from at91_loader import statManager, StatManager, XModem, CmdLoop, AT91, buildhexstring, converBinToInt, logger
+
+
+class Read:
+    def __init__(self, connection, count, timeout=1.0):
+        self.connection = connection
+        self.count = count
+        self.deadline = time.time() + timeout
+
+class Sleep:
+    def __init__(self, seconds):
+        self.deadline = time.time() + seconds
+
+class Result:
+    def __init__(self, value):
+        self.value = value
+
+
+class AsyncSerialConnection:
+    '''
+    Non-blocking tty. The reactor collects received data in the rx buffer
+    and drains the tx buffer when the tty is writable
+    '''
+    def __init__(self, device, rate):
+        tty = serial.Serial();
+        tty.port = device;
+        tty.baudrate=rate;
+        tty.bytesize=serial.EIGHTBITS;
+        tty.parity=serial.PARITY_NONE;
+        tty.stopbits=serial.STOPBITS_ONE;
+        tty.timeout=0;
+        tty.writeTimeout=0;
+        tty.xonxoff=False;
+        tty.rtscts=False;
+        tty.dsrdtr=False;
+        self.tty = tty
+        self.device = device
+        self.rxBuffer = ""
+        self.txBuffer = ""
+        self.stat = StatManager.Block(device)
+        self.stat.addFieldsInt(["rx", "tx", "rxBytes", "txBytes", "rxFailed", "txFailed"])
+        statManager.addCounters("AsyncSerialConnection", self.stat)
+
+    def connect(self):
+        result = False
+        try:
+            self.tty.open()
+            result = True
+        except serial.SerialException:
+            pass
+        return result
+
+    def disconnect(self):
+        if (self.tty.isOpen()):
+            self.tty.close()
+
+    def isOpen(self):
+        return self.tty.isOpen()
+
+    def fileno(self):
+        return self.tty.fileno()
+
+    def name(self):
+        return self.device
+
+    def write(self, data):
+        '''
+        Add data to the tx buffer, the reactor sends it
+        '''
+        self.txBuffer = self.txBuffer + data
+        return True
+
+    def write2(self, data):
+        return self.write(data)
+
+    def onReadable(self):
+        try:
+            data = os.read(self.fileno(), 4096)
+            self.rxBuffer = self.rxBuffer + data
+            self.stat.rx = self.stat.rx + 1
+            self.stat.rxBytes = self.stat.rxBytes + len(data)
+        except OSError:
+            self.stat.rxFailed = self.stat.rxFailed + 1
+
+    def onWritable(self):
+        try:
+            count = os.write(self.fileno(), self.txBuffer)
+            self.txBuffer = self.txBuffer[count:]
+            self.stat.tx = self.stat.tx + 1
+            self.stat.txBytes = self.stat.txBytes + count
+        except OSError:
+            self.stat.txFailed = self.stat.txFailed + 1
+
+    def take(self, count):
+        '''
+        Remove up to count bytes from the rx buffer
+        '''
+        data = self.rxBuffer[:count]
+        self.rxBuffer = self.rxBuffer[count:]
+        return data
+
+    def swFlush(self):
+        '''
+        Drop the received data
+        '''
+        count = len(self.rxBuffer)
+        self.rxBuffer = ""
+        return count
+
+
+class Task:
+    def __init__(self, generator):
+        self.stack = [generator]
+        self.value = None
+        self.request = None
+        self.result = None
+        self.done = False
+        self.exception = None
+
+
+class Reactor:
+    '''
+    Event loop for all connections. Tasks run until they yield a request
+    which can not be completed immediately
+    '''
+    def __init__(self):
+        self.tasks = []
+        # All connections the tasks have read from
+        self.connections = set()
+        self.stat = StatManager.Block("")
+        self.stat.addFieldsInt(["tasks", "selects", "resumes", "timeouts", "exceptions"])
+        statManager.addCounters("Reactor", self.stat)
+
+    def addConnection(self, connection):
+        '''
+        Make sure that the tx buffer of the connection is sent even if no task reads from it
+        '''
+        self.connections.add(connection)
+
+    def spawn(self, generator):
+        task = Task(generator)
+        self.tasks.append(task)
+        self.stat.tasks = self.stat.tasks + 1
+        self.__step(task)
+        return task
+
+    def __finish(self, task, value):
+        task.result = value
+        task.done = True
+        task.request = None
+
+    def __step(self, task):
+        '''
+        Run the task until it waits for data or time
+        '''
+        while (not task.done):
+            generator = task.stack[-1]
+            try:
+                request = generator.send(task.value)
+            except StopIteration:
+                request = Result(None)
+            except Exception as e:
+                self.stat.exceptions = self.stat.exceptions + 1
+                logger.error("Task failed: {0}".format(e))
+                task.exception = e
+                self.__finish(task, None)
+                break
+            task.value = None
+
+            if (isinstance(request, types.GeneratorType)):
+                task.stack.append(request)
+            elif (isinstance(request, Result)):
+                task.stack.pop()
+                task.value = request.value
+                if (len(task.stack) == 0):
+                    self.__finish(task, request.value)
+            elif (isinstance(request, Read) and (len(request.connection.rxBuffer) >= request.count)):
+                task.value = request.connection.take(request.count)
+            else:
+                if (isinstance(request, Read)):
+                    self.connections.add(request.connection)
+                task.request = request
+                break
+
+    def __resume(self, task, now):
+        '''
+        Complete the pending request of the task if possible
+        '''
+        request = task.request
+        if (isinstance(request, Read)):
+            if (len(request.connection.rxBuffer) >= request.count):
+                task.value = request.connection.take(request.count)
+            elif (now >= request.deadline):
+                self.stat.timeouts = self.stat.timeouts + 1
+                task.value = request.connection.take(request.count)
+            else:
+                return
+        elif (now < request.deadline):
+            return
+
+        self.stat.resumes = self.stat.resumes + 1
+        task.request = None
+        self.__step(task)
+
+    def run(self):
+        '''
+        Serve the tasks until all of them are completed
+        '''
+        while (True):
+            pending = [task for task in self.tasks if (not task.done)]
+            readers = [c for c in self.connections if c.isOpen()]
+            writers = [c for c in readers if (len(c.txBuffer) > 0)]
+            if ((len(pending) == 0) and (len(writers) == 0)):
+                break
+
+            timeout = 0.1
+            if (len(pending) > 0):
+                deadline = min([task.request.deadline for task in pending])
+                timeout = max(0, deadline - time.time())
+            self.stat.selects = self.stat.selects + 1
+            (readable, writable, _) = select.select(readers, writers, [], timeout)
+            for c in writable:
+                c.onWritable()
+            for c in readable:
+                c.onReadable()
+
+            now = time.time()
+            for task in pending:
+                self.__resume(task, now)
+
+        self.tasks = []
+
+
+class AsyncAT91:
+    '''
+    Same operations as AT91, every method returns a task for the Reactor
+    '''
+    BULK_READ_THRESHOLD = AT91.BULK_READ_THRESHOLD
+    TIMEOUT = 1.0
+
+    def __init__(self, device, rate=115200):
+        self.tty = AsyncSerialConnection(device, rate)
+        self.xmodem = XModem(self.tty)
+        self.cmdLoop = CmdLoop(self)
+        self.isConnected = False
+        self.stat = StatManager.Block(device)
+        self.stat.addFieldsInt(["dump", "read", "write", "executeCode", "command", "failedRead", "bulkRead", "bulkWrite"])
+        statManager.addCounters("AsyncAT91", self.stat)
+
+    def getTTY(self):
+        return self.tty
+
+    def connectionPollEnable(self, enable):
+        '''
+        There is no poll thread, the method is required by CmdLoop
+        '''
+        pass
+
+    def connect(self):
+        '''
+        Open the tty and check that SAM-BA monitor responds
+        '''
+        result = self.tty.isOpen() or self.tty.connect()
+        if (result):
+            self.tty.write("N#")
+            s = yield Read(self.tty, 2, self.TIMEOUT)
+            result = ("\n\r" in s)
+        self.isConnected = result
+        yield Result(result)
+
+    def __read(self, address):
+        self.tty.write("w{0},4#".format(buildhexstring(address)))
+        data = yield Read(self.tty, 4, self.TIMEOUT)
+        result = (len(data) == 4)
+        if (not result):
+            self.stat.failedRead = self.stat.failedRead + 1
+        yield Result((result, data))
+
+    def read(self, address):
+        self.stat.read = self.stat.read + 1
+        (result, data) = yield self.__read(address)
+        yield Result((result, data))
+
+    def write(self, address, data):
+        '''
+        @param data:32 bits value or list of values for consecutive addresses
+        '''
+        self.stat.write = self.stat.write + 1
+        if (not isinstance(data, list)):
+            data = [data]
+        s = ""
+        for value in data:
+            s = s + "W{0},{1}#".format(buildhexstring(address), buildhexstring(value))
+            address = address + 4
+        self.tty.write(s)
+        yield Result(True)
+
+    def __receiveBlocks(self, size):
+        '''
+        XMODEM receiver, see XModem.receive()
+        '''
+        xmodem = self.xmodem
+        blocks = []
+        expectedBlock = 1
+        retries = xmodem.RETRIES
+        response = xmodem.CRC
+        result = False
+        while (retries > 0):
+            self.tty.write(response)
+            c = yield Read(self.tty, 1, self.TIMEOUT)
+            if (c == xmodem.SOH):
+                block = yield Read(self.tty, xmodem.BLOCK_SIZE + 4, self.TIMEOUT)
+                result = (len(block) == xmodem.BLOCK_SIZE + 4)
+                if (result):
+                    (result, blockNumber, data) = xmodem.parseBlock(block)
+                if (not result):
+                    response = xmodem.NAK
+                    retries = retries - 1
+                    self.tty.swFlush()
+                    continue
+                if (blockNumber == (expectedBlock & 0xFF)):
+                    blocks.append(data)
+                    expectedBlock = expectedBlock + 1
+                response = xmodem.ACK
+                retries = xmodem.RETRIES
+            elif (c == xmodem.EOT):
+                self.tty.write(xmodem.ACK)
+                result = True
+                break
+            else:
+                retries = retries - 1
+                result = False
+                if (c == xmodem.CAN):
+                    break
+
+        data = "".join(blocks)
+        result = result and (len(data) >= size)
+        yield Result((result, data[:size]))
+
+    def __sendBlocks(self, data):
+        '''
+        XMODEM sender, see XModem.send()
+        '''
+        xmodem = self.xmodem
+        c = yield Read(self.tty, 1, xmodem.RETRIES*self.TIMEOUT)
+        if (c != xmodem.CRC):
+            yield Result(False)
+
+        blockNumber = 1
+        index = 0
+        while (index < len(data)):
+            block = xmodem.buildBlock(blockNumber, data[index:index+xmodem.BLOCK_SIZE])
+            retries = xmodem.RETRIES
+            result = False
+            while (retries > 0):
+                self.tty.write(block)
+                c = yield Read(self.tty, 1, self.TIMEOUT)
+                if (c == xmodem.ACK):
+                    result = True
+                    break
+                if (c == xmodem.CAN):
+                    break
+                retries = retries - 1
+            if (not result):
+                yield Result(False)
+            blockNumber = blockNumber + 1
+            index = index + xmodem.BLOCK_SIZE
+
+        self.tty.write(xmodem.EOT)
+        c = yield Read(self.tty, 1, self.TIMEOUT)
+        yield Result(c == xmodem.ACK)
+
+    def dump(self, address, size):
+        self.stat.dump = self.stat.dump + 1
+        if (size >= self.BULK_READ_THRESHOLD):
+            self.stat.bulkRead = self.stat.bulkRead + 1
+            self.tty.write("R{0},{1}#".format(buildhexstring(address, 8), buildhexstring(size, 8)))
+            (result, data) = yield self.__receiveBlocks(size)
+            yield Result((result, data))
+
+        data = ""
+        result = True
+        while (len(data) + 4 <= size):
+            (result, d) = yield self.__read(address + len(data))
+            if (not result):
+                break
+            data = data + d
+        yield Result((result, data))
+
+    def executeCode(self, address, entryPoint, code):
+        '''
+        Load binary code to the specified location and execute
+        '''
+        self.stat.executeCode = self.stat.executeCode + 1
+        self.stat.bulkWrite = self.stat.bulkWrite + 1
+        self.tty.write("S{0},{1}#".format(buildhexstring(address, 8), buildhexstring(len(code), 8)))
+        result = yield self.__sendBlocks(code)
+        if (not result):
+            # Fallback to the word by word write
+            yield Sleep(self.TIMEOUT)
+            self.tty.swFlush()
+            values = []
+            for index in range(0, len(code) - 3, 4):
+                values.append(converBinToInt(code[index:index+4]))
+            result = yield self.write(address, values)
+        self.tty.write("G{0}#".format(buildhexstring(entryPoint)))
+        yield Result(result)
+
+    def command(self, command, payload=None, timeout=TIMEOUT):
+        '''
+        Send command to the applet and wait for the response
+        Returns tuple (result, payload of the response)
+        '''
+        self.stat.command = self.stat.command + 1
+        self.cmdLoop.sendCommand(command, payload)
+        data = ""
+        deadline = time.time() + timeout
+        while (time.time() < deadline):
+            d = yield Read(self.tty, 1, deadline - time.time())
+            # Take the rest of the received data
+            data = data + d + self.tty.take(len(self.tty.rxBuffer))
+            (result, responsePayload, _) = self.cmdLoop.findResponse(data, command)
+            if (result):
+                yield Result((True, responsePayload))
+        yield Result((False, None))
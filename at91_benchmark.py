@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""AT91 benchmark.
+
+Measure throughput of the loader operations. If the device is not
+specified the benchmark runs against the built-in emulator
+
+Usage:
+  at91_benchmark.py -h | --help
+  at91_benchmark.py [--device=<STR>] [--baudrate=<INT>] [--latency=<FLOAT>] [--address=<HEX>] [--size=<INT>] [--count=<INT>] [--filename=<STR>] [--poll]
+
+Options:
+  -h --help             Show this screen.
+  -d --device=<STR>     Serial device, the emulator is used if not set
+  -b --baudrate=<INT>   Line rate of the emulator, 0 disables pacing [default: 115200]
+  -l --latency=<FLOAT>  Response latency of the emulator in seconds [default: 0]
+  -a --address=<HEX>    Address of the memory used by the tests [default: 308000]
+  -s --size=<INT>       Size of the dump and of the emulated code image [default: 65536]
+  -c --count=<INT>      Number of read, write and ping operations [default: 100]
+  -f --filename=<STR>   Applet for executeCode and ping [default: ./applets/mk/firmware.bin]
+  --poll                Keep the connection polling enabled
+"""
+
+import os
+import time
+import logging
+from docopt import docopt
+
+import at91_loader
+from at91_loader import AT91, CmdLoop, logger
+from at91_emulator import Emulator
+
+
+class Benchmark:
+    '''
+    Run the loader operations and collect number of operations, bytes and time
+    '''
+    def __init__(self, at91, address, size, count):
+        self.at91 = at91
+        self.address = address
+        self.size = size
+        self.count = count
+        self.results = []
+
+    def measure(self, name, operation):
+        '''
+        @param operation:function which returns tuple (result, ops, byteCount)
+        '''
+        startTime = time.time()
+        (result, ops, byteCount) = operation()
+        elapsed = time.time() - startTime
+        self.results.append((name, result, ops, byteCount, elapsed))
+        return result
+
+    def dump(self):
+        (result, data) = self.at91.dump(self.address, self.size)
+        return (result, 1, len(data))
+
+    def read(self):
+        result = True
+        for _ in range(self.count):
+            (result, data) = self.at91.read(self.address)
+            if (not result):
+                break
+        return (result, self.count, 4*self.count)
+
+    def write(self):
+        result = True
+        for i in range(self.count):
+            result = self.at91.write(self.address + 4*i, i)
+            if (not result):
+                break
+        return (result, self.count, 4*self.count)
+
+    def executeCode(self, code, differential=False):
+        self.at91.executeCode(self.address, self.address, code, differential=differential)
+        return (True, 1, len(code))
+
+    def ping(self):
+        cmdLoop = CmdLoop(self.at91)
+        result = True
+        for _ in range(self.count):
+            cmdLoop.sendCommand(CmdLoop.CMD_PING)
+            result = self.waitResponse(CmdLoop.CMD_PING)
+            if (not result):
+                break
+        return (result, self.count, 3*self.count)
+
+    def pingPipelined(self):
+        '''
+        Sequenced pings, several pings are in flight
+        '''
+        results = CmdLoop(self.at91).execute([(CmdLoop.CMD_PING, None)]*self.count)
+        result = all([r for (r, _, _) in results])
+        return (result, self.count, 4*self.count)
+
+    def exitApplet(self):
+        CmdLoop(self.at91).sendCommand(CmdLoop.CMD_EXIT)
+        return (self.waitResponse(CmdLoop.CMD_EXIT), 1, 3)
+
+    def waitResponse(self, command, timeout=1.0):
+        '''
+        Skip the debug output of the applet until the response frame
+        '''
+        s = ""
+        deadline = time.time() + timeout
+        while (time.time() < deadline):
+            (result, data) = self.at91.getOutput(16, max(deadline - time.time(), 0))
+            s = s + data
+            for commandId in [command, command | 0x80]:
+                if (s.endswith(chr(commandId) + chr(0x01) + chr((0x100 - commandId - 0x01) & 0xFF))):
+                    return True
+        return False
+
+    def printResults(self):
+        fieldPattern = "{:>14}"
+        print "".join([fieldPattern.format(f) for f in ["operation", "result", "ops", "bytes", "seconds", "ops/s", "bytes/s"]])
+        for (name, result, ops, byteCount, elapsed) in self.results:
+            elapsed = max(elapsed, 1e-9)
+            fields = [name, str(result), ops, byteCount, "{0:.3f}".format(elapsed), "{0:.1f}".format(ops/elapsed), "{0:.1f}".format(byteCount/elapsed)]
+            print "".join([fieldPattern.format(f) for f in fields])
+
+
+def loadCode(filename, size, emulated):
+    '''
+    Use the applet if available, the emulator runs any image
+    '''
+    if (os.path.exists(filename)):
+        with open(filename, "rb") as f:
+            return f.read()
+    if (emulated):
+        return os.urandom(size)
+    return None
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__, version='AT91 benchmark 0.1')
+
+    # Do not log every applet command
+    logging.basicConfig()
+    logger.setLevel(logging.WARNING)
+
+    emulator = None
+    device = arguments['--device']
+    if (device == None):
+        emulator = Emulator(int(arguments['--baudrate']), float(arguments['--latency']))
+        emulator.start()
+        device = emulator.getDevice()
+    logger.info("Use device {0}".format(device))
+
+    (_, address) = at91_loader.convertToInt(arguments['--address'], 16)
+    (_, size) = at91_loader.convertToInt(arguments['--size'], 10)
+    (_, count) = at91_loader.convertToInt(arguments['--count'], 10)
+
+    at91 = AT91(device)
+    at91.start()
+    if (not at91.waitConnection()):
+        logger.error("No connection to {0}".format(device))
+    at91.connectionPollEnable(arguments['--poll'])
+
+    benchmark = Benchmark(at91, address, size, count)
+    try:
+        benchmark.measure("dump", benchmark.dump)
+        benchmark.measure("read", benchmark.read)
+        benchmark.measure("write", benchmark.write)
+
+        code = loadCode(arguments['--filename'], size, emulator != None)
+        if (code != None):
+            benchmark.measure("executeCode", lambda : benchmark.executeCode(code))
+            # The same image again, nothing to upload
+            benchmark.measure("reloadDiff", lambda : benchmark.executeCode(code, True))
+            # The running applet serves the dump
+            benchmark.measure("appletDump", benchmark.dump)
+            benchmark.measure("ping", benchmark.ping)
+            benchmark.measure("pingPipelined", benchmark.pingPipelined)
+            benchmark.exitApplet()
+        else:
+            logger.error("No applet {0}, skip executeCode and ping".format(arguments['--filename']))
+    finally:
+        at91.cancel()
+        if (emulator != None):
+            emulator.cancel()
+
+    benchmark.printResults()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""AT91 loader client.
+
+Send the commands to at91_loader.py daemon. The commands are the commands of
+the interactive mode, for example 'dump 308000 64' or 'write 308000 11AE3255'.
+The command 'shutdown' stops the daemon. Exit status is 0 if all commands succeeded
+
+Usage:
+  at91_client.py -h | --help
+  at91_client.py [--socket=<STR>] <command>...
+
+Options:
+  -h --help            Show this screen.
+  --socket=<STR>       Unix socket of the daemon [default: /tmp/at91_loader.sock]
+"""
+
+# The client starts for every command, do not import the loader, serial and docopt
+import sys
+import json
+import socket
+
+
+DAEMON_SOCKET = "/tmp/at91_loader.sock"
+
+
+def parseArguments(argv):
+    '''
+    Returns tuple (result, socketPath, command)
+    '''
+    socketPath = DAEMON_SOCKET
+    words = []
+    for arg in argv:
+        if (arg.startswith("--socket=")):
+            socketPath = arg[len("--socket="):]
+        elif (arg in ["-h", "--help"]):
+            return (False, socketPath, "")
+        else:
+            words.append(arg)
+    return ((len(words) > 0), socketPath, " ".join(words))
+
+def sendCommand(socketPath, command):
+    '''
+    Returns tuple (result, output)
+    '''
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socketPath)
+        f = s.makefile("rw")
+        f.write(command + "\n")
+        f.flush()
+        line = f.readline()
+        f.close()
+    except socket.error as e:
+        return (False, "No daemon on {0}: {1}\n".format(socketPath, e))
+    finally:
+        s.close()
+
+    if (line == ""):
+        return (False, "No response from the daemon\n")
+    response = json.loads(line)
+    return (response["result"], response["output"])
+
+
+if __name__ == '__main__':
+    (result, socketPath, command) = parseArguments(sys.argv[1:])
+    if (not result):
+        print __doc__
+        sys.exit(1)
+
+    (result, output) = sendCommand(socketPath, command)
+    sys.stdout.write(output)
+    sys.exit(0 if result else 1)
@@ -0,0 +1,662 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""AT91 emulator.
+
+Pseudo terminal which answers SAM-BA monitor and applet command loop
+protocols. Use the printed device name as --device of at91_loader.py
+
+Usage:
+  at91_emulator.py -h | --help
+  at91_emulator.py [--baudrate=<INT>] [--latency=<FLOAT>] [--max-baudrate=<INT>] [--notrace]
+
+Options:
+  -h --help            Show this screen.
+  -b --baudrate=<INT>  Emulated line rate, 0 disables pacing [default: 115200]
+  -l --latency=<FLOAT>  Delay in seconds before every response [default: 0]
+  --max-baudrate=<INT>  Higher rates corrupt some bytes, 0 if all rates are reliable [default: 0]
+  --notrace            Do not emulate the applet debug output
+"""
+
+import os
+import tty
+import random
+import re
+import array
+import fcntl
+import termios
+import time
+import select
+import struct
+import binascii
+import threading
+
+
+class Memory:
+    '''
+    Sparse memory of the target. Pages are allocated on the first access
+    '''
+    PAGE_SIZE = 4096
+
+    def __init__(self):
+        self.pages = {}
+
+    def __page(self, address):
+        pageAddress = address - (address % self.PAGE_SIZE)
+        page = self.pages.get(pageAddress, None)
+        if (page == None):
+            page = bytearray(self.PAGE_SIZE)
+            self.pages[pageAddress] = page
+        return (pageAddress, page)
+
+    def read(self, address, size):
+        data = bytearray()
+        while (size > 0):
+            (pageAddress, page) = self.__page(address)
+            offset = address - pageAddress
+            count = min(size, self.PAGE_SIZE - offset)
+            data.extend(page[offset:offset+count])
+            address = address + count
+            size = size - count
+        return str(data)
+
+    def write(self, address, data):
+        index = 0
+        while (index < len(data)):
+            (pageAddress, page) = self.__page(address)
+            offset = address - pageAddress
+            count = min(len(data) - index, self.PAGE_SIZE - offset)
+            page[offset:offset+count] = data[index:index+count]
+            address = address + count
+            index = index + count
+
+
+class Emulator(threading.Thread):
+    '''
+    SAM-BA monitor on the master side of a pseudo terminal
+    After 'G' command the emulator switches to the applet command loop,
+    CMD_EXIT returns to the monitor
+    '''
+    SOH = chr(0x01)
+    EOT = chr(0x04)
+    ACK = chr(0x06)
+    NAK = chr(0x15)
+    XMODEM_BLOCK_SIZE = 128
+
+    # Applet commands, see applets/src/cmd.h
+    CMD_PING            = 0x03
+    CMD_EXIT            = 0x04
+    CMD_CHECKSUM        = 0x05
+    CMD_READ_BLOCK      = 0x06
+    CMD_WRITE_BLOCK     = 0x07
+    CMD_FLASH_INIT      = 0x08
+    CMD_FLASH_WRITE     = 0x09
+    CMD_FLASH_STATUS    = 0x0A
+    CMD_DECOMPRESS      = 0x0B
+    CMD_SET_BAUDRATE    = 0x0C
+    CMD_MEMTEST         = 0x0D
+    CMD_FLASH_CHECKSUM  = 0x0E
+    SEQUENCE_FLAG       = 0x40
+
+    # DBGU of the applet, see cmd_set_baudrate()
+    MONITOR_BAUDRATE = 115200
+    MASTER_CLOCK = 47923200
+    BAUDRATE_CONFIRM_TIMEOUT = 0.5
+    # Probability of a corrupted byte above the highest reliable rate
+    UNRELIABLE_ERROR_RATE = 0.0005
+    # Linux ioctl which returns struct termios2 with the custom rates
+    TCGETS2 = 0x802C542A
+
+    # Emulated AT25DF321: JEDEC ID, size, page size, time to erase 64KB block and to program a page
+    FLASH_JEDEC_ID = 0x47011F
+    FLASH_SIZE = 4*1024*1024
+    FLASH_PAGE_SIZE = 256
+    FLASH_ERASE_BLOCK_SIZE = 64*1024
+    FLASH_ERASE_TIME = 0.1
+    FLASH_PAGE_TIME = 0.0005
+
+    def __init__(self, baudrate=115200, latency=0.0, trace=True, maxBaudrate=0):
+        super(Emulator, self).__init__()
+        self.daemon = True
+        (self.master, self.slave) = os.openpty()
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+        self.baudrate = baudrate
+        self.latency = latency
+        self.trace = trace
+        self.maxBaudrate = maxBaudrate
+        # Rate of the emulated DBGU, the previous rate and the deadline of the confirmation
+        self.lineRate = self.MONITOR_BAUDRATE
+        self.previousLineRate = self.MONITOR_BAUDRATE
+        self.baudrateDeadline = None
+        # termios speed constants of the pseudo terminal
+        self.termiosRates = dict([(getattr(termios, name), int(name[1:])) for name in dir(termios) if re.match("^B[0-9]+$", name)])
+        self.exitFlag = False
+        self.memory = Memory()
+        # Serial flash and the programming job: start time, duration, size
+        self.flash = Memory()
+        self.flashJob = None
+        self.appletRunning = False
+        self.firstCommand = True
+        self.commandLine = ""
+        self.rxBuffer = ""
+        # Data which arrived together with the last monitor command
+        self.pending = ""
+        # Address, size and CRC32 of CMD_WRITE_BLOCK, the raw data follows the command
+        self.blockWrite = None
+        # Sequence number of the command being handled
+        self.sequence = None
+        # Payload size of the commands, see CMD_EXP_SIZE() in applets/src/cmd.h
+        self.payloadSizes = {
+            self.CMD_PING : 0,
+            self.CMD_EXIT : 0,
+            self.CMD_CHECKSUM : 9,
+            self.CMD_READ_BLOCK : 8,
+            self.CMD_WRITE_BLOCK : 12,
+            self.CMD_FLASH_INIT : 0,
+            self.CMD_FLASH_WRITE : 12,
+            self.CMD_FLASH_STATUS : 0,
+            self.CMD_DECOMPRESS : 16,
+            self.CMD_SET_BAUDRATE : 4,
+            self.CMD_MEMTEST : 13,
+            self.CMD_FLASH_CHECKSUM : 9,
+        }
+        self.commands = {
+            self.CMD_PING : self.cmdPing,
+            self.CMD_EXIT : self.cmdExit,
+            self.CMD_CHECKSUM : self.cmdChecksum,
+            self.CMD_READ_BLOCK : self.cmdReadBlock,
+            self.CMD_WRITE_BLOCK : self.cmdWriteBlock,
+            self.CMD_FLASH_INIT : self.cmdFlashInit,
+            self.CMD_FLASH_WRITE : self.cmdFlashWrite,
+            self.CMD_FLASH_STATUS : self.cmdFlashStatus,
+            self.CMD_DECOMPRESS : self.cmdDecompress,
+            self.CMD_SET_BAUDRATE : self.cmdSetBaudrate,
+            self.CMD_MEMTEST : self.cmdMemtest,
+            self.CMD_FLASH_CHECKSUM : self.cmdFlashChecksum,
+        }
+        # Data lines of the memory stuck at 1, the memory tests report them
+        self.stuckBits = 0
+
+    def getDevice(self):
+        return self.device
+
+    def cancel(self):
+        self.exitFlag = True
+
+    def __pace(self, count):
+        '''
+        Spend the time the UART needs to shift count bytes: start bit, 8 bits, stop bit
+        '''
+        if (self.baudrate > 0):
+            # The applet can switch the line to a faster rate
+            time.sleep((count*10.0*self.MONITOR_BAUDRATE)/(self.baudrate*self.lineRate))
+
+    def hostRate(self):
+        '''
+        Rate the host configured for the slave side of the pseudo terminal
+        '''
+        speed = termios.tcgetattr(self.slave)[5]
+        if (speed in self.termiosRates):
+            return self.termiosRates[speed]
+        # Custom rate, c_ospeed of struct termios2
+        buffer = array.array('i', [0]*64)
+        fcntl.ioctl(self.slave, self.TCGETS2, buffer)
+        return buffer[10]
+
+    def lineNoise(self, data):
+        '''
+        Characters are garbage if the host and the emulator use different rates, 
+        above the highest reliable rate some characters are corrupted
+        '''
+        hostRate = self.hostRate()
+        if (abs(hostRate - self.lineRate)*50 > hostRate):
+            return chr(0xFF)*len(data)
+        if ((self.maxBaudrate > 0) and (self.lineRate > self.maxBaudrate)):
+            data = bytearray(data)
+            for i in range(len(data)):
+                if (random.random() < self.UNRELIABLE_ERROR_RATE):
+                    data[i] = data[i] ^ 0x10
+            data = str(data)
+        return data
+
+    def send(self, data):
+        self.__pace(len(data))
+        os.write(self.master, self.lineNoise(data))
+
+    def receive(self, size, timeout=1.0):
+        '''
+        Read up to size bytes, wait not more than timeout
+        '''
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        deadline = time.time() + timeout
+        while ((len(data) < size) and (not self.exitFlag)):
+            remaining = deadline - time.time()
+            if (remaining <= 0):
+                break
+            (ready, _, _) = select.select([self.master], [], [], min(remaining, 0.1))
+            if (ready):
+                d = os.read(self.master, size - len(data))
+                self.__pace(len(d))
+                data = data + self.lineNoise(d)
+        return data
+
+    def receiveAvailable(self, timeout):
+        '''
+        Read whatever arrived, wait not more than timeout for the first byte
+        '''
+        data = ""
+        (ready, _, _) = select.select([self.master], [], [], timeout)
+        if (ready):
+            data = os.read(self.master, 4096)
+            self.__pace(len(data))
+        return self.lineNoise(data)
+
+    def run(self):
+        while (not self.exitFlag):
+            self.pending = self.pending + self.receiveAvailable(0.1)
+            self.checkBaudrateDeadline()
+            while ((len(self.pending) > 0) and (not self.exitFlag)):
+                if (self.appletRunning):
+                    self.rxBuffer = self.rxBuffer + self.pending
+                    self.pending = ""
+                    self.processCommand()
+                else:
+                    c = self.pending[0]
+                    self.pending = self.pending[1:]
+                    self.commandLine = self.commandLine + c
+                    if (c == '#'):
+                        line = self.commandLine
+                        self.commandLine = ""
+                        self.processMonitorCommand(line)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def processMonitorCommand(self, line):
+        '''
+        SAM-BA monitor command: letter, optional arguments separated by comma, '#'
+        '''
+        command = line[0]
+        args = []
+        try:
+            for arg in line[1:-1].split(','):
+                if (arg != ""):
+                    args.append(int(arg, 16))
+        except ValueError:
+            # The monitor ignores malformed commands
+            return
+
+        if (self.latency > 0):
+            time.sleep(self.latency)
+
+        try:
+            self.executeMonitorCommand(command, args)
+        except IndexError:
+            pass
+
+    def executeMonitorCommand(self, command, args):
+        if (command == 'N'):
+            self.send("\n\r")
+        elif (command == 'T'):
+            self.send("\n\r>")
+        elif (command == 'V'):
+            self.send("v1.0 emulator\n\r")
+        elif (command == 'O'):
+            self.memory.write(args[0], chr(args[1] & 0xFF))
+        elif (command == 'H'):
+            self.memory.write(args[0], struct.pack("<H", args[1] & 0xFFFF))
+        elif (command == 'W'):
+            self.memory.write(args[0], struct.pack("<I", args[1] & 0xFFFFFFFF))
+        elif (command == 'o'):
+            self.send(self.memory.read(args[0], 1))
+        elif (command == 'h'):
+            self.send(self.memory.read(args[0], 2))
+        elif (command == 'w'):
+            self.send(self.memory.read(args[0], 4))
+        elif (command == 'R'):
+            self.xmodemSend(self.memory.read(args[0], args[1]))
+        elif (command == 'S'):
+            data = self.xmodemReceive()
+            if (data != None):
+                self.memory.write(args[0], data[:args[1]])
+        elif (command == 'G'):
+            self.startApplet()
+
+    def xmodemBlock(self, blockNumber, data):
+        data = data.ljust(self.XMODEM_BLOCK_SIZE, chr(0))
+        crc = binascii.crc_hqx(data, 0)
+        blockNumber = blockNumber & 0xFF
+        return self.SOH + chr(blockNumber) + chr(0xFF - blockNumber) + data + chr(crc >> 8) + chr(crc & 0xFF)
+
+    def xmodemSend(self, data):
+        '''
+        Send data to the host, the host starts the transfer with 'C'
+        '''
+        if (self.receive(1) != 'C'):
+            return
+        blockNumber = 1
+        index = 0
+        while (index < len(data)):
+            self.send(self.xmodemBlock(blockNumber, data[index:index+self.XMODEM_BLOCK_SIZE]))
+            c = self.receive(1)
+            if (c == self.ACK):
+                blockNumber = blockNumber + 1
+                index = index + self.XMODEM_BLOCK_SIZE
+            elif (c != self.NAK):
+                return
+        self.send(self.EOT)
+        self.receive(1)
+
+    def xmodemReceive(self):
+        '''
+        Receive data from the host, ask for CRC16 mode with 'C'
+        '''
+        self.send('C')
+        data = ""
+        expectedBlock = 1
+        while (True):
+            c = self.receive(1)
+            if (c == self.EOT):
+                self.send(self.ACK)
+                return data
+            if (c != self.SOH):
+                return None
+            block = self.receive(self.XMODEM_BLOCK_SIZE + 4)
+            payload = block[2:2+self.XMODEM_BLOCK_SIZE]
+            crc = (ord(block[-2]) << 8) | ord(block[-1])
+            if ((len(block) != self.XMODEM_BLOCK_SIZE + 4) or (binascii.crc_hqx(payload, 0) != crc)):
+                self.send(self.NAK)
+                continue
+            if (ord(block[0]) == (expectedBlock & 0xFF)):
+                data = data + payload
+                expectedBlock = expectedBlock + 1
+            self.send(self.ACK)
+
+    def debugOutput(self, s):
+        '''
+        Emulate TRACE_DEBUG of the applet
+        '''
+        if (self.trace):
+            self.send(s)
+
+    def startApplet(self):
+        self.appletRunning = True
+        self.firstCommand = True
+        self.rxBuffer = ""
+        self.debugOutput("Main loop")
+
+    def calculateChecksum(self, data):
+        s = 0
+        for c in data:
+            s = (s + ord(c)) & 0xFF
+        return ((~s) + 1) & 0xFF
+
+    def processCommand(self):
+        '''
+        Same state machine as process_command() in applets/src/cmd.c
+        The frame is command id, payload size + 1, payload, checksum
+        '''
+        while ((self.blockWrite != None) or (len(self.rxBuffer) > 2)):
+            if (self.blockWrite != None):
+                if (not self.receiveBlock()):
+                    break
+                continue
+            commandId = ord(self.rxBuffer[0]) & ~self.SEQUENCE_FLAG
+            if (not commandId in self.commands):
+                self.rxBuffer = self.rxBuffer[1:]
+                continue
+            size = ord(self.rxBuffer[1]) + 2
+            sequenceSize = 1 if (ord(self.rxBuffer[0]) & self.SEQUENCE_FLAG) else 0
+            if (size != self.payloadSizes[commandId] + sequenceSize + 3):
+                self.rxBuffer = self.rxBuffer[1:]
+                continue
+            if (len(self.rxBuffer) < size):
+                break
+            frame = self.rxBuffer[:size]
+            if (self.calculateChecksum(frame[:-1]) != ord(frame[-1])):
+                self.rxBuffer = self.rxBuffer[1:]
+                continue
+            self.rxBuffer = self.rxBuffer[size:]
+            # A valid command arrived at the new rate
+            self.baudrateDeadline = None
+            if (self.latency > 0):
+                time.sleep(self.latency)
+            payload = frame[2:-1]
+            self.sequence = None
+            if (ord(frame[0]) & self.SEQUENCE_FLAG):
+                (self.sequence, payload) = (payload[0], payload[1:])
+            self.commands[commandId](commandId, payload)
+
+    def receiveBlock(self):
+        '''
+        Same as cmd_write_block_done(): check CRC32 when all data is in the memory
+        Returns False if more data is expected
+        '''
+        (address, size, crc, self.sequence) = self.blockWrite
+        if (len(self.rxBuffer) < size):
+            return False
+        self.blockWrite = None
+        self.memory.write(address, self.rxBuffer[:size])
+        self.rxBuffer = self.rxBuffer[size:]
+        crcMemory = binascii.crc32(self.memory.read(address, size)) & 0xFFFFFFFF
+        status = 0 if (crcMemory == crc) else 1
+        self.sendResponse(self.CMD_WRITE_BLOCK, struct.pack("<BI", status, crcMemory))
+        return True
+
+    def sendResponse(self, commandId, payload):
+        '''
+        Same as cmd_send_slave(): MSB of the command id is set in all responses but the first
+        '''
+        if (not self.firstCommand):
+            commandId = commandId | 0x80
+        self.firstCommand = False
+        if (self.sequence != None):
+            commandId = commandId | self.SEQUENCE_FLAG
+            payload = self.sequence + payload
+        frame = chr(commandId) + chr(len(payload) + 1) + payload
+        self.send(frame + chr(self.calculateChecksum(frame)))
+
+    def cmdPing(self, commandId, payload):
+        self.debugOutput("PING")
+        self.sendResponse(commandId, payload)
+
+    def cmdExit(self, commandId, payload):
+        self.debugOutput("EXIT")
+        self.sendResponse(commandId, payload)
+        self.appletRunning = False
+        self.commandLine = ""
+        self.lineRate = self.MONITOR_BAUDRATE
+        self.baudrateDeadline = None
+
+    def cmdSetBaudrate(self, commandId, payload):
+        '''
+        Same as cmd_set_baudrate(): the response is sent at the current rate
+        '''
+        (rate,) = struct.unpack("<I", payload)
+        divisor = ((self.MASTER_CLOCK + 8*rate)/(16*rate)) if (rate > 0) else 0
+        actual = (self.MASTER_CLOCK/(16*divisor)) if (divisor > 0) else 0
+        status = 0 if ((divisor > 0) and (abs(actual - rate)*50 <= rate)) else 1
+        self.sendResponse(commandId, struct.pack("<BI", status, actual))
+        if (status == 0):
+            self.previousLineRate = self.lineRate
+            self.lineRate = actual
+            self.baudrateDeadline = time.time() + self.BAUDRATE_CONFIRM_TIMEOUT
+
+    def checkBaudrateDeadline(self):
+        '''
+        Same as cmd_baudrate_poll(): return to the previous rate if the host did not confirm the new one
+        '''
+        if ((self.baudrateDeadline != None) and (time.time() > self.baudrateDeadline)):
+            self.baudrateDeadline = None
+            self.lineRate = self.previousLineRate
+            self.rxBuffer = ""
+
+    def cmdChecksum(self, commandId, payload):
+        (address, blockSize, blocks) = struct.unpack("<IIB", payload)
+        crcs = []
+        for i in range(blocks):
+            crc = binascii.crc32(self.memory.read(address + i*blockSize, blockSize)) & 0xFFFFFFFF
+            crcs.append(struct.pack("<I", crc))
+        self.sendResponse(commandId, "".join(crcs))
+
+    def cmdReadBlock(self, commandId, payload):
+        (address, size) = struct.unpack("<II", payload)
+        data = self.memory.read(address, size)
+        self.sendResponse(commandId, struct.pack("<II", size, binascii.crc32(data) & 0xFFFFFFFF))
+        self.send(data)
+
+    def cmdFlashInit(self, commandId, payload):
+        self.flashJob = None
+        self.sendResponse(commandId, struct.pack("<BIIII", 0, self.FLASH_JEDEC_ID, self.FLASH_SIZE, self.FLASH_PAGE_SIZE, self.FLASH_ERASE_BLOCK_SIZE))
+
+    def flashJobDone(self):
+        if (self.flashJob == None):
+            return True
+        (startTime, duration, size) = self.flashJob
+        return (time.time() >= startTime + duration)
+
+    def cmdFlashWrite(self, commandId, payload):
+        '''
+        The data is programmed immediately, the job looks busy for the time the flash needs
+        '''
+        (flashAddress, bufferAddress, size) = struct.unpack("<III", payload)
+        if (not self.flashJobDone()):
+            self.sendResponse(commandId, chr(2))
+            return
+        if (flashAddress + size > self.FLASH_SIZE):
+            self.sendResponse(commandId, chr(4))
+            return
+        blocks = len(range(flashAddress - (flashAddress % self.FLASH_ERASE_BLOCK_SIZE), flashAddress + size, self.FLASH_ERASE_BLOCK_SIZE))
+        pages = (size + self.FLASH_PAGE_SIZE - 1) / self.FLASH_PAGE_SIZE
+        self.flash.write(flashAddress, self.memory.read(bufferAddress, size))
+        self.flashJob = (time.time(), blocks*self.FLASH_ERASE_TIME + pages*self.FLASH_PAGE_TIME, size)
+        self.sendResponse(commandId, chr(0))
+
+    def cmdFlashStatus(self, commandId, payload):
+        if (self.flashJobDone()):
+            (state, done) = (0, self.flashJob[2] if (self.flashJob != None) else 0)
+        else:
+            (startTime, duration, size) = self.flashJob
+            (state, done) = (1, int(size*(time.time() - startTime)/duration))
+        self.sendResponse(commandId, struct.pack("<BBI", state, 0, done))
+
+    def cmdFlashChecksum(self, commandId, payload):
+        (flashAddress, blockSize, blocks) = struct.unpack("<IIB", payload)
+        if (not self.flashJobDone()):
+            self.sendResponse(commandId, chr(2))
+            return
+        if (flashAddress + blockSize*blocks > self.FLASH_SIZE):
+            self.sendResponse(commandId, chr(4))
+            return
+        crcs = []
+        for i in range(blocks):
+            crc = binascii.crc32(self.flash.read(flashAddress + i*blockSize, blockSize)) & 0xFFFFFFFF
+            crcs.append(struct.pack("<I", crc))
+        self.sendResponse(commandId, chr(0) + "".join(crcs))
+
+    def lz4Length(self, buffer, index, length):
+        '''
+        Returns tuple (length, index of the next byte)
+        '''
+        if (length == 15):
+            while (True):
+                length = length + buffer[index]
+                index = index + 1
+                if (buffer[index-1] != 255):
+                    break
+        return (length, index)
+
+    def cmdDecompress(self, commandId, payload):
+        '''
+        Same as lz4_decompress() of the applet: the source can overlap the end of the 
+        destination, the decoder works in the same buffer
+        '''
+        (src, srcSize, dst, dstSize) = struct.unpack("<IIII", payload)
+        end = max(dst + dstSize, src + srcSize)
+        buffer = bytearray(self.memory.read(dst, end - dst))
+        (index, srcEnd, out) = (src - dst, src - dst + srcSize, 0)
+        try:
+            while (index < srcEnd):
+                token = buffer[index]
+                (length, index) = self.lz4Length(buffer, index + 1, token >> 4)
+                buffer[out:out+length] = buffer[index:index+length]
+                (out, index) = (out + length, index + length)
+                if (index >= srcEnd):
+                    break
+                offset = buffer[index] | (buffer[index+1] << 8)
+                (length, index) = self.lz4Length(buffer, index + 2, token & 0x0F)
+                length = length + 4
+                if ((offset == 0) or (offset > out)):
+                    raise IndexError
+                # The match can overlap the output
+                pattern = buffer[out-offset:out]
+                buffer[out:out+length] = (pattern*(length/offset + 1))[:length]
+                out = out + length
+            status = 0 if (out <= dstSize) else 1
+        except IndexError:
+            status = 1
+        if (status == 0):
+            self.memory.write(dst, buffer[:out])
+            self.sendResponse(commandId, struct.pack("<BII", 0, out, binascii.crc32(str(buffer[:out])) & 0xFFFFFFFF))
+        else:
+            self.sendResponse(commandId, struct.pack("<BII", 1, 0, 0))
+
+    def memtestVerify(self, address, expected):
+        '''
+        Returns tuple (errors, first error address, expected, actual, failed bits)
+        '''
+        words = array.array('I', self.memory.read(address, 4*len(expected)))
+        errors = [(i, expected[i], words[i] | self.stuckBits) for i in range(len(words)) if ((words[i] | self.stuckBits) != expected[i])]
+        if (len(errors) == 0):
+            return (0, 0, 0, 0, 0)
+        (index, value, actual) = errors[0]
+        bits = reduce(lambda x, y: x | y, [e ^ a for (_, e, a) in errors])
+        return (len(errors), address + 4*index, value, actual, bits)
+
+    def cmdMemtest(self, commandId, payload):
+        '''
+        Same tests as memtest_run() of the applet, the address bus is always good
+        '''
+        (test, address, size, pattern) = struct.unpack("<BIII", payload)
+        if ((test > 4) or (address % 4 != 0) or (size % 4 != 0) or (size == 0)):
+            self.sendResponse(commandId, struct.pack("<BIIIII", 2, 0, 0, 0, 0, 0))
+            return
+        words = size/4
+        result = (0, 0, 0, 0, 0)
+        if (test == 0):
+            self.memory.write(address, (array.array('I', [pattern])*words).tostring())
+        elif (test == 1):
+            result = self.memtestVerify(address, array.array('I', [pattern])*words)
+        elif (test == 2):
+            bits = [1 << bit for bit in range(32)]
+            patterns = [p for bit in bits for p in (bit, ~bit & 0xFFFFFFFF)]
+            errors = [(p, p | self.stuckBits) for p in patterns if ((p | self.stuckBits) != p)]
+            if (len(errors) > 0):
+                result = (len(errors), address, errors[0][0], errors[0][1], self.stuckBits)
+        elif (test == 4):
+            for invert in [0, 0xFFFFFFFF]:
+                expected = array.array('I', [((address + 4*i) ^ pattern ^ invert) for i in range(words)])
+                self.memory.write(address, expected.tostring())
+                verify = self.memtestVerify(address, expected)
+                if (result[0] == 0):
+                    result = verify
+                else:
+                    result = (result[0] + verify[0],) + result[1:4] + (result[4] | verify[4],)
+        self.sendResponse(commandId, struct.pack("<BIIIII", 0 if (result[0] == 0) else 1, *result))
+
+    def cmdWriteBlock(self, commandId, payload):
+        self.blockWrite = struct.unpack("<III", payload) + (self.sequence,)
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    arguments = docopt(__doc__, version='AT91 emulator 0.1')
+
+    emulator = Emulator(int(arguments['--baudrate']), float(arguments['--latency']), not arguments['--notrace'], int(arguments['--max-baudrate']))
+    emulator.start()
+    print "Emulator is running on {0}".format(emulator.getDevice())
+    try:
+        while (emulator.isAlive()):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        emulator.cancel()
@@ -5,21 +5,49 @@
 Usage:
   at91_loader.py -h | --help
   at91_loader.py --version
-  at91_loader.py [--device=<STR>] -i | --interactive  
-  at91_loader.py run [--device=<STR>] [--filename=<STR>] [--address=<HEX>] [--interactive]  
-  at91_loader.py dump [--device=<STR>] --address=<HEX> [--size=<INT>]  [--interactive] 
-  at91_loader.py read [--device=<STR>] --address=<HEX> [--interactive]
-  at91_loader.py write [--device=<STR>] --address=<HEX> --data=<HEX> [--interactive]
+  at91_loader.py [--device=<STR>] (-i | --interactive) [--cache] [--trace=<STR>] [--trace-size=<INT>] [--stats=<STR>] [--stats-interval=<FLOAT>]
+  at91_loader.py run [--device=<STR>] [--filename=<STR>] [--address=<HEX>] [--diff] [--compress] [--verify] [--jobs=<INT>] [--logdir=<STR>] [--trace=<STR>] [--trace-size=<INT>] [--interactive] [--stats=<STR>] [--stats-interval=<FLOAT>]
+  at91_loader.py dump [--device=<STR>] --address=<HEX> [--size=<INT>] [--word=<INT>] [--big-endian] [--output=<STR>] [--resume] [--jobs=<INT>] [--logdir=<STR>] [--trace=<STR>] [--trace-size=<INT>] [--interactive] [--stats=<STR>] [--stats-interval=<FLOAT>]
+  at91_loader.py flash [--device=<STR>] [--filename=<STR>] [--address=<HEX>] --image=<STR> [--flash-address=<HEX>] [--compress] [--verify] [--baudrate=<INT>] [--jobs=<INT>] [--logdir=<STR>] [--trace=<STR>] [--trace-size=<INT>] [--interactive] [--stats=<STR>] [--stats-interval=<FLOAT>]
+  at91_loader.py baudrate [--device=<STR>] [--filename=<STR>] [--address=<HEX>] [--baudrate=<INT>] [--jobs=<INT>] [--logdir=<STR>] [--trace=<STR>] [--trace-size=<INT>] [--stats=<STR>] [--stats-interval=<FLOAT>]
+  at91_loader.py memtest [--device=<STR>] [--filename=<STR>] [--address=<HEX>] --memory=<HEX> --size=<INT> [--test=<STR>] [--pattern=<HEX>] [--jobs=<INT>] [--logdir=<STR>] [--trace=<STR>] [--trace-size=<INT>] [--interactive] [--stats=<STR>] [--stats-interval=<FLOAT>]
+  at91_loader.py fill [--device=<STR>] [--filename=<STR>] [--address=<HEX>] --memory=<HEX> --size=<INT> --pattern=<HEX> [--jobs=<INT>] [--logdir=<STR>] [--trace=<STR>] [--trace-size=<INT>] [--interactive] [--stats=<STR>] [--stats-interval=<FLOAT>]
+  at91_loader.py script [--device=<STR>] --script=<STR> [--cache] [--jobs=<INT>] [--logdir=<STR>] [--trace=<STR>] [--trace-size=<INT>] [--interactive] [--stats=<STR>] [--stats-interval=<FLOAT>]
+  at91_loader.py daemon [--device=<STR>] [--socket=<STR>] [--cache] [--trace=<STR>] [--trace-size=<INT>] [--stats=<STR>] [--stats-interval=<FLOAT>]
+  at91_loader.py read [--device=<STR>] --address=<HEX> [--jobs=<INT>] [--logdir=<STR>] [--trace=<STR>] [--trace-size=<INT>] [--interactive] [--stats=<STR>] [--stats-interval=<FLOAT>]
+  at91_loader.py write [--device=<STR>] --address=<HEX> --data=<HEX> [--jobs=<INT>] [--logdir=<STR>] [--trace=<STR>] [--trace-size=<INT>] [--interactive] [--stats=<STR>] [--stats-interval=<FLOAT>]
 
 Options:
   -h --help            Show this screen.
   --version            Show version.
-  -d --device=<STR>    Serial device [default: /dev/ttyUSB0]
+  -d --device=<STR>    Serial device, glob or comma separated list of devices [default: /dev/ttyUSB0]
+  -j --jobs=<INT>      Number of devices served in parallel [default: 16]
+  --logdir=<STR>       Directory for logs and dumps of every device if there are many [default: .]
   -a --address=<HEX>   Address where dump memory starts or code is loaded [default: 308000]
-  -f --filename=<STR>  BIN file for execution [default: ./applets/mk/firmware.bin]
-  -s --size=<INT>      Size of the dump [default: 256]
+  -f --filename=<STR>  BIN or ELF file for execution [default: ./applets/mk/firmware.bin]
+  --diff               Upload only blocks which differ from the memory of the target
+  --compress           The running applet receives LZ4 compressed data and decompresses it
+  --verify             Compare CRC32 of the loaded memory with the image, the applet calculates CRC32
+  --baudrate=<INT>     Line rate after the applet starts, the baudrate command probes the rates if not set
+  --image=<STR>        BIN file to program to the serial flash
+  --flash-address=<HEX>  Address in the serial flash [default: 0]
+  -s --size=<INT>      Size of the dump or of the tested memory [default: 256]
+  --memory=<HEX>       Start of the memory range the applet fills or tests
+  --test=<STR>         Comma separated tests: data, address, pattern, fill, verify [default: data,address,pattern]
+  --pattern=<HEX>      Pattern of the memory fill and of the tests [default: 55AA55AA]
+  -w --word=<INT>      Show the dump as 1, 2 or 4 bytes words [default: 1]
+  --big-endian         Words of the dump are big endian
+  -o --output=<STR>    Write the dump to the binary file, with many devices {device} in the name is replaced by the device
+  --resume             Continue the dump from the end of the output file
   --data=<HEX>         Data to write  
+  --socket=<STR>       Unix socket of the daemon, see at91_client.py [default: /tmp/at91_loader.sock]
+  --script=<STR>       File of the interactive commands, consecutive write, read and dump commands are sent in one transaction
   -i --interactive     Interactive mode
+  --cache              Cache the memory pages read by the interactive dump and read commands
+  --trace=<STR>        Record the serial traffic to the file, if there are many devices every device gets a trace in the logdir
+  --trace-size=<INT>   Size of the trace file, the oldest records are overwritten [default: 16777216]
+  --stats=<STR>        Write the statistics to the file, Prometheus text format if the name ends with .prom, JSON otherwise
+  --stats-interval=<FLOAT>  Period of the statistics export in seconds [default: 10]
 """
 
 import cmd
@@ -32,13 +60,27 @@ import subprocess
 import serial, random, time
 
 import sys, traceback
+import binascii
+import struct
+import array
+import glob
+import Queue
 import os
 import re
+import json
+import bisect
+import collections
+import SocketServer
+import socket
+import StringIO
+import signal
 
 
 
 NamedListener = namedtuple("NamedListener", ['name', 'callback'])
 
+logger = logging.getLogger('at91_loader')
+
 
 def convertToInt(s, base):
     value = None;
@@ -78,8 +120,8 @@ def openFile(filename, flag):
     
 
 def buildhexstring(value, width=0, prefix=''):
-    valueStr = hex(value)
-    valueStr = valueStr.lstrip("0x")
+    # lstrip("0x") would remove all digits of zero
+    valueStr = hex(value)[2:]
     valueStr = valueStr.rstrip("L")
     valueStr = valueStr.upper();
     if (width > 0):
@@ -98,9 +140,87 @@ class StatManager:
     '''
     A single place where references to all blocks off debug counters is stored
     '''
+    # Upper bounds of the latency buckets in seconds, 100us to 13s, the last bucket is not bounded
+    HISTOGRAM_BOUNDS = [0.0001*(2**i) for i in range(18)]
+    # Throughput is the number of bytes in the last THROUGHPUT_WINDOW seconds
+    THROUGHPUT_WINDOW = 10.0
+    THROUGHPUT_SLOT = 0.1
+
     def __init__(self):
         self.groups = {}
 
+    class Histogram:
+        '''
+        Number of samples in every bucket, sum and maximum of the samples
+        '''
+        def __init__(self, bounds):
+            self.bounds = bounds
+            self.buckets = [0]*(len(bounds) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.max = 0.0
+
+        def add(self, value):
+            self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+            self.count = self.count + 1
+            self.sum = self.sum + value
+            self.max = max(self.max, value)
+
+        def percentile(self, percent):
+            '''
+            Upper bound of the bucket where the percentile falls, the maximum for the last bucket
+            '''
+            threshold = self.count*percent/100.0
+            total = 0
+            for (index, count) in enumerate(self.buckets):
+                total = total + count
+                if ((total >= threshold) and (total > 0)):
+                    return min(self.bounds[index], self.max) if (index < len(self.bounds)) else self.max
+            return 0.0
+
+        def toDict(self):
+            average = (self.sum/self.count) if (self.count > 0) else 0.0
+            return {"count" : self.count, "sum" : self.sum, "max" : self.max, "average" : average,
+                    "p50" : self.percentile(50), "p90" : self.percentile(90), "p99" : self.percentile(99),
+                    "bounds" : self.bounds, "buckets" : self.buckets}
+
+    class Throughput:
+        '''
+        Total number of bytes and the rate in the sliding window
+        '''
+        def __init__(self, window, slot):
+            self.window = window
+            self.slot = slot
+            self.startTime = time.time()
+            self.total = 0
+            # Bytes in every time slot of the window: (slot, bytes)
+            self.slots = collections.deque()
+
+        def add(self, count):
+            self.total = self.total + count
+            slot = int(time.time()/self.slot)
+            if ((len(self.slots) > 0) and (self.slots[-1][0] == slot)):
+                self.slots[-1] = (slot, self.slots[-1][1] + count)
+            else:
+                self.slots.append((slot, count))
+            self.__expire()
+
+        def __expire(self):
+            oldest = int((time.time() - self.window)/self.slot)
+            while ((len(self.slots) > 0) and (self.slots[0][0] < oldest)):
+                self.slots.popleft()
+
+        def rate(self):
+            '''
+            Bytes/s in the window, the window is shorter during the first seconds
+            '''
+            self.__expire()
+            period = min(self.window, max(time.time() - self.startTime, self.slot))
+            return sum([count for (_, count) in self.slots])/period
+
+        def toDict(self):
+            return {"bytes" : self.total, "rate" : self.rate()}
+
     class Block:
         def __init__(self, name):
             '''
@@ -109,6 +229,9 @@ class StatManager:
             For example "eth0", "eth1"
             '''
             self.name = name
+            # Latency of the operations and the bytes counters, see addLatency() and addBytes()
+            self.histograms = {}
+            self.throughputs = {}
             self.ignoreFields = []
             
             #  All fields added so far are in the ignore list
@@ -136,6 +259,39 @@ class StatManager:
             '''
             for f in fields:
                 self.addField((f, 0))
+
+        def addHistograms(self, names):
+            '''
+            @param names list of operations, for example "read"
+            '''
+            for name in names:
+                self.histograms[name] = StatManager.Histogram(StatManager.HISTOGRAM_BOUNDS)
+
+        def addLatency(self, name, seconds):
+            '''
+            Add a sample to the histogram, the histogram is created on the first sample
+            '''
+            histogram = self.histograms.get(name, None)
+            if (histogram == None):
+                histogram = StatManager.Histogram(StatManager.HISTOGRAM_BOUNDS)
+                self.histograms[name] = histogram
+            histogram.add(seconds)
+
+        def addThroughputs(self, names):
+            '''
+            @param names list of directions, for example "rx"
+            '''
+            for name in names:
+                self.throughputs[name] = StatManager.Throughput(StatManager.THROUGHPUT_WINDOW, StatManager.THROUGHPUT_SLOT)
+
+        def addBytes(self, name, count):
+            self.throughputs[name].add(count)
+
+        def toDict(self):
+            counters = dict([(f, v) for (f, v) in self.__dict__.items() if ((not f in self.ignoreFields) and isinstance(v, (int, long, float)))])
+            histograms = dict([(n, h.toDict()) for (n, h) in self.histograms.items()])
+            throughputs = dict([(n, t.toDict()) for (n, t) in self.throughputs.items()])
+            return {"name" : self.name, "counters" : counters, "latency" : histograms, "throughput" : throughputs}
             
     def addCounters(self, groupName, block):
         '''
@@ -190,6 +346,29 @@ class StatManager:
                     print fieldPattern.format(counter.__dict__[fieldName]),
             print    
         
+    def printLatency(self, groupName):
+        '''
+        Print latency (ms) and throughput of the blocks in the group which have samples
+        '''
+        fieldPattern = "{:>14}"
+        lines = []
+        for block in self.groups[groupName]:
+            for (name, histogram) in sorted(block.histograms.items()):
+                if (histogram.count == 0):
+                    continue
+                values = [block.name, name, histogram.count, 1000*histogram.sum/histogram.count, 1000*histogram.percentile(50), 
+                          1000*histogram.percentile(99), 1000*histogram.max, ""]
+                lines.append(values)
+            for (name, throughput) in sorted(block.throughputs.items()):
+                if (throughput.total > 0):
+                    lines.append([block.name, name, "", "", "", "", "", "{0:.0f}/{1}".format(throughput.rate(), throughput.total)])
+        if (len(lines) == 0):
+            return
+        print " ".join([fieldPattern.format(f) for f in [groupName, "operation", "count", "avg ms", "p50 ms", "p99 ms", "max ms", "bytes/s/total"]])
+        for values in lines:
+            print " ".join([fieldPattern.format(("{0:.2f}".format(v)) if isinstance(v, float) else v) for v in values])
+        print
+
     def printAll(self):
         '''
         Print counters from all registered groups
@@ -197,6 +376,96 @@ class StatManager:
         for groupName in self.groups:
             self.printGroup(groupName)
             print
+        for groupName in self.groups:
+            self.printLatency(groupName)
+
+    def toDict(self):
+        groups = dict([(groupName, [block.toDict() for block in blocks]) for (groupName, blocks) in self.groups.items()])
+        return {"time" : time.time(), "groups" : groups}
+
+    def __metricName(self, *names):
+        return re.sub("[^a-zA-Z0-9_]", "_", "_".join(("at91",) + names))
+
+    def __labels(self, block, extra=""):
+        name = block.name.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        return "{{block=\"{0}\"{1}}}".format(name, extra)
+
+    def toPrometheus(self):
+        '''
+        Prometheus text exposition format: counters, latency histograms, bytes and bytes/s
+        '''
+        # Metric name -> (type, lines), the samples of a metric are together
+        metrics = collections.OrderedDict()
+        def addSample(name, metricType, line):
+            if (not name in metrics):
+                metrics[name] = (metricType, [])
+            metrics[name][1].append(line)
+
+        for (groupName, blocks) in sorted(self.groups.items()):
+            group = groupName.lower()
+            for block in blocks:
+                for (field, value) in sorted(block.toDict()["counters"].items()):
+                    name = self.__metricName(group, field)
+                    addSample(name, "untyped", "{0}{1} {2}".format(name, self.__labels(block), value))
+                for (operation, histogram) in sorted(block.histograms.items()):
+                    name = self.__metricName(group, operation, "seconds")
+                    total = 0
+                    for (bound, count) in zip(histogram.bounds + ["+Inf"], histogram.buckets):
+                        total = total + count
+                        addSample(name, "histogram", "{0}_bucket{1} {2}".format(name, self.__labels(block, ",le=\"{0}\"".format(bound)), total))
+                    addSample(name, "histogram", "{0}_sum{1} {2}".format(name, self.__labels(block), histogram.sum))
+                    addSample(name, "histogram", "{0}_count{1} {2}".format(name, self.__labels(block), histogram.count))
+                for (direction, throughput) in sorted(block.throughputs.items()):
+                    name = self.__metricName(group, direction, "bytes_total")
+                    addSample(name, "counter", "{0}{1} {2}".format(name, self.__labels(block), throughput.total))
+                    name = self.__metricName(group, direction, "bytes_per_second")
+                    addSample(name, "gauge", "{0}{1} {2}".format(name, self.__labels(block), throughput.rate()))
+
+        lines = []
+        for (name, (metricType, samples)) in metrics.items():
+            lines.append("# TYPE {0} {1}".format(name, metricType))
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def export(self, filename):
+        '''
+        Write the statistics to the file, Prometheus text format if the name ends with .prom, 
+        JSON otherwise. The file is replaced atomically
+        '''
+        if (filename.endswith(".prom")):
+            text = self.toPrometheus()
+        else:
+            text = json.dumps(self.toDict(), indent=1, sort_keys=True)
+        result = False
+        try:
+            f = open(filename + ".tmp", "w")
+            f.write(text)
+            f.close()
+            os.rename(filename + ".tmp", filename)
+            result = True
+        except (IOError, OSError):
+            logger.error("Failed to write statistics to {0}".format(filename))
+        return result
+
+class StatExporter(threading.Thread):
+    '''
+    Export the statistics periodically, the last export is done by cancel()
+    '''
+    def __init__(self, statManager, filename, interval):
+        super(StatExporter, self).__init__()
+        self.daemon = True
+        self.statManager = statManager
+        self.filename = filename
+        self.interval = interval
+        self.exitEvent = threading.Event()
+
+    def run(self):
+        while (not self.exitEvent.wait(self.interval)):
+            self.statManager.export(self.filename)
+
+    def cancel(self):
+        self.exitEvent.set()
+        self.statManager.export(self.filename)
             
 
 statManager = StatManager()
@@ -258,11 +527,14 @@ class cmdGroundLevel(cmd.Cmd):
         self.cmdLoop = CmdLoop(at91)
 
         (self.dumpAddressStr, self.dumpSizeStr) = ('0x308000', '256')
+        (self.dumpWordSize, self.dumpBigEndian) = (1, False)
         (self.runFilename, self.runAddressStr) = ('./applets/mk/firmware.bin', '308000')
         (self.writeAddressStr, self.writeValueStr) = ('0x308000', '11AE3255')
         self.readAddressStr = '0x308000'
         (self.flashAppletFilename, self.flashRunAddressStr, self.flashImage, self.flashAddressStr) = ('./applets/mk/firmware.bin', '0x308000', 'sama5d3xek-nandflashboot-uboot-3.6.0.bin', "0")
         (self.cmdCommand, self.cmdPayload) = "0x03", ""
+        # After run the output is logged until there is no output for this long
+        self.runOutputTimeout = 1.0
     
     
     def emptyline(self):
@@ -334,78 +606,197 @@ class cmdGroundLevel(cmd.Cmd):
     
     def do_dump(self, line):
         words = line.split()
-        if (len(words) == 2):
-            result = printDump(self.at91, words[0], words[1])
+        if ((len(words) == 3) or ((len(words) == 4) and (words[3] == "resume"))):
+            result = dumpToFile(self.at91, words[0], words[1], words[2], (len(words) == 4))
+            if (result):
+                (self.dumpAddressStr, self.dumpSizeStr) = (words[0], words[1])
+        elif (len(words) == 2):
+            result = printDump(self.at91, words[0], words[1], self.dumpWordSize, self.dumpBigEndian)
             if (result):
                 (self.dumpAddressStr, self.dumpSizeStr) = (words[0], words[1])
         elif (len(words) == 1): 
-            result = printDump(self.at91, words[0], self.dumpSizeStr)
+            result = printDump(self.at91, words[0], self.dumpSizeStr, self.dumpWordSize, self.dumpBigEndian)
             if (result):
                 self.dumpAddressStr = words[0]
         elif (len(words) == 0): 
-            printDump(self.at91, self.dumpAddressStr, self.dumpSizeStr)
+            printDump(self.at91, self.dumpAddressStr, self.dumpSizeStr, self.dumpWordSize, self.dumpBigEndian)
         else:
             self.help_dump()
         print        
     
     def help_dump(self):
         print "Dump memory"
-        print "Usage:dump [address=<HEX>] [size=<INT>]"
+        print "Usage:dump [address=<HEX>] [size=<INT>] [file=<STR> [resume]]"
+        print "If the file is specified the memory is written to the binary file"
+        print "See also dumpformat"
         print "Default args: addrress={0} size={1}".format(self.dumpAddressStr, self.dumpSizeStr)
+
+    DUMP_FORMAT_WORDS = {'8' : 1, '16' : 2, '32' : 4}
+    DUMP_FORMAT_ENDIAN = ['little', 'big']
+    def do_dumpformat(self, line):
+        words = line.split()
+        if ((len(words) >= 1) and (words[0] in self.DUMP_FORMAT_WORDS)):
+            self.dumpWordSize = self.DUMP_FORMAT_WORDS[words[0]]
+            if ((len(words) == 2) and (words[1] in self.DUMP_FORMAT_ENDIAN)):
+                self.dumpBigEndian = (words[1] == 'big')
+        else:
+            self.help_dumpformat()
+
+    def help_dumpformat(self):
+        print "Set word size and byte order of the dump output"
+        print "Usage:dumpformat [8|16|32] [little|big]"
+        print "Current: {0} bits {1} endian".format(8*self.dumpWordSize, self.DUMP_FORMAT_ENDIAN[self.dumpBigEndian])
         
     def do_statistics(self, line):
-        statManager.printAll()
+        words = line.split()
+        if (len(words) == 0):
+            statManager.printAll()
+        elif (len(words) == 1):
+            statManager.export(words[0])
+        else:
+            self.help_statistics()
 
     def help_statistics(self):
-        print "Print debug statistics"
+        print "Print debug statistics, latency of the operations and throughput"
+        print "Usage:statistics [filename=<STR>]"
+        print "Write the statistics to the file, Prometheus text format if the name ends with .prom, JSON otherwise"
+
+    def do_cache(self, line):
+        words = line.split()
+        pageCache = self.at91.getPageCache()
+        if ((len(words) == 1) and (words[0] in ["on", "off"])):
+            self.at91.enablePageCache(words[0] == "on")
+        elif ((len(words) == 1) and (words[0] == "flush")):
+            if (pageCache != None):
+                pageCache.invalidate(force=True)
+        elif ((len(words) == 4) and (words[0] == "region") and (words[3] in PageCache.POLICIES)):
+            (result, address) = convertToInt(words[1], 16)
+            (result, size) = convertToInt(words[2], 10) if result else (result, 0)
+            if (result and (pageCache != None)):
+                pageCache.addRegion(address, size, words[3])
+            elif (result):
+                print "Page cache is disabled"
+        elif (len(words) == 0):
+            if (pageCache == None):
+                print "Page cache is disabled"
+            else:
+                print "Pages {0}/{1}, page size {2}".format(len(pageCache.cache), pageCache.pages, PageCache.PAGE_SIZE)
+                for (address, size, policy) in pageCache.regions:
+                    print "{0:08X}-{1:08X} {2}".format(address, address + size - 1, policy)
+        else:
+            self.help_cache()
+
+    def help_cache(self):
+        print "Cache of the memory pages read by dump and read"
+        print "Usage:cache [on|off|flush]"
+        print "Usage:cache region address=<HEX> size=<INT> never|default|always"
+        print "Pages of 'always' regions are not invalidated by run and applet commands, 'never' regions are not cached"
+        print "Without arguments print the regions"
+
+    def do_wait(self, line):
+        words = line.split(None, 1)
+        if (len(words) == 2):
+            (result, timeout) = convertToFloat(words[0])
+            if (not result): return
+            waitLine(self.at91, words[1], timeout)
+        else:
+            self.help_wait()
+
+    def help_wait(self):
+        print "Wait for a line of the code output which matches the regular expression"
+        print "Usage:wait timeout=<FLOAT> pattern=<STR>"
+
+    def do_memtest(self, line):
+        words = line.split()
+        if ((len(words) >= 2) and (len(words) <= 4)):
+            tests = words[2] if (len(words) > 2) else MEMTEST_DEFAULT_TESTS
+            pattern = words[3] if (len(words) > 3) else "55AA55AA"
+            testMemory(self.at91, self.runFilename, self.runAddressStr, words[0], words[1], tests, pattern)
+        else:
+            self.help_memtest()
+
+    def help_memtest(self):
+        print "Test the memory range on the target, the applet is loaded if it is not running"
+        print "Usage:memtest address=<HEX> size=<INT> [tests=<STR>] [pattern=<HEX>]"
+        print "Tests is a comma separated list of {0}, default {1}".format(", ".join(sorted(CmdLoop.MEMTEST_NAMES)), MEMTEST_DEFAULT_TESTS)
+
+    def do_fill(self, line):
+        words = line.split()
+        if (len(words) == 3):
+            fillMemory(self.at91, self.runFilename, self.runAddressStr, words[0], words[1], words[2])
+        else:
+            self.help_fill()
+
+    def help_fill(self):
+        print "Fill the memory range on the target with the pattern"
+        print "Usage:fill address=<HEX> size=<INT> pattern=<HEX>"
+
+    def do_script(self, line):
+        words = line.split()
+        if (len(words) == 1):
+            runScript(self.at91, words[0], self)
+        else:
+            self.help_script()
+
+    def help_script(self):
+        print "Execute the commands from the file"
+        print "Usage:script filename=<STR>"
+        print "The file is parsed before the execution, consecutive write, read and dump commands are sent in one transaction"
+        print "Commands are separated by new lines or ';', '#' starts a comment"
 
     def do_run(self, line):
         words = line.split()
+        differential = ("diff" in words)
+        compressed = ("compress" in words)
+        verify = ("verify" in words)
+        outputTimeout = self.runOutputTimeout
+        for w in [w for w in words if w.startswith("wait=")]:
+            (result, outputTimeout) = convertToFloat(w[len("wait="):])
+            if (not result): return
+        words = [w for w in words if ((not w in ["diff", "compress", "verify"]) and (not w.startswith("wait=")))]
         if (len(words) == 2):
-            result = executeCode(at91, words[0], words[1])
+            result = executeCode(self.at91, words[0], words[1], differential=differential, compressed=compressed, verify=verify)
             if (result):
                 (self.runFilename, self.runAddressStr) = (words[0], words[1])
         elif (len(words) == 0): 
-            executeCode(self.at91, self.runFilename, self.runAddressStr)
+            executeCode(self.at91, self.runFilename, self.runAddressStr, differential=differential, compressed=compressed, verify=verify)
         else:
             self.help_run()
 
-        waitOuput(at91)
-        #self.at91.connectionPollEnable(True)
+        waitOuput(self.at91, outputTimeout)
 
     def help_run(self):
         print "Load and run code"
-        print "Usage:run [fileaname=<STR>] [address=<HEX>]"
+        print "Usage:run [diff] [compress] [verify] [wait=<FLOAT>] [fileaname=<STR>] [address=<HEX>]"
+        print "The output of the code is logged until there is no output for 'wait' seconds, default {0}".format(self.runOutputTimeout)
+        print "With 'diff' only blocks which differ from the target memory are loaded"
+        print "With 'compress' the running applet receives and decompresses LZ4 compressed code"
+        print "With 'verify' CRC32 of the loaded code is compared with the file"
+        print "ELF file is loaded by segments and starts from the entry point, the address is not used"
+        print "If the applet does not answer the last image loaded in this session is assumed, unless it was started"
         print "Default args: filename={0} address={1}".format(self.runFilename, self.runAddressStr)
 
     def do_flash(self, line):
         words = line.split()
-        while (True):
-            if (len(words) == 0):
-                result = executeCode(at91, self.flashAppletFilename, self.flashRunAddressStr)
-                waitOuput(at91)
-                if (not result):
-                    break
-                
-                self.cmdLoop.sendCommand(self.cmdLoop.CMD_EXIT)
-                waitOuput(at91)
-            break
-                
-        self.at91.connectionPollEnable(True)
-
-        #  Load applet
-        #  Load image
-        #  Send erase flash 
-        #  Write data 
+        compressed = ("compress" in words)
+        verify = ("verify" in words)
+        words = [w for w in words if (not w in ["compress", "verify"])]
+        if (len(words) == 4):
+            result = flashImage(self.at91, words[0], words[1], words[2], words[3], compressed, verify=verify)
+            if (result):
+                (self.flashAppletFilename, self.flashRunAddressStr, self.flashImage, self.flashAddressStr) = words
+        elif (len(words) == 0):
+            flashImage(self.at91, self.flashAppletFilename, self.flashRunAddressStr, self.flashImage, self.flashAddressStr, compressed, verify=verify)
+        else:
+            self.help_flash()
         
     def help_flash(self):
         print "Program serial flash with BIN file"
-        print "Usage:flash [applet=<STR>] [appletAddress=<HEX>] [imageFile=<STR>] [flashAddress=<HEX>]"
-        print "Default args: applet={0} appletAddress={1} image={2} flashAddress={3}".format(self.flashAppletFilename, self.flashImage, self.flashAddressStr)
+        print "Usage:flash [compress] [verify] [applet=<STR>] [appletAddress=<HEX>] [imageFile=<STR>] [flashAddress=<HEX>]"
+        print "The applet programs a block while the next block is loaded"
+        print "Default args: applet={0} appletAddress={1} image={2} flashAddress={3}".format(self.flashAppletFilename, self.flashRunAddressStr, self.flashImage, self.flashAddressStr)
 
     def do_command(self, line):
-        self.at91.connectionPollEnable(False)
-        
         words = line.split()
         if (len(words) == 0):
             (result, cmdCommand) = convertToInt(self.cmdCommand, 16)
@@ -417,8 +808,7 @@ class cmdGroundLevel(cmd.Cmd):
             self.cmdLoop.sendCommand(cmdCommand)
             self.cmdCommand = words[0]
             
-        waitOuput(at91, 1.0)
-        self.at91.connectionPollEnable(True)
+        waitOuput(self.at91, 1.0)
         
         
     def help_command(self):
@@ -426,6 +816,31 @@ class cmdGroundLevel(cmd.Cmd):
         print "Usage:command  command=<HEX>"
         print "Default args: command={0} payload='{1}'".format(self.cmdCommand, self.cmdPayload)
         
+    def do_ping(self, line):
+        words = line.split()
+        (count, window) = (16, CmdPipeline.WINDOW)
+        if (len(words) >= 1):
+            (result, count) = convertToInt(words[0], 10)
+            if (not result): return
+        if (len(words) >= 2):
+            (result, window) = convertToInt(words[1], 10)
+            if (not result): return
+        
+        startTime = time.time()
+        results = self.cmdLoop.execute([(CmdLoop.CMD_PING, None)]*count, window)
+        elapsed = time.time() - startTime
+        latencies = [latency for (result, _, latency) in results if result]
+        if (len(latencies) > 0):
+            print "{0} of {1} responses in {2:.3f}s, latency min {3:.1f}ms avg {4:.1f}ms max {5:.1f}ms".format(
+                len(latencies), count, elapsed, 1000*min(latencies), 1000*sum(latencies)/len(latencies), 1000*max(latencies))
+        else:
+            print "No response from the applet"
+
+    def help_ping(self):
+        print "Ping the running applet, up to 'window' pings are in flight"
+        print "Usage:ping [count=<INT>] [window=<INT>]"
+        print "Default args: count=16 window={0}".format(CmdPipeline.WINDOW)
+
     def do_read(self, line):
         words = line.split()
         if (len(words) == 1):
@@ -443,10 +858,11 @@ class cmdGroundLevel(cmd.Cmd):
 
     def do_write(self, line):
         words = line.split()
-        if (len(words) == 2):
-            result = writeData(self.at91, words[0], words[1])
+        if (len(words) >= 2):
+            valueStr = " ".join(words[1:])
+            result = writeData(self.at91, words[0], valueStr)
             if (result):
-                (self.writeAddressStr, self.writeValueStr) = (words[0], words[1])
+                (self.writeAddressStr, self.writeValueStr) = (words[0], valueStr)
         elif (len(words) == 0): 
             writeData(self.at91, self.writeAddressStr, self.writeValueStr)
         else:
@@ -456,9 +872,46 @@ class cmdGroundLevel(cmd.Cmd):
 
     def help_write(self):
         print "Write memory"
-        print "Usage:write [address=<HEX>] [value=<HEX>]"
+        print "Usage:write [address=<HEX>] [value=<HEX>] [value=<HEX> ...]"
+        print "Several values are written to consecutive words in one transaction"
         print "Default args: address={0} value={1}".format(self.writeAddressStr, self.writeValueStr)
 
+    def do_baudrate(self, line):
+        words = line.split()
+        if (not self.at91.appletRunning):
+            print "The applet is not running"
+        elif ((len(words) == 1) and (words[0] == "probe")):
+            (_, address) = convertToInt(self.runAddressStr, 16)
+            print "The highest reliable rate is {0}".format(probeBaudrate(self.at91, address))
+        elif (len(words) == 1):
+            (result, rate) = convertToInt(words[0], 10)
+            if (result):
+                result = self.at91.setBaudrate(rate)
+            print "Rate is {0}".format(self.at91.getTTY().getRate())
+        else:
+            self.help_baudrate()
+
+    def help_baudrate(self):
+        print "Switch the running applet and the host to another line rate"
+        print "Usage:baudrate rate=<INT>|probe"
+        print "The previous rate is restored if the applet does not answer at the new rate"
+        print "'probe' finds the highest rate which transfers a dump without errors"
+
+    def do_upload(self, line):
+        words = line.split()
+        compressed = ("compress" in words)
+        verify = ("verify" in words)
+        words = [w for w in words if (not w in ["compress", "verify"])]
+        if (len(words) == 2):
+            uploadFile(self.at91, words[0], words[1], compressed, verify)
+        else:
+            self.help_upload()
+
+    def help_upload(self):
+        print "Write BIN file to the memory, for example an image to DDR"
+        print "Usage:upload [compress] [verify] filename=<STR> address=<HEX>"
+        print "The running applet receives the data much faster than SAM-BA monitor"
+
     def do_exit(self, line):
         self.closeAll()
         
@@ -494,12 +947,118 @@ class cmdGroundLevel(cmd.Cmd):
 
     def closeAll(self):
         beepSound.disable()
-        at91.cancel()
+        self.at91.cancel()
+        if (statExporter != None):
+            statExporter.cancel()
         return exit(0)
     
 
+class WireTrace:
+    '''
+    Record the serial traffic to a file of fixed size. The file is a ring of blocks, 
+    the new block overwrites the oldest one. Records do not cross the blocks, the 
+    current block is kept in memory and written when full or every SYNC_PERIOD seconds
+    See at91_trace.py for the analysis
+    '''
+    MAGIC = "AT91WIRE"
+    VERSION = 1
+    # magic, version, block size, number of blocks, start time
+    HEADER_FORMAT = "<8sIIId"
+    HEADER_SIZE = 64
+    # Sequence number of the block, 0 if the block is not used
+    BLOCK_HEADER_FORMAT = "<Q"
+    # Type, size of the data, microseconds since the start
+    RECORD_FORMAT = "<BHQ"
+    BLOCK_SIZE = 64*1024
+    DEFAULT_SIZE = 16*1024*1024
+    SYNC_PERIOD = 1.0
+
+    # Record types, END is the unused part of the block
+    END   = 0
+    TX    = 1
+    RX    = 2
+    FLUSH = 3
+    MARK  = 4
+    RATE  = 5
+
+    def __init__(self, filename, size=DEFAULT_SIZE):
+        self.blocks = max(2, size/self.BLOCK_SIZE)
+        self.startTime = time.time()
+        self.lastTimestamp = 0
+        self.lastSync = self.startTime
+        self.sequence = 0
+        self.block = None
+        self.lock = threading.Lock()
+        self.recordSize = struct.calcsize(self.RECORD_FORMAT)
+        self.file = open(filename, "w+b")
+        header = struct.pack(self.HEADER_FORMAT, self.MAGIC, self.VERSION, self.BLOCK_SIZE, self.blocks, self.startTime)
+        self.file.write(header.ljust(self.HEADER_SIZE, chr(0)))
+        self.file.truncate(self.HEADER_SIZE + self.blocks*self.BLOCK_SIZE)
+        self.__newBlock()
+
+    def __newBlock(self):
+        self.sequence = self.sequence + 1
+        self.block = bytearray(struct.pack(self.BLOCK_HEADER_FORMAT, self.sequence))
+
+    def __writeBlock(self):
+        '''
+        The rest of the block is zeros, the record type END
+        '''
+        index = (self.sequence - 1) % self.blocks
+        self.file.seek(self.HEADER_SIZE + index*self.BLOCK_SIZE)
+        self.file.write(self.block + bytearray(self.BLOCK_SIZE - len(self.block)))
+        self.lastSync = time.time()
+
+    def __timestamp(self):
+        '''
+        Microseconds since the start, never goes back if the system time is changed
+        '''
+        timestamp = int((time.time() - self.startTime)*1000000)
+        self.lastTimestamp = max(self.lastTimestamp, timestamp)
+        return self.lastTimestamp
+
+    def record(self, recordType, data=""):
+        '''
+        Add a record, long data is split between several records of the same type
+        '''
+        self.lock.acquire()
+        if (self.file == None):
+            self.lock.release()
+            return
+        timestamp = self.__timestamp()
+        maxData = self.BLOCK_SIZE - struct.calcsize(self.BLOCK_HEADER_FORMAT) - self.recordSize
+        offset = 0
+        while (True):
+            chunk = data[offset:offset+maxData]
+            if (len(self.block) + self.recordSize + len(chunk) > self.BLOCK_SIZE):
+                self.__writeBlock()
+                self.__newBlock()
+            self.block.extend(struct.pack(self.RECORD_FORMAT, recordType, len(chunk), timestamp))
+            self.block.extend(chunk)
+            offset = offset + len(chunk)
+            if (offset >= len(data)):
+                break
+        if (time.time() - self.lastSync > self.SYNC_PERIOD):
+            self.__writeBlock()
+        self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        if (self.file != None):
+            self.__writeBlock()
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
 class SerialConnection:
     
+    # Pending writes are sent to the tty when the transmit buffer gets this large
+    TX_BUFFER_SIZE = 4096
+    # Receive buffer of swFlush(), allocated once
+    RX_BUFFER_SIZE = 64*1024
+    # swFlush() returns after the input is quiet for this long, not shorter than the timeout 
+    # of the tty. USB adapters deliver the input in chunks, FTDI latency timer is 16ms by default
+    FLUSH_QUIET_TIME = 0.01
     
     def __init__(self, device, rate):
         tty = serial.Serial();
@@ -515,10 +1074,48 @@ class SerialConnection:
         tty.dsrdtr=False;
         self.tty = tty
         self.device = device
-        self.stat = StatManager.Block("")
-        self.stat.addFieldsInt(["rx", "tx", "rxFailed", "txFailed", "flushed"])
+        self.rxBuffer = bytearray(self.RX_BUFFER_SIZE)
+        self.rxView = memoryview(self.rxBuffer)
+        self.flushQuietTime = self.FLUSH_QUIET_TIME
+        self.trace = None
+        self.batchLevel = 0
+        self.txBuffer = []
+        self.txBufferSize = 0
+        self.stat = StatManager.Block(device)
+        self.stat.addFieldsInt(["rx", "tx", "rxFailed", "txFailed", "flushed", "batches", "txCoalesced"])
+        self.stat.addThroughputs(["rx", "tx"])
         statManager.addCounters("SerialConnection", self.stat)
 
+    def startTrace(self, filename, size=WireTrace.DEFAULT_SIZE):
+        '''
+        Record all data sent and received to the file
+        '''
+        self.stopTrace()
+        try:
+            self.trace = WireTrace(filename, size)
+            self.trace.record(WireTrace.RATE, struct.pack("<I", self.tty.baudrate))
+        except IOError:
+            logger.error("Failed to open trace file {0}".format(filename))
+            self.trace = None
+        return (self.trace != None)
+
+    def stopTrace(self):
+        trace = self.trace
+        self.trace = None
+        if (trace != None):
+            trace.close()
+
+    def traceRecord(self, recordType, data=""):
+        trace = self.trace
+        if (trace != None):
+            trace.record(recordType, data)
+
+    def traceMark(self, name):
+        '''
+        Start of the operation, the traffic up to the next mark belongs to the operation
+        '''
+        self.traceRecord(WireTrace.MARK, name)
+
     def reset(self):
         tty = self.tty
         result = False
@@ -575,11 +1172,74 @@ class SerialConnection:
         except Exception:
             traceback.print_exc();
 
+    def beginBatch(self):
+        '''
+        Start a transaction. Writes are collected in the transmit buffer 
+        and sent to the tty by a single write in commit()
+        Transactions can be nested, the outermost commit() sends the data
+        '''
+        self.batchLevel = self.batchLevel + 1
+
+    def commit(self):
+        '''
+        Close the transaction started by beginBatch()
+        Returns False if the pending data could not be sent
+        '''
+        result = True
+        if (self.batchLevel > 0):
+            self.batchLevel = self.batchLevel - 1
+        if (self.batchLevel == 0):
+            result = self.__sendTxBuffer()
+        return result
+
+    def __sendTxBuffer(self):
+        '''
+        Send all pending writes with one tty write
+        '''
+        if (self.txBufferSize == 0):
+            return True
+
+        data = "".join(self.txBuffer)
+        self.txBuffer = []
+        self.txBufferSize = 0
+        self.stat.batches = self.stat.batches + 1
+
+        tty = self.tty
+        result = False
+        if (not tty.isOpen()):
+            return False
+        try:
+            tty.flush();
+            tty.write(data);
+            self.stat.addBytes("tx", len(data))
+            self.traceRecord(WireTrace.TX, data)
+            result = True
+        except Exception:
+            self.stat.txFailed = self.stat.txFailed + 1
+
+        return result
+
+    def __addTxBuffer(self, data):
+        '''
+        Add data to the transmit buffer of the transaction
+        '''
+        self.txBuffer.append(data)
+        self.txBufferSize = self.txBufferSize + len(data)
+        self.stat.txCoalesced = self.stat.txCoalesced + 1
+        result = True
+        if (self.txBufferSize >= self.TX_BUFFER_SIZE):
+            result = self.__sendTxBuffer()
+        return result
+
     def write(self, data):
         '''
         write data to the tty
         @param data:string to write 
         '''
+        if (self.batchLevel > 0):
+            self.stat.tx = self.stat.tx + 1
+            return self.__addTxBuffer(data)
+
         tty = self.tty
         result = False
         if (not tty.isOpen()):
@@ -588,6 +1248,8 @@ class SerialConnection:
             tty.flush();
             tty.write(data);
             self.stat.tx = self.stat.tx + 1
+            self.stat.addBytes("tx", len(data))
+            self.traceRecord(WireTrace.TX, data)
             result = True
         except Exception:
             self.stat.txFailed = self.stat.txFailed + 1
@@ -601,12 +1263,17 @@ class SerialConnection:
         write data to the tty
         @param data:string to write 
         '''
+        if (self.batchLevel > 0):
+            return self.__addTxBuffer(data)
+
         tty = self.tty
         result = False
         if (not tty.isOpen()):
             return False
         try:
             tty.write(data);
+            self.stat.addBytes("tx", len(data))
+            self.traceRecord(WireTrace.TX, data)
         except Exception:
             pass
             #tty.flush();
@@ -618,6 +1285,8 @@ class SerialConnection:
         '''
         read all characters, similar to flush, buit i wait for timeout
         '''
+        # Response is expected - send the pending writes first
+        self.__sendTxBuffer()
         
         tty = self.tty
         s = ''
@@ -625,6 +1294,9 @@ class SerialConnection:
         try:
             s = tty.read(expectedCount)
             self.stat.rx = self.stat.rx + 1
+            self.stat.addBytes("rx", len(s))
+            if (len(s) > 0):
+                self.traceRecord(WireTrace.RX, s)
             result = True
         except Exception:
             self.stat.rxFailed = self.stat.rxFailed + 1
@@ -632,26 +1304,141 @@ class SerialConnection:
             #traceback.print_exc();
     
         return (result, s)
-    
-    def swFlush(self):
-        count = 0
-        s = ""
-        while (True):   
-            (result, data) = self.read(2)
+
+    def readInto(self, buffer):
+        '''
+        Read up to len(buffer) characters to the buffer, waits for the timeout like read()
+        Returns tuple (result, number of characters)
+        '''
+        self.__sendTxBuffer()
+
+        buffer = memoryview(buffer)
+        (result, count) = self.__readInto(buffer)
+        if (result):
+            self.stat.rx = self.stat.rx + 1
+            self.stat.addBytes("rx", count)
+            if ((count > 0) and (self.trace != None)):
+                self.traceRecord(WireTrace.RX, buffer[:count].tobytes())
+        else:
+            self.stat.rxFailed = self.stat.rxFailed + 1
+
+        return (result, count)
+
+    def __readInto(self, buffer):
+        try:
+            return (True, self.tty.readinto(buffer))
+        except Exception:
+            return (False, 0)
+
+    def __pending(self):
+        '''
+        Returns number of the received characters, 0 if the tty is closed
+        '''
+        try:
+            return self.tty.inWaiting()
+        except Exception:
+            return 0
+
+    def readAvailable(self):
+        '''
+        Read the characters which are already received, never wait
+        '''
+        count = self.__pending()
+        if (count == 0):
+            return (True, "")
+        return self.read(count)
+
+    def readAll(self, expectedCount, timeout=1.0):
+        '''
+        read exactly expectedCount characters, keep reading until timeout
+        Returns False if less than expectedCount characters arrived
+        '''
+        s = ''
+        result = True
+        deadline = time.time() + timeout
+        while (len(s) < expectedCount):
+            (result, data) = self.read(expectedCount - len(s))
             if (not result):
                 break
-            if (data == None):
+            s = s + data
+            if (time.time() > deadline):
                 break
-            if (data == ""):
+
+        result = result and (len(s) == expectedCount)
+        return (result, s)
+
+    def readAllInto(self, buffer, timeout=1.0):
+        '''
+        Fill the buffer, keep reading until timeout
+        Returns tuple (result, number of characters), False if the buffer is not full
+        '''
+        buffer = memoryview(buffer)
+        count = 0
+        result = True
+        deadline = time.time() + timeout
+        while (count < len(buffer)):
+            (result, received) = self.readInto(buffer[count:])
+            if (not result):
                 break
-            if (len(data) == 0):
+            count = count + received
+            if (time.time() > deadline):
                 break
-            count = count + len(data)
-            s = s + data
+
+        result = result and (count == len(buffer))
+        return (result, count)
+
+    def getRate(self):
+        return self.tty.baudrate
+
+    def setRate(self, rate):
+        '''
+        Change the line rate of the opened port, the pending data is sent at the old rate
+        '''
+        result = True
+        try:
+            self.tty.flush()
+            self.tty.baudrate = rate
+            self.traceRecord(WireTrace.RATE, struct.pack("<I", rate))
+        except (ValueError, serial.SerialException):
+            logger.error("Failed to set rate {0} for {1}".format(rate, self.device))
+            result = False
+        return result
+
+    def transferTime(self, count):
+        '''
+        Time the line needs to send count bytes: start bit, 8 bits, stop bit
+        '''
+        return (count*10.0)/self.tty.baudrate
+
+    def swFlush(self):
+        '''
+        Drop the received characters, the input is drained in one read. Returns when 
+        nothing arrives for flushQuietTime or the timeout of the tty, whichever is longer
+        '''
+        # Response is expected - send the pending writes first
+        self.__sendTxBuffer()
+
+        count = 0
+        flushed = []
+        settled = False
+        while (True):
+            waiting = self.__pending()
+            if (waiting > 0):
+                (result, received) = self.__readInto(self.rxView[:min(waiting, self.RX_BUFFER_SIZE)])
+                if ((not result) or (received == 0)):
+                    break
+                count = count + received
+                if (self.trace != None):
+                    flushed.append(self.rxView[:received].tobytes())
+                settled = False
+                continue
+            if (settled):
+                break
+            time.sleep(max(self.flushQuietTime, self.tty.timeout))
+            settled = True
             
-        #if (count > 0):
-        #    logger.error("Flush {0} bytes '{1}'".format(count, s))
         self.stat.flushed = self.stat.flushed + count
+        self.traceRecord(WireTrace.FLUSH, "".join(flushed))
         
         return count
         
@@ -659,23 +1446,218 @@ class SerialConnection:
     def name(self):
         return self.device
 
-class CmdLoop:
+class XModem:
     '''
-    Methods to send command to the applet.
-    Command contains command IP, command size, optional payload and checksum
+    XMODEM (CRC16) framing used by the SAM-BA monitor for the send file 'S' and
+    receive file 'R' commands over the DBGU
     '''
-    CMD_PING            = 0x03
-    CMD_EXIT            = 0x04
+    SOH = chr(0x01)
+    EOT = chr(0x04)
+    ACK = chr(0x06)
+    NAK = chr(0x15)
+    CAN = chr(0x18)
+    CRC = 'C'
+    BLOCK_SIZE = 128
+    RETRIES = 10
 
-    def __init__(self, at91):
-        self.at91 = at91 
-    
-    def calculateChecksum(self, data):
+    def __init__(self, tty):
+        self.tty = tty
+        self.stat = StatManager.Block(tty.name())
+        self.stat.addFieldsInt(["rxBlocks", "txBlocks", "crcErrors", "retries", "timeouts", "canceled"])
+        statManager.addCounters("XModem", self.stat)
+
+    def buildBlock(self, blockNumber, data):
         '''
-        Command loop of the applet requires simple checksum in the end 
-        of the message 
+        Concatenate header, 128 bytes of data padded with zeros and CRC16
         '''
-        sum = 0;
+        data = data.ljust(self.BLOCK_SIZE, chr(0))
+        crc = binascii.crc_hqx(data, 0)
+        blockNumber = blockNumber & 0xFF
+        header = self.SOH + chr(blockNumber) + chr(0xFF - blockNumber)
+        return header + data + chr((crc >> 8) & 0xFF) + chr(crc & 0xFF)
+
+    def parseBlock(self, block):
+        '''
+        Check the block (without SOH) and return block number and payload
+        '''
+        blockNumber = ord(block[0])
+        result = (blockNumber == (0xFF - ord(block[1])))
+        data = block[2:2+self.BLOCK_SIZE]
+        crc = (ord(block[-2]) << 8) | ord(block[-1])
+        if (result and (binascii.crc_hqx(data, 0) != crc)):
+            self.stat.crcErrors = self.stat.crcErrors + 1
+            result = False
+
+        return (result, blockNumber, data)
+
+    def receive(self, size, timeout=1.0):
+        '''
+        Receive size bytes from the device
+        Returns tuple (result, data)
+        '''
+        buffer = bytearray(size)
+        (result, count) = self.receiveInto(memoryview(buffer), timeout)
+        return (result, str(buffer[:count]))
+
+    def receiveInto(self, buffer, timeout=1.0):
+        '''
+        Receive len(buffer) bytes from the device into the preallocated buffer
+        Returns tuple (result, number of bytes received)
+        '''
+        size = len(buffer)
+        count = 0
+        expectedBlock = 1
+        retries = self.RETRIES
+        # Receiver starts the transfer by sending 'C' - CRC16 mode
+        response = self.CRC
+        result = False
+        while (retries > 0):
+            self.tty.write2(response)
+            (_, c) = self.tty.readAll(1, timeout)
+            if (c == self.SOH):
+                blockSize = self.BLOCK_SIZE + 4
+                (result, block) = self.tty.readAll(blockSize, timeout)
+                if (result):
+                    (result, blockNumber, data) = self.parseBlock(block)
+                if (not result):
+                    response = self.NAK
+                    retries = retries - 1
+                    self.stat.retries = self.stat.retries + 1
+                    self.tty.swFlush()
+                    continue
+                # Block is repeated if the sender missed my ACK
+                if (blockNumber == (expectedBlock & 0xFF)):
+                    # The last block is padded
+                    data = data[:size-count]
+                    buffer[count:count+len(data)] = data
+                    count = count + len(data)
+                    expectedBlock = expectedBlock + 1
+                    self.stat.rxBlocks = self.stat.rxBlocks + 1
+                response = self.ACK
+                retries = self.RETRIES
+            elif (c == self.EOT):
+                self.tty.write2(self.ACK)
+                result = True
+                break
+            elif (c == self.CAN):
+                self.stat.canceled = self.stat.canceled + 1
+                result = False
+                break
+            else:
+                self.stat.timeouts = self.stat.timeouts + 1
+                retries = retries - 1
+                result = False
+
+        result = result and (count == size)
+        return (result, count)
+
+    def send(self, data, timeout=1.0):
+        '''
+        Send data to the device.
+        Returns True if the device acknowledged all blocks
+        '''
+        # Wait for the receiver to ask for CRC16 mode
+        retries = self.RETRIES
+        result = False
+        while (retries > 0):
+            (_, c) = self.tty.readAll(1, timeout)
+            if (c == self.CRC):
+                result = True
+                break
+            retries = retries - 1
+            self.stat.timeouts = self.stat.timeouts + 1
+        if (not result):
+            return result
+
+        blockNumber = 1
+        index = 0
+        while (index < len(data)):
+            block = self.buildBlock(blockNumber, data[index:index+self.BLOCK_SIZE])
+            retries = self.RETRIES
+            result = False
+            while (retries > 0):
+                self.tty.write2(block)
+                (_, c) = self.tty.readAll(1, timeout)
+                if (c == self.ACK):
+                    result = True
+                    break
+                if (c == self.CAN):
+                    self.stat.canceled = self.stat.canceled + 1
+                    break
+                retries = retries - 1
+                self.stat.retries = self.stat.retries + 1
+            if (not result):
+                return result
+            self.stat.txBlocks = self.stat.txBlocks + 1
+            blockNumber = blockNumber + 1
+            index = index + self.BLOCK_SIZE
+
+        result = False
+        retries = self.RETRIES
+        while (retries > 0):
+            self.tty.write2(self.EOT)
+            (_, c) = self.tty.readAll(1, timeout)
+            if (c == self.ACK):
+                result = True
+                break
+            retries = retries - 1
+
+        return result
+
+class CmdLoop:
+    '''
+    Methods to send command to the applet.
+    Command contains command IP, command size, optional payload and checksum
+    '''
+    CMD_PING            = 0x03
+    CMD_EXIT            = 0x04
+    CMD_CHECKSUM        = 0x05
+    CMD_READ_BLOCK      = 0x06
+    CMD_WRITE_BLOCK     = 0x07
+    CMD_FLASH_INIT      = 0x08
+    CMD_FLASH_WRITE     = 0x09
+    CMD_FLASH_STATUS    = 0x0A
+    CMD_DECOMPRESS      = 0x0B
+    CMD_SET_BAUDRATE    = 0x0C
+    CMD_MEMTEST         = 0x0D
+    CMD_FLASH_CHECKSUM  = 0x0E
+
+    # The first byte of the payload is a sequence number, see CMD_SEQUENCE_FLAG in applets/src/cmd.h
+    SEQUENCE_FLAG       = 0x40
+
+    # See CMD_CHECKSUM_BLOCKS_MAX in applets/src/cmd.h
+    CHECKSUM_BLOCKS_MAX = 32
+    # Raw data of CMD_READ_BLOCK and CMD_WRITE_BLOCK is sent in frames of this size
+    BLOCK_FRAME_SIZE    = 4096
+    BLOCK_STATUS_OK     = 0
+    # See SPIFLASH_STATE_xx and SPIFLASH_STATUS_xx in applets/src/spiflash/spiflash.h
+    FLASH_STATE_IDLE    = 0
+    FLASH_STATE_BUSY    = 1
+    FLASH_STATUS_OK     = 0
+    DECOMPRESS_STATUS_OK = 0
+    BAUDRATE_STATUS_OK  = 0
+    # See memtest_t in applets/src/memtest.h
+    MEMTEST_FILL        = 0
+    MEMTEST_VERIFY      = 1
+    MEMTEST_DATA_BUS    = 2
+    MEMTEST_ADDRESS_BUS = 3
+    MEMTEST_PATTERN     = 4
+    MEMTEST_NAMES       = {"fill" : MEMTEST_FILL, "verify" : MEMTEST_VERIFY, "data" : MEMTEST_DATA_BUS, 
+                           "address" : MEMTEST_ADDRESS_BUS, "pattern" : MEMTEST_PATTERN}
+    MEMTEST_STATUS_OK   = 0
+    MEMTEST_STATUS_ERRORS = 1
+    # Command id, size, checksum
+    EXIT_RESPONSE_SIZE  = 3
+
+    def __init__(self, at91):
+        self.at91 = at91 
+    
+    def calculateChecksum(self, data):
+        '''
+        Command loop of the applet requires simple checksum in the end 
+        of the message 
+        '''
+        sum = 0;
         for b in data:
             sum = sum + (b & 0xFF);
             sum = sum & 0xFF
@@ -693,59 +1675,659 @@ class CmdLoop:
             command = [command] + [0x01];
         cs = self.calculateChecksum(command)
         command = command + [cs];
-        
+
         return command;
-    
+
+    def findResponse(self, data, command):
+        '''
+        Find response to the command in the data received from the applet.
+        The applet sets MSB of the command ID in all responses but the first one
+        Debug output of the applet before the response is skipped
+        Returns tuple (result, payload, number of bytes consumed)
+        '''
+        index = 0
+        while (index + 3 <= len(data)):
+            commandId = ord(data[index]) & 0x7F
+            size = ord(data[index+1])
+            frameEnd = index + 2 + size
+            if ((commandId == command) and (size > 0) and (frameEnd <= len(data))):
+                frame = map(ord, data[index:frameEnd])
+                if (self.calculateChecksum(frame[:-1]) == frame[-1]):
+                    return (True, frame[2:-1], frameEnd)
+            index = index + 1
+
+        return (False, None, 0)
+
+    def commandName(self, command):
+        '''
+        Name of the command in the statistics, for example "ping" for CMD_PING
+        '''
+        for name in dir(CmdLoop):
+            if (name.startswith("CMD_") and (getattr(CmdLoop, name) == command)):
+                return name[4:].lower()
+        return "{0:02X}".format(command)
+
+    def buildSequencedCommand(self, command, sequence, payload):
+        '''
+        Command with the sequence number, the applet copies the number to the response
+        '''
+        if (payload == None):
+            payload = []
+        return self.buildCommand(command | self.SEQUENCE_FLAG, [sequence] + payload)
+
+    def execute(self, commands, window=None):
+        '''
+        Send the commands to the applet without waiting for the responses
+        @param commands:list of tuples (command, payload)
+        Returns list of tuples (result, payload of the response, latency) in the order of the commands
+        '''
+        return self.at91.appletCommands(commands, window)
+
+    def readBlockPayload(self, address, size):
+        '''
+        Payload of CMD_READ_BLOCK, see cmd_read_block_rq_t
+        '''
+        return map(ord, struct.pack("<II", address, size))
+
+    def parseReadBlockResponse(self, response):
+        '''
+        Returns tuple (size of the data, CRC32 of the data)
+        '''
+        return struct.unpack("<II", "".join(map(chr, response)))
+
+    def writeBlockPayload(self, address, data):
+        '''
+        Payload of CMD_WRITE_BLOCK, see cmd_write_block_rq_t. The data follows the command
+        '''
+        return map(ord, struct.pack("<III", address, len(data), binascii.crc32(data) & 0xFFFFFFFF))
+
+    def parseWriteBlockResponse(self, response):
+        '''
+        Returns tuple (status, CRC32 of the written memory)
+        '''
+        return struct.unpack("<BI", "".join(map(chr, response)))
+
+    def decompressPayload(self, src, srcSize, dst, dstSize):
+        '''
+        Payload of CMD_DECOMPRESS, see cmd_decompress_rq_t
+        '''
+        return map(ord, struct.pack("<IIII", src, srcSize, dst, dstSize))
+
+    def parseDecompressResponse(self, response):
+        '''
+        Returns tuple (status, size of the decompressed data, CRC32 of the decompressed data)
+        '''
+        return struct.unpack("<BII", "".join(map(chr, response)))
+
+    def memtestPayload(self, test, address, size, pattern):
+        '''
+        Payload of CMD_MEMTEST, see cmd_memtest_rq_t
+        '''
+        return map(ord, struct.pack("<BIII", test, address, size, pattern))
+
+    def parseMemtestResponse(self, response):
+        '''
+        Returns tuple (status, errors, address of the first error, expected value, actual value, failed bits)
+        '''
+        return struct.unpack("<BIIIII", "".join(map(chr, response)))
+
+    def parseSetBaudrateResponse(self, response):
+        '''
+        Returns tuple (status, rate of the applet)
+        '''
+        return struct.unpack("<BI", "".join(map(chr, response)))
+
+    def parseFlashInitResponse(self, response):
+        '''
+        Returns tuple (status, JEDEC ID, flash size, page size, erase block size)
+        '''
+        return struct.unpack("<BIIII", "".join(map(chr, response)))
+
+    def flashWritePayload(self, flashAddress, bufferAddress, size):
+        '''
+        Payload of CMD_FLASH_WRITE, see cmd_flash_write_rq_t
+        '''
+        return map(ord, struct.pack("<III", flashAddress, bufferAddress, size))
+
+    def parseFlashStatusResponse(self, response):
+        '''
+        Returns tuple (state, status, number of bytes programmed)
+        '''
+        return struct.unpack("<BBI", "".join(map(chr, response)))
+
     def sendCommand(self, command, payload=None):
         '''
         @param command:CMD_PING, CMD_EXIT, ... 
         '''
+        commandId = command
         command = self.buildCommand(command, payload)
         s = "".join(map(chr, command))
         self.at91.getTTY().write2(s)
+        # The applet returns to SAM-BA monitor
+        if (commandId == self.CMD_EXIT):
+            self.at91.setAppletRunning(False)
         s = ""
         for c in command:
             s = s + "{0}".format(buildhexstring(c, 2)) + " "
         logger.info("Sent command {}".format(s))
     
-    
+
+class CmdPipeline:
+    '''
+    Sliding window of applet commands. Every command carries a sequence number, 
+    responses are matched to the commands by the number. A command is sent again 
+    if the response has bad checksum or does not arrive in time
+    '''
+    WINDOW = 4
+    # The applet keeps the commands in flight in the buffer of 255 bytes
+    WINDOW_BYTES = 192
+    RESPONSE_TIMEOUT = 0.5
+    ATTEMPTS = 3
+
+    def __init__(self, tty, window=WINDOW):
+        self.tty = tty
+        self.window = window
+        self.cmdLoop = CmdLoop(None)
+        self.sequence = 0
+        self.stat = StatManager.Block(tty.name())
+        self.stat.addFieldsInt(["commands", "responses", "retransmits", "badChecksum", "timeouts", "failed", "latencyMaxUs", "latencyTotalUs"])
+        statManager.addCounters("CmdPipeline", self.stat)
+
+    def execute(self, commands, window=None):
+        '''
+        @param commands:list of tuples (command, payload)
+        Returns list of tuples (result, payload of the response, latency in seconds)
+        '''
+        if (window == None):
+            window = self.window
+        self.commands = commands
+        self.results = [(False, None, 0.0)]*len(commands)
+        self.attempts = [0]*len(commands)
+        # Indexes of the commands to send
+        self.queue = range(len(commands))
+        # Sequence number -> (index of the command, send time, size of the frame)
+        self.inflight = {}
+        data = ""
+        while ((len(self.queue) > 0) or (len(self.inflight) > 0)):
+            self.__fillWindow(window)
+            (result, s) = self.tty.read(256)
+            if (not result):
+                break
+            data = self.__parse(data + s)
+            self.__checkTimeouts()
+
+        self.tty.swFlush()
+        for ((command, _), (result, _, latency)) in zip(self.commands, self.results):
+            if (result):
+                self.stat.addLatency("cmd_" + self.cmdLoop.commandName(command), latency)
+        return self.results
+
+    def __fillWindow(self, window):
+        '''
+        Send commands while the window is not full, all frames go in one write
+        '''
+        inflightBytes = sum([frameSize for (_, _, frameSize) in self.inflight.values()])
+        self.tty.beginBatch()
+        while ((len(self.queue) > 0) and (len(self.inflight) < window)):
+            index = self.queue[0]
+            (command, payload) = self.commands[index]
+            sequence = self.sequence
+            frame = self.cmdLoop.buildSequencedCommand(command, sequence, payload)
+            if ((len(self.inflight) > 0) and (inflightBytes + len(frame) > self.WINDOW_BYTES)):
+                break
+            self.queue.pop(0)
+            self.sequence = (self.sequence + 1) & 0xFF
+            self.attempts[index] = self.attempts[index] + 1
+            self.inflight[sequence] = (index, time.time(), len(frame))
+            inflightBytes = inflightBytes + len(frame)
+            self.stat.commands = self.stat.commands + 1
+            self.tty.write("".join(map(chr, frame)))
+        self.tty.commit()
+
+    def __retransmit(self, sequence):
+        '''
+        Send the command again with a new sequence number or give up
+        '''
+        (index, _, _) = self.inflight.pop(sequence)
+        if (self.attempts[index] < self.ATTEMPTS):
+            self.stat.retransmits = self.stat.retransmits + 1
+            self.queue.insert(0, index)
+        else:
+            self.stat.failed = self.stat.failed + 1
+
+    def __parse(self, data):
+        '''
+        Find responses to the commands in flight, skip debug output of the applet
+        Returns the data which can contain the beginning of a response
+        '''
+        index = 0
+        while (index + 4 <= len(data)):
+            commandId = ord(data[index]) & 0x7F
+            size = ord(data[index+1])
+            sequence = ord(data[index+2])
+            entry = self.inflight.get(sequence, None)
+            if ((not (commandId & CmdLoop.SEQUENCE_FLAG)) or (size < 2) or (entry == None)):
+                index = index + 1
+                continue
+            (commandIndex, sendTime, _) = entry
+            if (self.commands[commandIndex][0] != (commandId & ~CmdLoop.SEQUENCE_FLAG)):
+                index = index + 1
+                continue
+            frameEnd = index + 2 + size
+            if (frameEnd > len(data)):
+                break
+            frame = map(ord, data[index:frameEnd])
+            if (self.cmdLoop.calculateChecksum(frame[:-1]) != frame[-1]):
+                self.stat.badChecksum = self.stat.badChecksum + 1
+                self.__retransmit(sequence)
+                index = index + 1
+                continue
+
+            del self.inflight[sequence]
+            latency = time.time() - sendTime
+            self.results[commandIndex] = (True, frame[3:-1], latency)
+            latencyUs = int(latency*1000000)
+            self.stat.responses = self.stat.responses + 1
+            self.stat.latencyTotalUs = self.stat.latencyTotalUs + latencyUs
+            self.stat.latencyMaxUs = max(self.stat.latencyMaxUs, latencyUs)
+            index = frameEnd
+
+        return data[index:]
+
+    def __checkTimeouts(self):
+        now = time.time()
+        for (sequence, (_, sendTime, _)) in self.inflight.items():
+            if (now - sendTime > self.RESPONSE_TIMEOUT):
+                self.stat.timeouts = self.stat.timeouts + 1
+                self.__retransmit(sequence)
+
+class PageCache:
+    '''
+    Copies of the target memory pages, the least recently used page is evicted 
+    when the cache is full. Regions of the memory map have own policies: the 
+    peripheral registers are never cached, the ROM is never invalidated
+    '''
+    PAGE_SIZE = 256
+    PAGES = 4096
+
+    POLICY_NEVER   = "never"
+    POLICY_DEFAULT = "default"
+    POLICY_ALWAYS  = "always"
+    POLICIES = [POLICY_NEVER, POLICY_DEFAULT, POLICY_ALWAYS]
+
+    # SAMA5D3x memory map, see applets/src/board_sama5d3x.h
+    # Tuples (start address, size, policy)
+    REGIONS = [
+        # IROM_ADDR
+        (0x00100000, 0x20000, POLICY_ALWAYS),
+        # SMD_ADDR, UDPHS_RAM_ADDR, UHP_OHCI_ADDR, UHP_EHCI_ADDR, AXIMX_ADDR, DAP_ADDR
+        (0x00400000, 0x600000, POLICY_NEVER),
+        # Peripherals, HSMCI0 to PIT and the system controller
+        (0xF0000000, 0x10000000, POLICY_NEVER),
+    ]
+
+    def __init__(self, pages=PAGES, regions=REGIONS):
+        self.pages = pages
+        self.regions = list(regions)
+        self.cache = collections.OrderedDict()
+
+    def addRegion(self, address, size, policy):
+        '''
+        The last added region wins if the regions overlap
+        '''
+        self.regions.append((address, size, policy))
+        self.invalidate(address, size, True)
+
+    def policy(self, address):
+        result = self.POLICY_DEFAULT
+        for (start, size, policy) in self.regions:
+            if ((address >= start) and (address < start + size)):
+                result = policy
+        return result
+
+    def isCacheable(self, pageAddress):
+        return (self.policy(pageAddress) != self.POLICY_NEVER)
+
+    def get(self, pageAddress):
+        '''
+        Returns the page or None
+        '''
+        page = self.cache.pop(pageAddress, None)
+        if (page != None):
+            self.cache[pageAddress] = page
+        return page
+
+    def contains(self, pageAddress):
+        return (pageAddress in self.cache)
+
+    def put(self, pageAddress, page):
+        '''
+        Returns number of evicted pages
+        '''
+        self.cache.pop(pageAddress, None)
+        self.cache[pageAddress] = page
+        evicted = 0
+        while (len(self.cache) > self.pages):
+            self.cache.popitem(last=False)
+            evicted = evicted + 1
+        return evicted
+
+    def invalidate(self, address=0, size=None, force=False):
+        '''
+        Drop the pages of the range, all pages if size is None
+        Pages of the POLICY_ALWAYS regions are kept unless force is set
+        '''
+        for pageAddress in self.cache.keys():
+            if ((size != None) and ((pageAddress + self.PAGE_SIZE <= address) or (pageAddress >= address + size))):
+                continue
+            if ((not force) and (self.policy(pageAddress) == self.POLICY_ALWAYS)):
+                continue
+            del self.cache[pageAddress]
+
+class OutputReader(threading.Thread):
+    '''
+    Drain the output of the running code while there is no transaction. The output
+    is kept in a ring buffer, the oldest bytes are dropped when it is full. The listeners 
+    get complete lines and the raw listeners get every chunk, for example a demultiplexer 
+    of a protocol
+    '''
+    BUFFER_SIZE = 64*1024
+    # Recent lines for waitLine()
+    LINES = 1024
+    POLL_PERIOD = 0.01
+
+    def __init__(self, at91, device, bufferSize=BUFFER_SIZE):
+        super(OutputReader, self).__init__()
+        self.daemon = True
+        # The log of the device collects the records of the threads named by the device
+        self.name = device + ":output"
+        self.at91 = at91
+        self.bufferSize = bufferSize
+        # Ring buffer, the counters of the written and the read bytes never wrap
+        self.buffer = bytearray(bufferSize)
+        self.writeCount = 0
+        self.readCount = 0
+        self.partialLine = ""
+        self.lines = collections.deque(maxlen=self.LINES)
+        self.lineCount = 0
+        self.listeners = []
+        self.rawListeners = []
+        self.condition = threading.Condition()
+        self.exitEvent = threading.Event()
+        self.stat = StatManager.Block(device)
+        self.stat.addFieldsInt(["bytes", "lines", "dropped", "listenerFailed"])
+        statManager.addCounters("OutputReader", self.stat)
+
+    def run(self):
+        while (not self.exitEvent.wait(self.POLL_PERIOD)):
+            data = self.at91.readOutput()
+            if (len(data) > 0):
+                self.feed(data)
+
+    def cancel(self):
+        self.exitEvent.set()
+
+    def feed(self, data):
+        self.stat.bytes = self.stat.bytes + len(data)
+        self.__dispatch(self.rawListeners, data)
+
+        self.condition.acquire()
+        kept = data[-self.bufferSize:]
+        self.writeCount = self.writeCount + len(data) - len(kept)
+        self.__copyIn(kept)
+        dropped = self.writeCount - self.readCount - self.bufferSize
+        if (dropped > 0):
+            self.stat.dropped = self.stat.dropped + dropped
+            self.readCount = self.readCount + dropped
+        lines = (self.partialLine + data).split("\n")
+        self.partialLine = lines.pop()
+        lines = [line.rstrip("\r") for line in lines]
+        self.__addLines(lines)
+        self.condition.release()
+
+        for line in lines:
+            self.__dispatch(self.listeners, line)
+
+    def __copyIn(self, data):
+        '''
+        Copy the data to the write position of the ring buffer, the data is not 
+        larger than the buffer
+        '''
+        offset = self.writeCount % self.bufferSize
+        head = min(len(data), self.bufferSize - offset)
+        self.buffer[offset:offset + head] = data[:head]
+        self.buffer[:len(data) - head] = data[head:]
+        self.writeCount = self.writeCount + len(data)
+
+    def __copyOut(self, size):
+        offset = self.readCount % self.bufferSize
+        head = min(size, self.bufferSize - offset)
+        data = self.buffer[offset:offset + head] + self.buffer[:size - head]
+        self.readCount = self.readCount + size
+        return str(data)
+
+    def __addLines(self, lines):
+        if (len(lines) > 0):
+            self.lines.extend(lines)
+            self.lineCount = self.lineCount + len(lines)
+            self.stat.lines = self.stat.lines + len(lines)
+        self.condition.notifyAll()
+
+    def __dispatch(self, listeners, data):
+        for listener in listeners:
+            try:
+                listener.callback(data)
+            except Exception:
+                self.stat.listenerFailed = self.stat.listenerFailed + 1
+                logger.error("Listener {0} failed: {1}".format(listener.name, traceback.format_exc()))
+
+    def addListener(self, listener, raw=False):
+        '''
+        @param listener:NamedListener, the callback gets a line or a chunk of the output
+        if raw is set. The callbacks are called by the reader thread
+        '''
+        if (raw):
+            self.rawListeners = self.rawListeners + [listener]
+        else:
+            self.listeners = self.listeners + [listener]
+
+    def removeListener(self, name):
+        self.listeners = [l for l in self.listeners if (l.name != name)]
+        self.rawListeners = [l for l in self.rawListeners if (l.name != name)]
+
+    def read(self, size=None, timeout=0):
+        '''
+        Returns the oldest data from the ring buffer, all data if size is None
+        Waits up to timeout seconds if the buffer is empty
+        '''
+        deadline = time.time() + timeout
+        self.condition.acquire()
+        while ((self.writeCount == self.readCount) and (time.time() < deadline)):
+            self.condition.wait(deadline - time.time())
+        available = self.writeCount - self.readCount
+        if ((size == None) or (size > available)):
+            size = available
+        data = self.__copyOut(size)
+        self.condition.release()
+        return data
+
+    def getLineNumber(self):
+        '''
+        Number of the next line, waitLine() can look for a line starting from it
+        '''
+        return self.lineCount
+
+    def waitLine(self, pattern, timeout, since=None):
+        '''
+        Wait for a line which matches the regular expression, the lines which arrive 
+        after the call are checked if since is not set
+        Returns tuple (result, line)
+        '''
+        if (since == None):
+            since = self.lineCount
+        deadline = time.time() + timeout
+        self.condition.acquire()
+        while (True):
+            first = self.lineCount - len(self.lines)
+            for index in range(max(since, first), self.lineCount):
+                if (re.search(pattern, self.lines[index - first])):
+                    self.condition.release()
+                    return (True, self.lines[index - first])
+            since = self.lineCount
+            remaining = deadline - time.time()
+            if (remaining <= 0):
+                break
+            self.condition.wait(remaining)
+        self.condition.release()
+        return (False, None)
+
+
 class AT91(threading.Thread):
     
     '''
     Keep connection alive, polls the connection while idle and makes sure that SAM-BA still responds 
     '''        
-    def __init__(self, device):
+
+    # Dumps of this size and larger use SAM-BA receive file command 'R'
+    BULK_READ_THRESHOLD = 64
+
+    # Poll the connection if there was no successful transaction for this long (seconds)
+    CONNECTION_IDLE_TIMEOUT = 1.0
+    # Poll period while the connection is down doubles up to the maximum
+    CONNECTION_BACKOFF_MIN = 0.05
+    CONNECTION_BACKOFF_MAX = 2.0
+
+    # Differential upload compares the image with the target memory in blocks of this size
+    DIFF_BLOCK_SIZE = 4096
+    APPLET_RESPONSE_TIMEOUT = 0.5
+    # Number of attempts to send a frame of CMD_READ_BLOCK or CMD_WRITE_BLOCK 
+    APPLET_BLOCK_ATTEMPTS = 3
+    # SAM-BA monitor rate, the applet can switch to a faster rate
+    MONITOR_BAUDRATE = 115200
+    # The applet returns to the previous rate if there is no command at the new rate for this long
+    BAUDRATE_CONFIRM_TIMEOUT = 0.5
+    # Pings which check the new rate, all of them fit the confirmation timeout
+    BAUDRATE_PING_ATTEMPTS = 3
+    BAUDRATE_PING_TIMEOUT = 0.1
+    # Time the applet needs to switch the rate
+    BAUDRATE_SWITCH_TIME = 0.01
+    # Lower estimate of the applet decompression and CRC32 speed (bytes/s)
+    APPLET_DECOMPRESS_RATE = 1024*1024
+    # Lower estimate of the speed of the serial flash read and CRC32 by the applet (bytes/s)
+    APPLET_FLASH_READ_RATE = 512*1024
+    # Verification narrows a mismatch down to blocks of this size
+    VERIFY_BLOCK_SIZE = 256
+    # Attempts to reach the code which has just started, the first frame can be lost while the code boots
+    VERIFY_ATTEMPTS = 3
+    # Lower estimate of the applet memory test speed for every pass over the memory (bytes/s)
+    APPLET_MEMTEST_RATE = 16*1024*1024
+    # Number of passes of the memory tests, the fill and the verify pass once
+    MEMTEST_PASSES = {CmdLoop.MEMTEST_PATTERN : 4, CmdLoop.MEMTEST_FILL : 1, CmdLoop.MEMTEST_VERIFY : 1}
+
+    def __init__(self, device, idleTimeout=CONNECTION_IDLE_TIMEOUT):
         super(AT91, self).__init__()
         self.lock = threading.Lock()
         self.exitFlag = False
         self.isConnected = False
         self.skipConnectionPoll = False
-        self.tty = SerialConnection(device, 115200)
-        self.stat = StatManager.Block("")
-        self.stat.addFieldsInt(["dump", "read", "write", "failedRead", "failedWrite", "executeCode", "checkFailed", "check", "initOk", "init4", "initBadRsp", "initNoRsp"])
+        self.idleTimeout = idleTimeout
+        self.lastActivity = 0
+        self.lastCheck = 0
+        self.backoff = self.CONNECTION_BACKOFF_MIN
+        self.wakeup = threading.Event()
+        self.appletRunning = False
+        # Tuples (address, size) of the memory of the code started by executeCode, None if not known
+        self.runningCode = None
+        # Tuples (block checksums, started) of the images loaded by executeCode, the key is the load address
+        self.imageCache = {}
+        # Pages of the target memory for dump and read, see enablePageCache()
+        self.pageCache = None
+        self.tty = SerialConnection(device, self.MONITOR_BAUDRATE)
+        self.xmodem = XModem(self.tty)
+        self.cmdLoop = CmdLoop(self)
+        self.pipeline = CmdPipeline(self.tty)
+        self.stat = StatManager.Block(device)
+        self.stat.addFieldsInt(["dump", "read", "write", "failedRead", "failedWrite", "executeCode", "checkFailed", "check", "initOk", "init4", "initBadRsp", "initNoRsp", "bulkRead", "bulkReadFailed", "bulkWrite", "bulkWriteFailed", "checkBusy", 
+                                "diffBlocksSent", "diffBlocksSkipped", "diffQuery", "diffQueryFailed", "diffCacheHit", "diffCacheStale",
+                                "appletRead", "appletWrite", "appletBlockFailed", "upload", "compressedUpload", "compressedFailed",
+                                "baudrateSet", "baudrateFailed", "baudrateRecovered",
+                                "cacheHit", "cacheMiss", "cacheBypass", "cacheEvicted", "cacheInvalidated", "batch",
+                                "memtest", "memtestFailed", "memtestErrors", "verify", "verifyFailed", "verifyQuery", "zeroFilled"])
+        self.stat.addHistograms(["read", "write", "dump", "executeCode", "upload", "batch", "memtest"])
         statManager.addCounters("AT91", self.stat)
+        self.outputReader = OutputReader(self, device)
         
     def run(self):
         '''
-        Check conneciton periodically
+        Check conneciton when idle
+        Any successful transaction proves that the connection is alive, 
+        the poll is sent only if the link was idle for idleTimeout seconds. 
+        While the connection is down the poll period grows exponentially
         '''
+        self.outputReader.start()
         while (not self.exitFlag):
-            
-            if (not self.skipConnectionPoll):
-                self.stat.check = self.stat.check + 1
-            
-                self.lock.acquire()
-                self.__checkConnection()
-                self.lock.release()
-            
-            time.sleep(0.05)
+
+            if (self.isConnected):
+                nextCheck = self.lastActivity + self.idleTimeout
+            else:
+                nextCheck = self.lastCheck + self.backoff
+            delay = nextCheck - time.time()
+            if (self.skipConnectionPoll):
+                delay = self.idleTimeout
+            if (delay > 0):
+                self.wakeup.wait(delay)
+                self.wakeup.clear()
+                continue
+
+            # Never wait for a transfer in progress
+            if (not self.lock.acquire(False)):
+                self.stat.checkBusy = self.stat.checkBusy + 1
+                self.wakeup.wait(self.CONNECTION_BACKOFF_MIN)
+                continue
+
+            self.stat.check = self.stat.check + 1
+            isConnected = self.__checkConnection()
+            self.lock.release()
+
+            self.lastCheck = time.time()
+            if (isConnected):
+                self.backoff = self.CONNECTION_BACKOFF_MIN
+            else:
+                self.backoff = min(2*self.backoff, self.CONNECTION_BACKOFF_MAX)
+
+        self.outputReader.join()
             
     def __checkConnection(self):
         isConnected = self.__isConnected()
         if (not isConnected):
             self.stat.checkFailed = self.stat.checkFailed + 1
             self.tty.connect()
+        else:
+            self.lastActivity = time.time()
         self.__updateConnectionStatus(isConnected)
+        return isConnected
+
+    def __transactionDone(self, result):
+        '''
+        Successful transaction postpones the next connection poll
+        '''
+        if (result):
+            self.lastActivity = time.time()
+            self.__updateConnectionStatus(True)
+
+    def setAppletRunning(self, isRunning):
+        '''
+        SAM-BA monitor does not answer while the applet is running
+        '''
+        self.appletRunning = isRunning
+        self.skipConnectionPoll = isRunning
+        if (not isRunning):
+            self.runningCode = None
+        # The applet restores the monitor rate after the response to CMD_EXIT
+        if ((not isRunning) and (self.tty.getRate() != self.MONITOR_BAUDRATE)):
+            self.tty.flush()
+            time.sleep(self.tty.transferTime(CmdLoop.EXIT_RESPONSE_SIZE) + self.BAUDRATE_SWITCH_TIME)
+            self.tty.setRate(self.MONITOR_BAUDRATE)
 
     def connectionPollEnable(self, enable):
         '''
@@ -754,15 +2336,35 @@ class AT91(threading.Thread):
         '''
         self.skipConnectionPoll = not enable
 
-    def getOutput(self, expectedLength=80):
+    def getOutput(self, expectedLength=80, timeout=0):
+        '''
+        The output collected by the reader thread, see getOutputReader()
+        '''
+        if (self.outputReader.isAlive()):
+            return (True, self.outputReader.read(expectedLength, timeout))
+
         self.lock.acquire()
         (result, s) = self.tty.read(expectedLength)
         self.lock.release()
         
         return (result, s)
 
+    def readOutput(self):
+        '''
+        Returns the data waiting in the tty, nothing if a transaction is in progress
+        '''
+        if (not self.lock.acquire(False)):
+            return ""
+        (_, s) = self.tty.readAvailable()
+        self.lock.release()
+        return s
+
+    def getOutputReader(self):
+        return self.outputReader
+
     def sendData(self, data):
         self.lock.acquire()
+        self.tty.traceMark("sendData")
         result = self.tty.write(data)
         self.lock.release()
         
@@ -772,6 +2374,10 @@ class AT91(threading.Thread):
         loopsTotal = 10
         loops = 0
         self.isConnected = False 
+        # Poll the connection now
+        self.backoff = self.CONNECTION_BACKOFF_MIN
+        self.lastCheck = 0
+        self.wakeup.set()
         while (True):
 
             if (self.isConnected):
@@ -785,6 +2391,7 @@ class AT91(threading.Thread):
         return self.isConnected
         
     def __isConnected(self):
+        self.tty.traceMark("check")
         while (True):
             INIT_COMMAND = "N#"
             result = self.tty.write(INIT_COMMAND)
@@ -832,6 +2439,10 @@ class AT91(threading.Thread):
     def __updateConnectionStatus(self, isConnected):
         if (self.isConnected != isConnected):
             self.isConnected = isConnected
+            # The board could be reset, the memory content is not known anymore
+            if (not isConnected):
+                self.imageCache = {}
+                self.__invalidatePageCache()
             self.__printConnectionStatus()
 
     def __printConnectionStatus(self):
@@ -845,66 +2456,881 @@ class AT91(threading.Thread):
             
     def cancel(self):
         self.exitFlag = True
+        self.wakeup.set()
+        self.outputReader.cancel()
+        self.stopTrace()
         
-    def executeCode(self, address, entryPoint, code, timeout=0.0):
+    def executeCode(self, address, entryPoint, code, timeout=0.0, differential=False, compressed=False, verify=False):
         '''
         Load binary code to the specified location, execute, wait for completion
+        Differential upload skips blocks which are already in the target memory. 
+        The running applet reports checksums of the memory, if the applet does not 
+        answer the checksums of the last image loaded to the address are used unless
+        the image was started
+        Compressed upload requires the running applet, the applet decompresses the image
+        Verification compares CRC32 of the memory and of the code. The image loaded by the 
+        running applet is verified before the start, the image loaded by SAM-BA monitor is 
+        verified by the started code before it modifies own variables, the first command 
+        the code gets is the checksum query
+        '''
+        return self.executeSegments([(address, code, len(code))], entryPoint, timeout, differential, compressed, verify)
+
+    def executeSegments(self, segments, entryPoint, timeout=0.0, differential=False, compressed=False, verify=False):
+        '''
+        Load the segments, for example PT_LOAD segments of ELF file, and execute the code 
+        from the entry point, see executeCode()
+        @param segments:list of tuples (address, data, size of the segment in memory). The 
+        running applet fills the end of the segment after the data with zeros, if the applet
+        is not running or the range overlaps the applet the zeros are uploaded
         '''
-        s2 = "G{0}#".format(buildhexstring(address))
+        s2 = "G{0}#".format(buildhexstring(entryPoint))
         
         self.stat.executeCode = self.stat.executeCode + 1
+        startTime = time.time()
         self.lock.acquire()
+        self.tty.traceMark("executeCode")
         
-        # copy the code 
-        words = len(code)/4
-        index  = 0
-        while (words > 0):
-            
-            data = code[index:index+4]
-            value = converBinToInt(data)
-            self.__write(address, value)
+        images = []
+        for (address, data, memorySize) in segments:
+            tail = max(memorySize - len(data), 0)
+            if ((tail > 0) and (not self.__zeroFill(address + len(data), tail))):
+                data = data + "\0"*tail
+                tail = 0
+            targetChecksums = None
+            if (differential):
+                targetChecksums = self.__targetChecksums(address, len(data))
+            images.append((address, data, tail, self.__imageChecksums(data), targetChecksums))
 
-            address = address + 4
-            words = words - 1
-            index = index + 4
+        uploadData = self.__uploadData
+        if (compressed and self.appletRunning):
+            uploadData = self.__appletWriteCompressed
+        elif (compressed):
+            logger.warning("The applet is not running, load the code uncompressed")
+        # SAM-BA monitor is required to upload the data and to start the code 
+        if ((uploadData == self.__uploadData) and self.appletRunning):
+            self.__exitApplet()
+
+        # copy the code 
+        result = True
+        for (address, data, _, checksums, targetChecksums) in images:
+            uploaded = self.__uploadBlocks(address, data, checksums, targetChecksums, uploadData)
+            self.__updateImageCache(address, len(data), checksums if uploaded else None)
+            result = uploaded and result
+        # The code can modify any memory
+        self.__invalidatePageCache()
+        verifyStarted = verify
+        if (self.appletRunning):
+            if (verify and result):
+                result = self.__verifySegments(images)
+                verifyStarted = False
+            self.__exitApplet()
         
         self.tty.swFlush()
         # execute the code
-        self.tty.write(s2)
+        result = self.tty.write(s2) and result
+        self.setAppletRunning(True)
+        self.runningCode = [(address, len(data) + tail) for (address, data, tail, _, _) in images]
+        # The code modifies own variables and stack, the cached checksums are not trusted
+        for (address, _, _, _, _) in images:
+            self.__markImageStarted(address)
         
         if (timeout > 0):
             time.sleep(timeout)
+
+        if (verifyStarted and result):
+            result = self.__verifySegments(images, self.VERIFY_ATTEMPTS)
         
         self.lock.release()
+        self.stat.addLatency("executeCode", time.time() - startTime)
 
-    def dump(self, address, size):
+        return result
+
+    def __zeroFill(self, address, size):
         '''
-        Read memory from the device
+        Ask the running applet to fill the memory with zeros, the applet must not clear 
+        own variables. The applet left running by the previous session is not known
+        Returns False if the range overlaps the applet, the applet is not running or failed
+        '''
+        if ((not self.appletRunning) or (self.runningCode == None)):
+            return False
+        for (start, length) in self.runningCode:
+            if ((start < address + size) and (address < start + length)):
+                return False
+        (result, _) = self.__memtest(CmdLoop.MEMTEST_FILL, address, size, 0)
+        if (result):
+            self.stat.zeroFilled = self.stat.zeroFilled + size
+        return result
+
+    def __verifySegments(self, images, attempts=1):
+        '''
+        The zeros filled by the applet are verified too, CRC32 does not cost the transfer
+        '''
+        result = True
+        for (address, data, tail, _, _) in images:
+            (verified, _) = self.__verify(address, data + "\0"*tail, attempts)
+            result = verified and result
+        return result
+
+    def __imageChecksums(self, code):
+        '''
+        CRC32 of every DIFF_BLOCK_SIZE block of the image, the last block can be shorter
+        '''
+        blockSize = self.DIFF_BLOCK_SIZE
+        return [binascii.crc32(code[i:i+blockSize]) & 0xFFFFFFFF for i in range(0, len(code), blockSize)]
+
+    def __targetChecksums(self, address, size):
+        '''
+        Get checksums of the memory blocks from the running applet or from the image cache
+        Returns list of checksums or None if not known
+        '''
+        # The applet could be left running by the previous session
+        if ((not self.appletRunning) and (not self.isConnected)):
+            (result, _, _) = self.__appletCommand(CmdLoop.CMD_PING)
+            if (not result):
+                # SAM-BA monitor skips the frame of the ping up to the next '#'
+                self.__checkConnection()
+            self.appletRunning = result
+
+        if (self.appletRunning):
+            checksums = self.__queryChecksums(address, size)
+            if (checksums != None):
+                return checksums
+
+        (checksums, started) = self.imageCache.get(address, (None, False))
+        if (started):
+            logger.info("The code at {0} was started after the upload, all blocks are loaded".format(buildhexstring(address)))
+            self.stat.diffCacheStale = self.stat.diffCacheStale + 1
+            checksums = None
+        elif (checksums != None):
+            self.stat.diffCacheHit = self.stat.diffCacheHit + 1
+        return checksums
+
+    def __exitApplet(self):
+        '''
+        Return to SAM-BA monitor and check that the monitor answers
+        '''
+        self.__appletCommand(CmdLoop.CMD_EXIT)
+        self.setAppletRunning(False)
+        self.tty.swFlush()
+        self.__checkConnection()
+
+    def __queryChecksums(self, address, size):
+        '''
+        Ask the applet for CRC32 of the memory blocks, the blocks are the same as in __imageChecksums()
+        Returns list of checksums or None if the applet does not answer
+        '''
+        blockSize = self.DIFF_BLOCK_SIZE
+        commands = []
+        while (size > 0):
+            blocks = min(size / blockSize, CmdLoop.CHECKSUM_BLOCKS_MAX)
+            if (blocks == 0):
+                # The last short block
+                (blocks, blockSize) = (1, size)
+            commands.append((CmdLoop.CMD_CHECKSUM, map(ord, struct.pack("<IIB", address, blockSize, blocks))))
+            address = address + blocks*blockSize
+            size = size - blocks*blockSize
+        
+        # All queries are in flight together
+        self.stat.diffQuery = self.stat.diffQuery + len(commands)
+        checksums = []
+        for ((result, response, _), (_, payload)) in zip(self.pipeline.execute(commands), commands):
+            blocks = payload[-1]
+            if ((not result) or (len(response) != 4*blocks)):
+                self.stat.diffQueryFailed = self.stat.diffQueryFailed + 1
+                return None
+            checksums.extend(struct.unpack("<{0}I".format(blocks), "".join(map(chr, response))))
+
+        return checksums
+
+    def __appletCommand(self, command, payload=None, data="", timeout=APPLET_RESPONSE_TIMEOUT):
+        '''
+        Send command to the applet and wait for the response, debug output of the applet is skipped
+        @param data:raw data which follows the command
+        Returns tuple (result, payload of the response, data received after the response)
+        '''
+        frame = self.cmdLoop.buildCommand(command, payload)
+        startTime = time.time()
+        result = self.tty.write("".join(map(chr, frame)) + data)
+        s = ""
+        deadline = startTime + timeout + self.tty.transferTime(len(data))
+        while (result and (time.time() < deadline)):
+            (result, d) = self.tty.read(256)
+            s = s + d
+            (found, response, frameEnd) = self.cmdLoop.findResponse(s, command)
+            if (found):
+                self.stat.addLatency("cmd_" + self.cmdLoop.commandName(command), time.time() - startTime)
+                return (True, response, s[frameEnd:])
+        
+        return (False, None, "")
+
+    def __appletReadBlock(self, address, buffer):
+        '''
+        Read memory with CMD_READ_BLOCK, the applet sends raw data after the response
+        Returns tuple (result, number of bytes read)
+        '''
+        view = memoryview(buffer)
+        count = 0
+        while (count < len(buffer)):
+            size = min(len(buffer) - count, CmdLoop.BLOCK_FRAME_SIZE)
+            payload = self.cmdLoop.readBlockPayload(address + count, size)
+            block = view[count:count+size]
+            for _ in range(self.APPLET_BLOCK_ATTEMPTS):
+                self.stat.appletRead = self.stat.appletRead + 1
+                (result, response, data) = self.__appletCommand(CmdLoop.CMD_READ_BLOCK, payload)
+                if (result):
+                    (_, crc) = self.cmdLoop.parseReadBlockResponse(response)
+                    # The data received with the response is copied, the rest is received to the buffer
+                    data = data[:size]
+                    block[:len(data)] = data
+                    (result, _) = self.tty.readAllInto(block[len(data):], self.APPLET_RESPONSE_TIMEOUT + self.tty.transferTime(size))
+                    result = result and ((binascii.crc32(block) & 0xFFFFFFFF) == crc)
+                if (result):
+                    break
+                self.stat.appletBlockFailed = self.stat.appletBlockFailed + 1
+                self.tty.swFlush()
+            if (not result):
+                break
+            count = count + size
+
+        return (result, count)
+
+    def __appletWriteBlock(self, address, data):
+        '''
+        Write memory with CMD_WRITE_BLOCK, the raw data follows the command
+        The applet answers when all data is in the memory
+        '''
+        result = True
+        for offset in range(0, len(data), CmdLoop.BLOCK_FRAME_SIZE):
+            frame = data[offset:offset+CmdLoop.BLOCK_FRAME_SIZE]
+            payload = self.cmdLoop.writeBlockPayload(address + offset, frame)
+            for _ in range(self.APPLET_BLOCK_ATTEMPTS):
+                self.stat.appletWrite = self.stat.appletWrite + 1
+                (result, response, _) = self.__appletCommand(CmdLoop.CMD_WRITE_BLOCK, payload, frame)
+                if (result):
+                    (status, _) = self.cmdLoop.parseWriteBlockResponse(response)
+                    result = (status == CmdLoop.BLOCK_STATUS_OK)
+                if (result):
+                    break
+                self.stat.appletBlockFailed = self.stat.appletBlockFailed + 1
+                self.tty.swFlush()
+            if (not result):
+                break
+
+        return result
+
+    def __appletWriteCompressed(self, address, data):
+        '''
+        Load LZ4 compressed data to the end of the destination, the applet decompresses 
+        it in place. The compressed data never goes past the destination: if it does not 
+        fit at the in place offset, the head of the data is compressed and the tail is 
+        written as is after the head is decompressed. The data which does not compress 
+        is written as is
+        '''
+        (compressed, offset) = compressImage(data)
+        size = len(data)
+        overlap = offset + len(compressed) - size
+        if (overlap > 0):
+            size = size - overlap
+            (compressed, offset) = compressImage(data[:size])
+        if ((len(compressed) >= size) or (offset + len(compressed) > len(data))):
+            return self.__appletWriteBlock(address, data)
+
+        self.stat.compressedUpload = self.stat.compressedUpload + 1
+        logger.debug("Compressed {0} bytes to {1} bytes".format(size, len(compressed)))
+        result = self.__appletWriteBlock(address + offset, compressed)
+        if (result):
+            payload = self.cmdLoop.decompressPayload(address + offset, len(compressed), address, size)
+            timeout = self.APPLET_RESPONSE_TIMEOUT + float(size)/self.APPLET_DECOMPRESS_RATE
+            (result, response, _) = self.__appletCommand(CmdLoop.CMD_DECOMPRESS, payload, timeout=timeout)
+        if (result):
+            (status, decompressedSize, crc) = self.cmdLoop.parseDecompressResponse(response)
+            result = ((status == CmdLoop.DECOMPRESS_STATUS_OK) and (decompressedSize == size) and (crc == (binascii.crc32(data[:size]) & 0xFFFFFFFF)))
+        if (not result):
+            self.stat.compressedFailed = self.stat.compressedFailed + 1
+            logger.error("Failed to decompress {0} bytes at {1}".format(size, buildhexstring(address, 8)))
+        elif (size < len(data)):
+            result = self.__appletWriteBlock(address + size, data[size:])
+
+        return result
+
+    def __uploadBlocks(self, address, code, checksums, targetChecksums, uploadData):
+        '''
+        Write the image blocks which differ from the target memory, all blocks if targetChecksums is None
+        Consecutive blocks are sent in one transfer
+        @param uploadData:function which writes the data to the memory 
+        '''
+        blockSize = self.DIFF_BLOCK_SIZE
+        if (targetChecksums == None):
+            targetChecksums = []
+        changed = [((i >= len(targetChecksums)) or (checksums[i] != targetChecksums[i])) for i in range(len(checksums))]
+
+        result = True
+        index = 0
+        while (index < len(changed)):
+            if (not changed[index]):
+                self.stat.diffBlocksSkipped = self.stat.diffBlocksSkipped + 1
+                index = index + 1
+                continue
+            end = index + 1
+            while ((end < len(changed)) and changed[end]):
+                end = end + 1
+            self.stat.diffBlocksSent = self.stat.diffBlocksSent + (end - index)
+            result = uploadData(address + index*blockSize, code[index*blockSize:end*blockSize]) and result
+            index = end
+            
+        return result
+
+    def __uploadData(self, address, code):
+        '''
+        Write the data using send file command, fallback to the word by word write
+        '''
+        words = len(code)/4
+        index  = 0
+        result = self.__writeBlock(address, code)
+        if (result):
+            words = 0
+        else:
+            # Fallback to the word by word write
+            self.stat.bulkWriteFailed = self.stat.bulkWriteFailed + 1
+            self.tty.swFlush()
+            result = True
+
+        self.tty.beginBatch()
+        while (words > 0):
+            
+            data = code[index:index+4]
+            value = converBinToInt(data)
+            self.__write(address, value)
+
+            address = address + 4
+            words = words - 1
+            index = index + 4
+        result = self.tty.commit() and result
+
+        return result
+
+    def __updateImageCache(self, address, size, checksums):
+        '''
+        Forget the images which overlap the memory range, remember the new one
+        '''
+        for (imageAddress, (imageChecksums, _)) in self.imageCache.items():
+            imageSize = len(imageChecksums)*self.DIFF_BLOCK_SIZE
+            if ((imageAddress < address + size) and (address < imageAddress + imageSize)):
+                del self.imageCache[imageAddress]
+        if (checksums != None):
+            self.imageCache[address] = (checksums, False)
+
+    def __markImageStarted(self, address):
+        '''
+        The memory of the started image can differ from the checksums, only the 
+        applet can tell which blocks are still the same
+        '''
+        if (address in self.imageCache):
+            (checksums, _) = self.imageCache[address]
+            self.imageCache[address] = (checksums, True)
+
+    def dump(self, address, size):
+        '''
+        Read memory from the device
+        '''
+        buffer = bytearray(size)
+        (result, count) = self.dumpInto(address, memoryview(buffer))
+        
+        return (result, str(buffer[:count]))
+
+    def dumpInto(self, address, buffer):
+        '''
+        Read len(buffer) bytes of memory from the device into the preallocated buffer
+        Returns tuple (result, number of bytes read)
         '''
-          
         self.stat.dump = self.stat.dump + 1
-        words = size/4
+        startTime = time.time()
         
-        data = ""
         self.lock.acquire()
+        self.tty.traceMark("dump")
+
+        if (self.pageCache != None):
+            (result, count) = self.__cachedReadInto(address, buffer)
+        else:
+            (result, count) = self.__readInto(address, buffer)
+        
+        self.tty.swFlush()
+        self.__transactionDone(result and (count > 0))
+        self.lock.release()
+        self.stat.addLatency("dump", time.time() - startTime)
+        
+        return (result, count)
+
+    def __readInto(self, address, buffer):
+        '''
+        Read the memory using the fastest available method
+        '''
+        size = len(buffer)
+        words = size/4
+        count = 0
+        result = False
+
+        if (self.appletRunning):
+            # SAM-BA monitor does not answer while the applet is running
+            (result, count) = self.__appletReadBlock(address, buffer)
+            words = 0
+        elif (size >= self.BULK_READ_THRESHOLD):
+            (result, count) = self.__readBlock(address, buffer)
+            if (result):
+                words = 0
+            else:
+                # Fallback to the word by word read
+                self.stat.bulkReadFailed = self.stat.bulkReadFailed + 1
+                self.tty.swFlush()
+                count = 0
         
+        # Words are received straight to the buffer
+        view = memoryview(buffer)
         while (words > 0):
-            (result, d) = self.__read(address)
+            (result, received) = self.__readWordInto(address, view[count:count+4])
             words = words - 1
             address = address + 4
-            if (result and (len(d)> 0)):
-                data = data + d
+            if (result and (received > 0)):
+                count = count + received
             else:
                 break
         
+        return (result, count)
+
+    def __cachedReadInto(self, address, buffer):
+        '''
+        Copy the cached pages, read the missing pages in one transaction
+        Only the requested bytes of the not cacheable pages are read, reading 
+        a peripheral register can have side effects
+        '''
+        pageSize = PageCache.PAGE_SIZE
+        buffer = memoryview(buffer)
+        size = len(buffer)
+        count = 0
+        result = True
+        while (result and (count < size)):
+            pageAddress = (address + count) - (address + count) % pageSize
+            offset = address + count - pageAddress
+            page = self.pageCache.get(pageAddress)
+            if (page != None):
+                self.stat.cacheHit = self.stat.cacheHit + 1
+                length = min(pageSize - offset, size - count)
+                buffer[count:count+length] = page[offset:offset+length]
+                count = count + length
+                continue
+
+            # Consecutive missing pages of the same policy
+            cacheable = self.pageCache.isCacheable(pageAddress)
+            end = pageAddress + pageSize
+            while ((end < address + size) and (not self.pageCache.contains(end)) and (self.pageCache.isCacheable(end) == cacheable)):
+                end = end + pageSize
+            length = min(end - (address + count), size - count)
+
+            if (not cacheable):
+                self.stat.cacheBypass = self.stat.cacheBypass + 1
+                (result, n) = self.__readInto(address + count, buffer[count:count+length])
+                result = result and (n == length)
+                count = count + n
+                continue
+
+            self.stat.cacheMiss = self.stat.cacheMiss + (end - pageAddress)/pageSize
+            pages = bytearray(end - pageAddress)
+            (result, n) = self.__readInto(pageAddress, memoryview(pages))
+            result = result and (n == len(pages))
+            if (not result):
+                break
+            for i in range(0, len(pages), pageSize):
+                evicted = self.pageCache.put(pageAddress + i, pages[i:i+pageSize])
+                self.stat.cacheEvicted = self.stat.cacheEvicted + evicted
+            buffer[count:count+length] = pages[offset:offset+length]
+            count = count + length
+
+        return (result, count)
+
+    def enablePageCache(self, enable, pages=PageCache.PAGES):
+        '''
+        Keep copies of the memory pages read by dump and read. Write, upload, executeCode 
+        and applet commands invalidate the pages
+        '''
+        self.lock.acquire()
+        if (enable):
+            if (self.pageCache == None):
+                self.pageCache = PageCache(pages)
+        else:
+            self.pageCache = None
+        self.lock.release()
+
+    def getPageCache(self):
+        return self.pageCache
+
+    def __invalidatePageCache(self, address=0, size=None):
+        if (self.pageCache != None):
+            self.stat.cacheInvalidated = self.stat.cacheInvalidated + 1
+            self.pageCache.invalidate(address, size)
+
+    def appletCommands(self, commands, window=None):
+        '''
+        Send the commands to the running applet, up to 'window' commands are in flight
+        @param commands:list of tuples (command, payload)
+        Returns list of tuples (result, payload of the response, latency)
+        '''
+        self.lock.acquire()
+        self.tty.traceMark("appletCommands")
+        # The commands can modify the memory, for example CMD_DECOMPRESS
+        self.__invalidatePageCache()
+        results = self.pipeline.execute(commands, window)
+        self.__transactionDone(any([result for (result, _, _) in results]))
+        self.lock.release()
+
+        return results
+
+    def verify(self, address, data):
+        '''
+        Compare CRC32 of the memory with CRC32 of the data, the memory is not read back
+        Returns tuple (result, regions), see __verify()
+        '''
+        self.lock.acquire()
+        self.tty.traceMark("verify")
+        (result, regions) = self.__verify(address, data)
+        self.tty.swFlush()
+        self.__transactionDone(regions != None)
+        self.lock.release()
+
+        return (result, regions)
+
+    def verifyFlash(self, flashAddress, data):
+        '''
+        Compare CRC32 of the serial flash with CRC32 of the data, the applet reads the flash
+        Returns tuple (result, regions), see __verify()
+        '''
+        self.lock.acquire()
+        self.tty.traceMark("verifyFlash")
+        (result, regions) = self.__verify(flashAddress, data, flash=True)
+        self.tty.swFlush()
+        self.__transactionDone(regions != None)
+        self.lock.release()
+
+        return (result, regions)
+
+    def __rangeChecksums(self, address, size, blocks, attempts=1, flash=False):
+        '''
+        CRC32 of the range split to 'blocks' blocks, the last block can be shorter
+        The range is in the serial flash if flash is set, see CMD_FLASH_CHECKSUM
+        Returns list of tuples (address, size, checksum) or None if the applet does not answer
+        '''
+        blockSize = (size + blocks - 1)/blocks
+        queries = [(address, blockSize, size/blockSize)]
+        if (size % blockSize != 0):
+            queries.append((address + (size/blockSize)*blockSize, size % blockSize, 1))
+        checksums = []
+        for (queryAddress, queryBlockSize, queryBlocks) in queries:
+            if (queryBlocks == 0):
+                continue
+            payload = map(ord, struct.pack("<IIB", queryAddress, queryBlockSize, queryBlocks))
+            if (flash):
+                timeout = self.APPLET_RESPONSE_TIMEOUT + float(queryBlockSize*queryBlocks)/self.APPLET_FLASH_READ_RATE
+            else:
+                timeout = self.APPLET_RESPONSE_TIMEOUT + float(queryBlockSize*queryBlocks)/self.APPLET_DECOMPRESS_RATE
+            for _ in range(attempts):
+                self.stat.verifyQuery = self.stat.verifyQuery + 1
+                if (flash):
+                    (result, response, _) = self.__appletCommand(CmdLoop.CMD_FLASH_CHECKSUM, payload, timeout=timeout)
+                    if (result and (len(response) > 0) and (response[0] != CmdLoop.FLASH_STATUS_OK)):
+                        logger.error("Checksum of the serial flash failed, status {0}".format(response[0]))
+                        return None
+                    # Status of the serial flash
+                    response = response[1:] if result else response
+                else:
+                    (result, response, _) = self.__appletCommand(CmdLoop.CMD_CHECKSUM, payload, timeout=timeout)
+                result = result and (len(response) == 4*queryBlocks)
+                if (result):
+                    break
+                self.tty.swFlush()
+            if (not result):
+                return None
+            crcs = struct.unpack("<{0}I".format(queryBlocks), "".join(map(chr, response)))
+            checksums.extend([(queryAddress + i*queryBlockSize, queryBlockSize, crc) for (i, crc) in enumerate(crcs)])
+
+        return checksums
+
+    def __verify(self, address, data, attempts=1, flash=False):
+        '''
+        Compare CRC32 of the range with the data, the range is in the serial flash if flash 
+        is set. If the checksums differ the range is split to CmdLoop.CHECKSUM_BLOCKS_MAX blocks, the blocks which differ are split again until
+        the blocks are VERIFY_BLOCK_SIZE bytes. The applet is asked once for every level
+        Returns tuple (result, list of tuples (address, size) of the regions which differ), the
+        list is None if the applet does not answer
+        '''
+        self.stat.verify = self.stat.verify + 1
+        memory = "Serial flash" if flash else "Memory"
+        checksums = self.__rangeChecksums(address, len(data), 1, attempts, flash)
+        regions = []
+        while (checksums != None):
+            pending = []
+            for (blockAddress, blockSize, crc) in checksums:
+                offset = blockAddress - address
+                if (crc == (binascii.crc32(data[offset:offset+blockSize]) & 0xFFFFFFFF)):
+                    continue
+                if (blockSize <= self.VERIFY_BLOCK_SIZE):
+                    regions.append((blockAddress, blockSize))
+                else:
+                    pending.append((blockAddress, blockSize))
+            if (len(pending) == 0):
+                break
+            checksums = []
+            for (blockAddress, blockSize) in pending:
+                blocks = min(CmdLoop.CHECKSUM_BLOCKS_MAX, (blockSize + self.VERIFY_BLOCK_SIZE - 1)/self.VERIFY_BLOCK_SIZE)
+                blockChecksums = self.__rangeChecksums(blockAddress, blockSize, blocks, flash=flash)
+                if (blockChecksums == None):
+                    checksums = None
+                    break
+                checksums.extend(blockChecksums)
+
+        if (checksums == None):
+            self.stat.verifyFailed = self.stat.verifyFailed + 1
+            logger.error("The code does not answer the checksum query of {0} at {1}".format(memory.lower(), buildhexstring(address, 8)))
+            return (False, None)
+
+        # Adjacent blocks make one region
+        merged = []
+        for (regionAddress, regionSize) in sorted(regions):
+            if ((len(merged) > 0) and (merged[-1][0] + merged[-1][1] == regionAddress)):
+                merged[-1] = (merged[-1][0], merged[-1][1] + regionSize)
+            else:
+                merged.append((regionAddress, regionSize))
+        for (regionAddress, regionSize) in merged:
+            logger.error("{0} {1}-{2} differs from the image".format(memory, buildhexstring(regionAddress, 8), buildhexstring(regionAddress + regionSize - 1, 8)))
+        if (len(merged) > 0):
+            self.stat.verifyFailed = self.stat.verifyFailed + 1
+
+        return ((len(merged) == 0), merged)
+
+    def memtest(self, test, address, size, pattern=0):
+        '''
+        Run the test of the memory range on the target, see CmdLoop.MEMTEST_xx
+        Returns tuple (result, summary), the summary is the tuple from 
+        CmdLoop.parseMemtestResponse() or None if the applet did not answer
+        '''
+        self.stat.memtest = self.stat.memtest + 1
+        startTime = time.time()
+        self.lock.acquire()
+        self.tty.traceMark("memtest")
+
+        (result, summary) = self.__memtest(test, address, size, pattern)
+
         self.tty.swFlush()
+        self.__transactionDone(summary != None)
         self.lock.release()
+        self.stat.addLatency("memtest", time.time() - startTime)
+
+        return (result, summary)
+
+    def __memtest(self, test, address, size, pattern):
+        # Fill and the tests overwrite the memory
+        self.__updateImageCache(address, size, None)
+        self.__invalidatePageCache(address, size)
+        summary = None
+        result = self.appletRunning
+        if (result):
+            timeout = self.APPLET_RESPONSE_TIMEOUT + self.MEMTEST_PASSES.get(test, 1)*size/float(self.APPLET_MEMTEST_RATE)
+            payload = self.cmdLoop.memtestPayload(test, address, size, pattern)
+            (result, response, _) = self.__appletCommand(CmdLoop.CMD_MEMTEST, payload, timeout=timeout)
+        if (result):
+            summary = self.cmdLoop.parseMemtestResponse(response)
+            result = (summary[0] == CmdLoop.MEMTEST_STATUS_OK)
+            self.stat.memtestErrors = self.stat.memtestErrors + summary[1]
+        if (not result):
+            self.stat.memtestFailed = self.stat.memtestFailed + 1
+
+        return (result, summary)
+
+    def setBaudrate(self, rate):
+        '''
+        Switch the running applet and the host to the new line rate. Pings check the 
+        link, if there is no answer both sides return to the previous rate
+        Returns True if the new rate is used
+        '''
+        self.lock.acquire()
+        self.tty.traceMark("setBaudrate")
+
+        previousRate = self.tty.getRate()
+        (result, response, _) = self.__appletCommand(CmdLoop.CMD_SET_BAUDRATE, map(ord, struct.pack("<I", rate)))
+        if (result):
+            (status, appletRate) = self.cmdLoop.parseSetBaudrateResponse(response)
+            result = (status == CmdLoop.BAUDRATE_STATUS_OK)
+            if (not result):
+                logger.info("The applet can not use rate {0}, the closest rate is {1}".format(rate, appletRate))
+        if (result):
+            switchTime = time.time()
+            result = self.tty.setRate(rate) and self.__pingApplet()
+            if (not result):
+                self.__fallbackBaudrate(rate, previousRate, switchTime)
         
-        return (result, data)
+        if (result):
+            self.stat.baudrateSet = self.stat.baudrateSet + 1
+        else:
+            self.stat.baudrateFailed = self.stat.baudrateFailed + 1
+        self.__transactionDone(True)
+        self.lock.release()
+
+        return result
+
+    def __pingApplet(self):
+        '''
+        Returns True if the applet answers one of the pings
+        '''
+        for _ in range(self.BAUDRATE_PING_ATTEMPTS):
+            self.tty.swFlush()
+            (result, _, _) = self.__appletCommand(CmdLoop.CMD_PING, timeout=self.BAUDRATE_PING_TIMEOUT)
+            if (result):
+                return True
+        return False
+
+    def __fallbackBaudrate(self, rate, previousRate, switchTime):
+        '''
+        The applet returns to the previous rate when the confirmation timeout expires
+        If a ping reached the applet, but the response was lost, the applet stays at
+        the new rate and is asked to go back
+        '''
+        self.tty.setRate(previousRate)
+        time.sleep(max(0, switchTime + self.BAUDRATE_CONFIRM_TIMEOUT + self.BAUDRATE_PING_TIMEOUT - time.time()))
+        if (self.__pingApplet()):
+            return True
+
+        self.tty.setRate(rate)
+        (result, _, _) = self.__appletCommand(CmdLoop.CMD_SET_BAUDRATE, map(ord, struct.pack("<I", previousRate)))
+        self.tty.setRate(previousRate)
+        result = result and self.__pingApplet()
+        if (result):
+            self.stat.baudrateRecovered = self.stat.baudrateRecovered + 1
+        else:
+            logger.error("The applet does not answer at rate {0}".format(previousRate))
+        return result
+
+    def upload(self, address, data, compressed=False, verify=False):
+        '''
+        Write the data to the memory. The running applet gets the data in large 
+        frames, otherwise SAM-BA monitor receives XMODEM blocks
+        The running applet can receive compressed data, see __appletWriteCompressed()
+        Verification requires the running applet, see __verify()
+        '''
+        self.stat.upload = self.stat.upload + 1
+        startTime = time.time()
+        self.lock.acquire()
+        self.tty.traceMark("upload")
+        
+        self.__updateImageCache(address, len(data), None)
+        self.__invalidatePageCache(address, len(data))
+        if (self.appletRunning and compressed):
+            result = self.__appletWriteCompressed(address, data)
+        elif (self.appletRunning):
+            result = self.__appletWriteBlock(address, data)
+        else:
+            result = self.__uploadData(address, data)
+        if (verify and result and self.appletRunning):
+            (result, _) = self.__verify(address, data)
+        elif (verify):
+            logger.warning("Verification requires the running applet")
+        
+        self.tty.swFlush()
+        self.__transactionDone(result)
+        self.lock.release()
+        self.stat.addLatency("upload", time.time() - startTime)
+
+        return result
 
     def getTTY(self):
         return self.tty
+
+    def startTrace(self, filename, size=WireTrace.DEFAULT_SIZE):
+        '''
+        Record the serial traffic to the file, see at91_trace.py 
+        '''
+        return self.tty.startTrace(filename, size)
+
+    def stopTrace(self):
+        self.tty.stopTrace()
     
+    def batch(self, operations):
+        '''
+        Execute the operations holding the lock, consecutive writes are sent in one 
+        transaction, the input is flushed once after every group of writes
+        @param operations:list of tuples ("write", address, list of values), 
+        ("read", address) or ("dump", address, size)
+        Returns list of tuples (result, data, seconds), the writes of a group share the time
+        '''
+        self.stat.batch = self.stat.batch + 1
+        startTime = time.time()
+        results = []
+        self.lock.acquire()
+        self.tty.traceMark("batch")
+
+        index = 0
+        while (index < len(operations)):
+            operationStartTime = time.time()
+            operation = operations[index]
+            if (operation[0] == "write"):
+                group = []
+                while ((index < len(operations)) and (operations[index][0] == "write")):
+                    group.append(operations[index])
+                    index = index + 1
+                result = self.__batchWrite(group)
+                elapsed = (time.time() - operationStartTime)/len(group)
+                results.extend([(result, None, elapsed)]*len(group))
+                self.stat.write = self.stat.write + len(group)
+                continue
+
+            if (operation[0] == "read"):
+                size = 4
+            else:
+                size = operation[2]
+            buffer = bytearray(size)
+            if (self.pageCache != None):
+                (result, count) = self.__cachedReadInto(operation[1], memoryview(buffer))
+            else:
+                (result, count) = self.__readInto(operation[1], memoryview(buffer))
+            result = result and (count == size)
+            if (not result):
+                self.tty.swFlush()
+            results.append((result, str(buffer[:count]), time.time() - operationStartTime))
+            if (operation[0] == "read"):
+                self.stat.read = self.stat.read + 1
+            else:
+                self.stat.dump = self.stat.dump + 1
+            index = index + 1
+
+        self.tty.swFlush()
+        self.__transactionDone(any([result for (result, _, _) in results]))
+        self.lock.release()
+        self.stat.addLatency("batch", time.time() - startTime)
+
+        return results
+
+    def __batchWrite(self, group):
+        '''
+        SAM-BA monitor does not answer the writes, all writes of the group are sent 
+        with one tty write
+        '''
+        result = True
+        if (not self.appletRunning):
+            self.tty.beginBatch()
+        for (_, address, values) in group:
+            self.__updateImageCache(address, 4*len(values), None)
+            self.__invalidatePageCache(address, 4*len(values))
+            if (self.appletRunning):
+                result = self.__appletWriteBlock(address, struct.pack("<{0}I".format(len(values)), *values)) and result
+                continue
+            for value in values:
+                self.__write(address, value)
+                address = address + 4
+        if (not self.appletRunning):
+            result = self.tty.commit() and result
+        self.tty.swFlush()
+        if (not result):
+            self.stat.failedWrite = self.stat.failedWrite + 1
+
+        return result
+
     def __write(self, address, data):
         '''
         Write memory
@@ -917,18 +3343,48 @@ class AT91(threading.Thread):
         return True
 
     
+    def __writeBlock(self, address, data):
+        '''
+        Write memory using send file command 'S'
+        The monitor expects the data in XMODEM blocks
+        '''
+        self.stat.bulkWrite = self.stat.bulkWrite + 1
+        s = "S{0},{1}#".format(buildhexstring(address, 8), buildhexstring(len(data), 8))
+
+        result = self.tty.write(s)
+        if (result):
+            result = self.xmodem.send(data)
+
+        return result
+
     def write(self, address, data):
         '''
         Write memory
+        @param data:32 bits value or list of values for consecutive addresses
         '''
         self.stat.write = self.stat.write + 1
+        startTime = time.time()
+
+        if (not isinstance(data, list)):
+            data = [data]
         
         self.lock.acquire()
+        self.tty.traceMark("write")
         
-        result = self.__write(address, data)
+        self.__updateImageCache(address, 4*len(data), None)
+        self.__invalidatePageCache(address, 4*len(data))
+        if (self.appletRunning):
+            result = self.__appletWriteBlock(address, struct.pack("<{0}I".format(len(data)), *data))
+        else:
+            self.tty.beginBatch()
+            for value in data:
+                result = self.__write(address, value)
+                address = address + 4
+            result = self.tty.commit() and result
         
         self.tty.swFlush()
         self.lock.release()
+        self.stat.addLatency("write", time.time() - startTime)
 
         return result
 
@@ -943,30 +3399,166 @@ class AT91(threading.Thread):
         
         return (result, data)
 
-    def read(self, address):
+    def __readWordInto(self, address, buffer):
         '''
-        Read memory from the device
+        Read a word of the memory to the buffer
+        Returns tuple (result, number of bytes)
         '''
-        self.stat.read = self.stat.read + 1
+        self.tty.write("w{0},4#".format(buildhexstring(address)))
+        return self.tty.readInto(buffer)
 
-        self.lock.acquire()
+    def __readBlock(self, address, buffer):
+        '''
+        Read memory from the device using receive file command 'R'
+        The monitor sends the data in XMODEM blocks
+        '''
+        self.stat.bulkRead = self.stat.bulkRead + 1
+        s = "R{0},{1}#".format(buildhexstring(address, 8), buildhexstring(len(buffer), 8))
+
+        result = self.tty.write(s)
+        count = 0
+        if (result):
+            (result, count) = self.xmodem.receiveInto(buffer)
+
+        return (result, count)
+
+    def read(self, address):
+        '''
+        Read memory from the device
+        '''
+        self.stat.read = self.stat.read + 1
+        startTime = time.time()
+
+        self.lock.acquire()
+        self.tty.traceMark("read")
 
-        (result, data) = self.__read(address)        
+        if (self.pageCache != None):
+            buffer = bytearray(4)
+            (result, count) = self.__cachedReadInto(address, memoryview(buffer))
+            data = str(buffer[:count])
+        elif (self.appletRunning):
+            buffer = bytearray(4)
+            (result, count) = self.__appletReadBlock(address, buffer)
+            data = str(buffer[:count])
+        else:
+            (result, data) = self.__read(address)        
         
         self.tty.swFlush()
+        self.__transactionDone(result and (len(data) > 0))
         
         self.lock.release()
+        self.stat.addLatency("read", time.time() - startTime)
         
         return (result, data)
 
 def binToHex(data):
-    result = ""
-    for d in data:
-        ordD = ord(d)
-        s = buildhexstring(ordD, 2)
-        result = result + s
-        
-    return result
+    return binascii.hexlify(data).upper()
+
+# Printable characters of the hex dump, the rest is shown as '.'
+HEXDUMP_ASCII_TABLE = "".join([chr(c) if ((c >= 0x20) and (c < 0x7F)) else "." for c in range(256)])
+HEXDUMP_ROW_SIZE = 16
+HEXDUMP_WORD_TYPES = {2 : 'H', 4 : 'I'}
+
+def swapWords(data, wordSize):
+    '''
+    Reverse order of bytes in every word, the tail shorter than a word is not changed
+    '''
+    size = (len(data) / wordSize) * wordSize
+    words = array.array(HEXDUMP_WORD_TYPES[wordSize], data[:size])
+    words.byteswap()
+    return words.tostring() + data[size:]
+
+def renderHexDump(address, data, wordSize=1, bigEndian=False):
+    '''
+    Render all rows of the block at once: address, 16 bytes as 8, 16 or 32 bits words, ASCII
+    Returns the text of the block
+    '''
+    hexData = data
+    if ((wordSize > 1) and (not bigEndian)):
+        hexData = swapWords(data, wordSize)
+    hexStr = binascii.hexlify(hexData).upper()
+    asciiStr = data.translate(HEXDUMP_ASCII_TABLE)
+
+    digits = 2*wordSize
+    rowDigits = 2*HEXDUMP_ROW_SIZE
+    lines = []
+    for offset in range(0, len(data), HEXDUMP_ROW_SIZE):
+        rowHex = hexStr[2*offset:2*offset+rowDigits]
+        words = [rowHex[i:i+digits] for i in range(0, len(rowHex), digits)]
+        lines.append("{0:08X}:  {1}  {2}\n".format(address+offset, " ".join(words), asciiStr[offset:offset+HEXDUMP_ROW_SIZE]))
+    return "".join(lines)
+
+# LZ4 block format: the shortest match, the last match ends 5 bytes before the end of the block
+LZ4_MIN_MATCH = 4
+LZ4_LAST_LITERALS = 5
+LZ4_MATCH_LIMIT = 12
+LZ4_MAX_OFFSET = 0xFFFF
+
+def lz4Length(out, length):
+    '''
+    Add bytes of the length which does not fit the token
+    '''
+    length = length - 15
+    while (length >= 255):
+        out.append(255)
+        length = length - 255
+    out.append(length)
+
+def compressImage(data):
+    '''
+    Greedy LZ4 compression, the applet decodes the block in place. The compressed 
+    data is loaded at the returned offset from the output buffer, the decoder never 
+    overwrites the bytes it did not read yet
+    Returns tuple (compressed data, offset of the compressed data)
+    '''
+    out = bytearray()
+    table = {}
+    size = len(data)
+    anchor = 0
+    position = 0
+    misses = 0
+    inPlaceOffset = 0
+    while (position < size - LZ4_MATCH_LIMIT):
+        key = data[position:position+LZ4_MIN_MATCH]
+        candidate = table.get(key, -1)
+        table[key] = position
+        if ((candidate < 0) or (position - candidate > LZ4_MAX_OFFSET)):
+            # Skip faster through the data which does not compress
+            misses = misses + 1
+            position = position + 1 + (misses >> 6)
+            continue
+        misses = 0
+
+        length = LZ4_MIN_MATCH
+        maxLength = size - LZ4_LAST_LITERALS - position
+        while ((length + 64 <= maxLength) and (data[position+length:position+length+64] == data[candidate+length:candidate+length+64])):
+            length = length + 64
+        while ((length < maxLength) and (data[position+length] == data[candidate+length])):
+            length = length + 1
+
+        literals = position - anchor
+        out.append((min(literals, 15) << 4) | min(length - LZ4_MIN_MATCH, 15))
+        if (literals >= 15):
+            lz4Length(out, literals)
+        out.extend(data[anchor:position])
+        inPlaceOffset = max(inPlaceOffset, position - len(out))
+        offset = position - candidate
+        out.append(offset & 0xFF)
+        out.append(offset >> 8)
+        if (length - LZ4_MIN_MATCH >= 15):
+            lz4Length(out, length - LZ4_MIN_MATCH)
+        position = position + length
+        anchor = position
+        inPlaceOffset = max(inPlaceOffset, position - len(out))
+
+    literals = size - anchor
+    out.append(min(literals, 15) << 4)
+    if (literals >= 15):
+        lz4Length(out, literals)
+    out.extend(data[anchor:])
+    inPlaceOffset = max(inPlaceOffset, size - len(out))
+
+    return (str(out), inPlaceOffset)
     
 def readMemory(at91, addressStr):
     (result, addressInt) = convertToInt(addressStr, 16)    
@@ -981,11 +3573,11 @@ def readMemory(at91, addressStr):
         print s
     else:
        logger.error("Failed to read result={0}, len={1}".format(result, len(data)))
-         
+       result = False
     
-    return (result, data)
+    return result
 
-def printDump(at91, addressStr, sizeStr):
+def printDump(at91, addressStr, sizeStr, wordSize=1, bigEndian=False):
     
     (result, addressInt) = convertToInt(addressStr, 16)    
     if (not result):
@@ -997,47 +3589,70 @@ def printDump(at91, addressStr, sizeStr):
        logger.error("Size '{0}' is not valid integer".format(sizeStr))
        return result
 
-    blockSize = 128
-    count = 0
-    blocks = 0
-    totalBytes = sizeInt 
-    print "{0}: ".format(buildhexstring(addressInt, 8)),
-    asciiLine = ""
-    while (sizeInt > 0):    
-        if (sizeInt > blockSize):
-            (result, data) = at91.dump(addressInt+blocks*blockSize, blockSize)
-        else:
-            (result, data) = at91.dump(addressInt+blocks*blockSize, sizeInt)
+    # AT91.dump switches to the bulk read for large blocks
+    # Block size is a multiple of the row size
+    blockSize = 4096
+    offset = 0
+    while (offset < sizeInt):    
+        size = min(blockSize, sizeInt - offset)
+        (result, data) = at91.dump(addressInt+offset, size)
         if (not result):
-            logger.error("Failed to dump {0}".format(buildhexstring(addressInt, 8)))
-            return 
-        sizeInt = sizeInt - blockSize
-        blocks = blocks + 1
-    
-        for d in data:
-            ordD = ord(d)
-            s = buildhexstring(ordD, 2)
-            if ((ordD >= 0x20) and (ordD <= 0x7f)):
-                asciiLine = asciiLine + d
-            else:
-                asciiLine = asciiLine + "."
-            print s,
-            count = count + 1
-            if ((count % 16 == 0) and (count < totalBytes)):
-                print " {0}".format(asciiLine)
-                asciiLine = ""
-                print "{0}: ".format(buildhexstring(addressInt+count, 8)),
-    print " {0}".format(asciiLine)
+            logger.error("Failed to dump {0}".format(buildhexstring(addressInt+offset, 8)))
+            return result
+        # One write for the whole block
+        sys.stdout.write(renderHexDump(addressInt+offset, data, wordSize, bigEndian))
+        offset = offset + size
+    sys.stdout.flush()
                 
     return True
 
-def executeCode(at91, filename, addressStr, timeout=0.1):
+ELF_HEADER_FORMAT = "<16sHHIIIIIHHHHHH"
+ELF_PROGRAM_HEADER_FORMAT = "<IIIIIIII"
+ELF_PT_LOAD = 1
+
+def parseElf(data):
+    '''
+    Get the entry point and the loadable segments of 32 bits little endian ELF file
+    Returns tuple (result, entryPoint, segments), segments is a list of tuples 
+    (physical address, data of the file, size of the segment in memory)
+    '''
+    headerSize = struct.calcsize(ELF_HEADER_FORMAT)
+    if ((len(data) < headerSize) or (data[:4] != "\x7fELF")):
+        return (False, None, [])
+    (ident, _, _, _, entryPoint, phoff, _, _, _, phentsize, phnum, _, _, _) = struct.unpack(ELF_HEADER_FORMAT, data[:headerSize])
+    # ELFCLASS32, ELFDATA2LSB
+    if ((ord(ident[4]) != 1) or (ord(ident[5]) != 1)):
+        logger.error("Only 32 bits little endian ELF files are supported")
+        return (False, None, [])
+
+    segments = []
+    programHeaderSize = struct.calcsize(ELF_PROGRAM_HEADER_FORMAT)
+    for i in range(phnum):
+        offset = phoff + i*phentsize
+        if (offset + programHeaderSize > len(data)):
+            logger.error("Program header {0} is out of the file".format(i))
+            return (False, None, [])
+        (segmentType, fileOffset, _, physicalAddress, fileSize, memorySize, _, _) = struct.unpack(ELF_PROGRAM_HEADER_FORMAT, data[offset:offset+programHeaderSize])
+        if ((segmentType != ELF_PT_LOAD) or (memorySize == 0)):
+            continue
+        if (fileOffset + fileSize > len(data)):
+            logger.error("Segment {0} is out of the file".format(i))
+            return (False, None, [])
+        segments.append((physicalAddress, data[fileOffset:fileOffset+fileSize], max(memorySize, fileSize)))
+
+    return (True, entryPoint, segments)
+
+def executeCode(at91, filename, addressStr, timeout=0.1, differential=False, compressed=False, verify=False):
+    '''
+    Load BIN file to the address or the segments of ELF file and run the code
+    The entry point of ELF file is used instead of the address
+    '''
     file = None
 
     (result, addressInt) = convertToInt(addressStr, 16)    
     if (not result):
        logger.error("Address '{0}' is not valid hexadecimal integer".format(addressStr))
-       return
+       return result
     
     while (True):
         (result, file) = openFile(filename, "rb")
@@ -1045,6 +3660,7 @@ def executeCode(at91, filename, addressStr, timeout=0.1):
             logger.error("Failed to open file '{0}' for reading".format(filename))
             break;
 
+        result = False
         fileSize = os.path.getsize(filename)
         if (fileSize <= 0):
             logger.error("Failed to get size of the file '{0}'".format(filename))
@@ -1056,9 +3672,21 @@ def executeCode(at91, filename, addressStr, timeout=0.1):
             break;
     
         logger.info("Load Code {0}".format(filename))
-        at91.connectionPollEnable(False)
 
-        at91.executeCode(addressInt, addressInt, data)
+        startTime = time.time()
+        if (data[:4] == "\x7fELF"):
+            (result, entryPoint, segments) = parseElf(data)
+            if (not result):
+                logger.error("Failed to parse ELF file {0}".format(filename))
+                break;
+            for (address, segmentData, memorySize) in segments:
+                logger.info("Segment {0} {1} bytes, {2} bytes of zeros".format(buildhexstring(address, 8), len(segmentData), memorySize - len(segmentData)))
+            result = at91.executeSegments(segments, entryPoint, differential=differential, compressed=compressed, verify=verify)
+            data = "".join([segmentData for (_, segmentData, _) in segments])
+        else:
+            result = at91.executeCode(addressInt, addressInt, data, differential=differential, compressed=compressed, verify=verify)
+        elapsed = max(time.time() - startTime, 1e-6)
+        logger.info("Loaded {0} bytes in {1:.2f}s, {2:.0f} bytes/s".format(len(data), elapsed, len(data)/elapsed))
         logger.info("Code {0} is running, wait for output".format(filename))
 
         waitOuput(at91, timeout)
@@ -1068,21 +3696,307 @@ def executeCode(at91, filename, addressStr, timeout=0.1):
     if (file != None):
         file.close()
 
+    return result
+
+def uploadFile(at91, filename, addressStr, compressed=False, verify=False):
+    (result, addressInt) = convertToInt(addressStr, 16)    
+    if (not result):
+       logger.error("Address '{0}' is not valid hexadecimal integer".format(addressStr))
+       return result
+
+    (result, file) = openFile(filename, "rb")
+    if (not result):
+        logger.error("Failed to open file '{0}' for reading".format(filename))
+        return result
+    data = file.read()
+    file.close()
+
+    startTime = time.time()
+    result = at91.upload(addressInt, data, compressed, verify)
+    elapsed = max(time.time() - startTime, 1e-6)
+    if (result):
+        logger.info("Loaded {0} bytes to {1} in {2:.2f}s, {3:.0f} bytes/s".format(len(data), buildhexstring(addressInt, 8), elapsed, len(data)/elapsed))
+    else:
+        logger.error("Failed to load {0} to {1}".format(filename, buildhexstring(addressInt, 8)))
+
+    return result
+
+# Rates the probe tries, DBGU of the applet supports only rates close to master clock/(16*N)
+BAUDRATE_PROBE_RATES = [230400, 460800, 500000, 921600, 1000000, 1500000, 2000000, 3000000]
+# Size of the dump which checks the rate
+BAUDRATE_PROBE_SIZE = 32*1024
+
+def probeBaudrate(at91, address, rates=BAUDRATE_PROBE_RATES, size=BAUDRATE_PROBE_SIZE):
+    '''
+    Find the highest rate which transfers a dump without errors and leave the 
+    running applet at this rate
+    Returns the rate 
+    '''
+    bestRate = at91.getTTY().getRate()
+    for rate in rates:
+        if (rate <= bestRate):
+            continue
+        if (not at91.setBaudrate(rate)):
+            logger.info("Rate {0}: no link".format(rate))
+            continue
+
+        blockFailed = at91.stat.appletBlockFailed
+        startTime = time.time()
+        (result, data) = at91.dump(address, size)
+        elapsed = max(time.time() - startTime, 1e-6)
+        result = result and (len(data) == size) and (at91.stat.appletBlockFailed == blockFailed)
+        if (result):
+            logger.info("Rate {0}: {1:.0f} bytes/s".format(rate, size/elapsed))
+            bestRate = rate
+        else:
+            logger.info("Rate {0}: {1} failed blocks".format(rate, at91.stat.appletBlockFailed - blockFailed))
+            at91.setBaudrate(bestRate)
+
+    if (at91.getTTY().getRate() != bestRate):
+        at91.setBaudrate(bestRate)
+    return bestRate
+
+def setBaudrate(at91, appletFilename, appletAddressStr, rateStr):
+    '''
+    Load the applet, switch to the rate or find the highest reliable rate if rateStr is None
+    The applet returns to SAM-BA monitor at the end
+    '''
+    rate = None
+    if (rateStr != None):
+        (result, rate) = convertToInt(rateStr, 10)
+        if (not result):
+            logger.error("Rate '{0}' is not valid integer".format(rateStr))
+            return result
+
+    (result, address) = convertToInt(appletAddressStr, 16)
+    if (not result):
+       logger.error("Address '{0}' is not valid hexadecimal integer".format(appletAddressStr))
+       return result
+
+    result = executeCode(at91, appletFilename, appletAddressStr)
+    if (result and (rate != None)):
+        result = at91.setBaudrate(rate)
+        logger.info("Rate {0} {1}".format(rate, "works" if result else "does not work"))
+    elif (result):
+        # Dump of the applet code checks the link
+        rate = probeBaudrate(at91, address)
+        logger.info("The highest reliable rate is {0}".format(rate))
+
+    if (at91.appletRunning):
+        CmdLoop(at91).sendCommand(CmdLoop.CMD_EXIT)
+        waitOuput(at91, 0.1)
+
+    return result
+
+# Tests of the memtest command if not specified
+MEMTEST_DEFAULT_TESTS = "data,address,pattern"
+
+def testMemory(at91, appletFilename, appletAddressStr, addressStr, sizeStr, testsStr=MEMTEST_DEFAULT_TESTS, patternStr="55AA55AA"):
+    '''
+    Run the tests on the target and print the summary of the errors. The applet 
+    is loaded if it is not running and returns to SAM-BA monitor at the end
+    @param testsStr:comma separated names of the tests, see CmdLoop.MEMTEST_NAMES
+    '''
+    (result, address) = convertToInt(addressStr, 16)
+    if (not result):
+       logger.error("Address '{0}' is not valid hexadecimal integer".format(addressStr))
+       return result
+
+    (result, size) = convertToInt(sizeStr, 10)
+    if ((not result) or (size < 4) or (size % 4 != 0) or (address % 4 != 0)):
+       logger.error("Address {0} and size '{1}' shall be aligned to words".format(addressStr, sizeStr))
+       return False
+
+    (result, pattern) = convertToInt(patternStr, 16)
+    if (not result):
+       logger.error("Pattern '{0}' is not valid hexadecimal integer".format(patternStr))
+       return result
+
+    tests = testsStr.split(",")
+    for test in tests:
+        if (not test in CmdLoop.MEMTEST_NAMES):
+            logger.error("Test '{0}' is not one of {1}".format(test, ", ".join(sorted(CmdLoop.MEMTEST_NAMES))))
+            return False
+
+    appletStarted = (not at91.appletRunning)
+    if (appletStarted):
+        result = executeCode(at91, appletFilename, appletAddressStr)
+    failed = False
+
+    # All tests run, the failed data lines do not hide the failed address lines
+    for test in tests:
+        if (not result):
+            break
+        startTime = time.time()
+        (testResult, summary) = at91.memtest(CmdLoop.MEMTEST_NAMES[test], address, size, pattern)
+        elapsed = time.time() - startTime
+        if (summary == None):
+            logger.error("The applet does not support the memory test")
+            result = False
+            break
+        (_, errors, errorAddress, expected, actual, errorBits) = summary
+        if (errors == 0):
+            logger.info("{0} {1} {2} bytes: ok, {3:.2f}s".format(test, buildhexstring(address, 8), size, elapsed))
+        else:
+            logger.error("{0} {1} {2} bytes: {3} errors, the first at {4} expected {5} read {6}, failed {7} {8}".format(
+                test, buildhexstring(address, 8), size, errors, buildhexstring(errorAddress, 8), 
+                buildhexstring(expected, 8), buildhexstring(actual, 8), "address lines" if (test == "address") else "data lines",
+                buildhexstring(errorBits, 8)))
+        failed = failed or (not testResult)
+
+    if (appletStarted and at91.appletRunning):
+        CmdLoop(at91).sendCommand(CmdLoop.CMD_EXIT)
+        waitOuput(at91, 0.1)
+
+    return (result and (not failed))
+
+def fillMemory(at91, appletFilename, appletAddressStr, addressStr, sizeStr, patternStr):
+    '''
+    Write the pattern to every word of the range
+    '''
+    return testMemory(at91, appletFilename, appletAddressStr, addressStr, sizeStr, "fill", patternStr)
+
+# Double buffer for the serial flash image in DDR
+FLASH_BUFFER_ADDRESS = 0x20000000
+# Size of the block the applet programs while the host sends the next one
+FLASH_CHUNK_SIZE = 64*1024
+# The longest time to program a block
+FLASH_CHUNK_TIMEOUT = 10.0
+
+def waitFlashIdle(at91, timeout=FLASH_CHUNK_TIMEOUT):
+    '''
+    Poll the state of the programming job until the applet completes it
+    '''
+    cmdLoop = CmdLoop(at91)
+    deadline = time.time() + timeout
+    while (time.time() < deadline):
+        [(result, response, _)] = at91.appletCommands([(CmdLoop.CMD_FLASH_STATUS, None)])
+        if (not result):
+            logger.error("No response to the flash status")
+            return False
+        (state, status, done) = cmdLoop.parseFlashStatusResponse(response)
+        if (state == CmdLoop.FLASH_STATE_IDLE):
+            return True
+        if (state != CmdLoop.FLASH_STATE_BUSY):
+            logger.error("Programming failed, status {0}, {1} bytes programmed".format(status, done))
+            return False
+        time.sleep(0.01)
+
+    logger.error("Programming of the block takes longer than {0}s".format(timeout))
+    return False
+
+def programFlash(at91, flashAddress, image, bufferAddress=FLASH_BUFFER_ADDRESS, chunkSize=FLASH_CHUNK_SIZE, compressed=False, verify=False):
+    '''
+    Stream the image to the running applet. The applet erases and programs the 
+    block from one buffer while the host loads the next block to the other buffer
+    Verification checks the block in the buffer before the applet programs it and 
+    the serial flash after the last block, the regions which differ are reported
+    '''
+    cmdLoop = CmdLoop(at91)
+    startTime = time.time()
+    offset = 0
+    index = 0
+    while (offset < len(image)):
+        chunk = image[offset:offset+chunkSize]
+        buffer = bufferAddress + (index % 2)*chunkSize
+        # The applet is programming the previous block
+        if (not at91.upload(buffer, chunk, compressed, verify)):
+            logger.error("Failed to load block {0} of the image".format(index))
+            return False
+        if (not waitFlashIdle(at91)):
+            return False
+        
+        payload = cmdLoop.flashWritePayload(flashAddress + offset, buffer, len(chunk))
+        [(result, response, _)] = at91.appletCommands([(CmdLoop.CMD_FLASH_WRITE, payload)])
+        if ((not result) or (response[0] != CmdLoop.FLASH_STATUS_OK)):
+            logger.error("Failed to start programming of {0}".format(buildhexstring(flashAddress + offset, 8)))
+            return False
+        offset = offset + len(chunk)
+        index = index + 1
+        logger.debug("Loaded {0} of {1} bytes".format(offset, len(image)))
+
+    result = waitFlashIdle(at91)
+    if (result and verify):
+        (result, _) = at91.verifyFlash(flashAddress, image)
+    elapsed = max(time.time() - startTime, 1e-6)
+    if (result):
+        logger.info("Programmed {0} bytes in {1:.1f}s, {2:.3f} MB/s".format(len(image), elapsed, len(image)/elapsed/(1024*1024)))
+    return result
+
+def flashImage(at91, appletFilename, appletAddressStr, imageFilename, flashAddressStr, compressed=False, rateStr=None, verify=False):
+    '''
+    Load the applet, detect the serial flash, program the image, return to SAM-BA monitor
+    '''
+    (result, flashAddress) = convertToInt(flashAddressStr, 16)    
+    if (not result):
+       logger.error("Address '{0}' is not valid hexadecimal integer".format(flashAddressStr))
+       return result
+
+    (result, file) = openFile(imageFilename, "rb")
+    if (not result):
+        logger.error("Failed to open file '{0}' for reading".format(imageFilename))
+        return result
+    image = file.read()
+    file.close()
+
+    while (True):
+        result = executeCode(at91, appletFilename, appletAddressStr)
+        if (not result):
+            break
+
+        # The applet ignores the commands it is built without
+        [(result, response, _)] = at91.appletCommands([(CmdLoop.CMD_FLASH_INIT, None)])
+        if (not result):
+            logger.error("The applet {0} has no serial flash commands, build it with CONFIGURE_SPI_FLASH 1 in applets/src/configure.h "
+                "and the src/spiflash sources in applets/mk/config.mk".format(appletFilename))
+            break
+
+        if (rateStr != None):
+            (result, rate) = convertToInt(rateStr, 10)
+            if ((not result) or (not at91.setBaudrate(rate))):
+                logger.warning("Failed to switch to rate {0}, continue at {1}".format(rateStr, at91.getTTY().getRate()))
+        (status, jedecId, size, pageSize, eraseSize) = CmdLoop(at91).parseFlashInitResponse(response)
+        result = (status == CmdLoop.FLASH_STATUS_OK)
+        if (not result):
+            logger.error("Serial flash is not found")
+            break
+        logger.info("Serial flash {0}, {1} bytes, page {2} bytes".format(buildhexstring(jedecId, 6), size, pageSize))
+
+        result = programFlash(at91, flashAddress, image, compressed=compressed, verify=verify)
+        break
+
+    if (at91.appletRunning):
+        CmdLoop(at91).sendCommand(CmdLoop.CMD_EXIT)
+        waitOuput(at91, 0.1)
+
+    return result
+
 def waitOuput(at91, timeout=1):
-    LOOPS = 5
-    loops = LOOPS
-    
-    # Force floating point calculation
-    loopDelay = (1.0*timeout)/loops
-
-    while (loops > 0):
-        (result, s) = at91.getOutput(80)
-        if (result and (len(s) > 0)):
-            logger.info(">{}".format(s))
-            loops = LOOPS
-            
-        loops = loops - 1
-        time.sleep(loopDelay) 
+    '''
+    Log the output of the code until no output arrives for timeout seconds. Every chunk 
+    of the output restarts the wait, so the call returns timeout seconds after the last 
+    output and does not return while the code keeps writing. Returns at once if the 
+    output reader does not run. Use waitLine() to wait for a known line
+    '''
+    reader = at91.getOutputReader()
+    if (not reader.isAlive()):
+        return
+    while (True):
+        s = reader.read(timeout=timeout)
+        if (len(s) == 0):
+            break
+        logger.info(">{}".format(s))
+
+def waitLine(at91, pattern, timeout):
+    '''
+    Wait for a line of the output which matches the regular expression
+    '''
+    (result, line) = at91.getOutputReader().waitLine(pattern, timeout)
+    if (result):
+        logger.info(">{}".format(line))
+    else:
+        logger.error("No line matches '{0}' in {1}s".format(pattern, timeout))
+    return result
         
 def writeData(at91, addressStr, valueStr):
     
@@ -1091,46 +4005,631 @@ def writeData(at91, addressStr, valueStr):
        logger.error("Address '{0}' is not valid hexadecimal integer".format(addressStr))
        return result
     
-    (result, valueInt) = convertToInt(valueStr, 16)
-    if (not result):
-       logger.error("Value '{0}' is not valid hexadecimal integer".format(valueStr))
-       return result
+    values = []
+    for s in valueStr.split():
+        (result, valueInt) = convertToInt(s, 16)
+        if (not result):
+           logger.error("Value '{0}' is not valid hexadecimal integer".format(s))
+           return result
+        values.append(valueInt)
 
-    at91.write(addressInt, valueInt)
+    result = at91.write(addressInt, values)
+    if (not result):
+        logger.error("Write to {0} failed".format(addressStr))
    
-    return True 
+    return result 
+    
+# Size of the dump in a script if the size is not specified
+SCRIPT_DUMP_SIZE = 256
+
+def parseScriptOperation(words):
+    '''
+    Convert the write, read or dump command of the script to the operation of AT91.batch()
+    Returns tuple (result, operation), the operation is None if the command is not batched
+    '''
+    command = words[0]
+    if ((not command in ["write", "read", "dump"]) or (len(words) < 2)):
+        return (True, None)
+    if (((command == "read") and (len(words) != 2)) or ((command == "dump") and (len(words) > 3))):
+        # Dump to a file and the rest are executed by the interpreter
+        return (True, None)
+
+    (result, address) = convertToInt(words[1], 16)
+    if (not result):
+        logger.error("Address '{0}' is not valid hexadecimal integer".format(words[1]))
+        return (False, None)
+
+    if (command == "write"):
+        values = []
+        for valueStr in words[2:]:
+            (result, value) = convertToInt(valueStr, 16)
+            if (not result):
+                logger.error("Value '{0}' is not valid hexadecimal integer".format(valueStr))
+                return (False, None)
+            values.append(value)
+        if (len(values) == 0):
+            logger.error("No values to write")
+            return (False, None)
+        return (True, (command, address, values))
+
+    if (command == "read"):
+        return (True, (command, address))
+
+    size = SCRIPT_DUMP_SIZE
+    if (len(words) == 3):
+        (result, size) = convertToInt(words[2], 10)
+        if (not result):
+            logger.error("Size '{0}' is not valid integer".format(words[2]))
+            return (False, None)
+    return (True, (command, address, size))
+
+def parseScript(filename):
+    '''
+    Read the whole script before anything is sent to the target
+    Commands are separated by new lines or ';', '#' starts a comment
+    Returns tuple (result, steps), steps is list of tuples (line number, command, operation)
+    '''
+    (result, file) = openFile(filename, "r")
+    if (not result):
+        logger.error("Failed to open file '{0}' for reading".format(filename))
+        return (False, [])
+
+    steps = []
+    lineNumber = 0
+    for line in file:
+        lineNumber = lineNumber + 1
+        line = line.split("#")[0]
+        for command in line.split(";"):
+            words = command.split()
+            if (len(words) == 0):
+                continue
+            (result, operation) = parseScriptOperation(words)
+            if (not result):
+                logger.error("Line {0}: '{1}'".format(lineNumber, command.strip()))
+                break
+            steps.append((lineNumber, " ".join(words), operation))
+        if (not result):
+            break
+    file.close()
+
+    return (result, steps)
+
+def runScript(at91, filename, interpreter=None):
+    '''
+    Consecutive write, read and dump commands of the script run as one AT91.batch() 
+    The rest of the commands are executed by the interpreter
+    Prints time of every step
+    '''
+    (result, steps) = parseScript(filename)
+    if (not result):
+        return False
+
+    if (interpreter == None):
+        interpreter = cmdGroundLevel()
+        interpreter.init(at91)
+    
+    timing = []
+    startTime = time.time()
+    index = 0
+    while (result and (index < len(steps))):
+        (lineNumber, command, operation) = steps[index]
+        if (operation == None):
+            stepStartTime = time.time()
+            interpreter.onecmd(command)
+            timing.append((lineNumber, command, True, time.time() - stepStartTime))
+            index = index + 1
+            continue
+
+        group = []
+        while ((index < len(steps)) and (steps[index][2] != None)):
+            group.append(steps[index])
+            index = index + 1
+        batchResults = at91.batch([operation for (_, _, operation) in group])
+        for ((lineNumber, command, operation), (stepResult, data, elapsed)) in zip(group, batchResults):
+            timing.append((lineNumber, command, stepResult, elapsed))
+            if (not stepResult):
+                logger.error("Line {0}: '{1}' failed".format(lineNumber, command))
+                result = False
+                break
+            if (operation[0] == "read"):
+                print binToHex(data)
+            elif (operation[0] == "dump"):
+                sys.stdout.write(renderHexDump(operation[1], data, interpreter.dumpWordSize, interpreter.dumpBigEndian))
+    sys.stdout.flush()
+    elapsed = time.time() - startTime
+
+    fieldPattern = "{:>10}"
+    print " ".join([fieldPattern.format(c) for c in ["line", "result", "ms"]]) + " command"
+    for (lineNumber, command, stepResult, stepElapsed) in timing:
+        fields = [lineNumber, "ok" if stepResult else "FAILED", "{0:.2f}".format(1000*stepElapsed)]
+        print " ".join([fieldPattern.format(f) for f in fields]) + " " + command
+    print "Steps {0}/{1}, {2:.3f}s".format(len(timing), len(steps), elapsed)
+
+    return result
     
+def findDevices(deviceStr):
+    '''
+    Expand glob patterns in the comma separated list of devices
+    '''
+    devices = []
+    for pattern in deviceStr.split(","):
+        matches = sorted(glob.glob(pattern))
+        if (len(matches) == 0):
+            # Keep the name, connection will fail and report it
+            matches = [pattern]
+        for device in matches:
+            if (not device in devices):
+                devices.append(device)
+    return devices
+
+# Dump to file reads memory in chunks of this size into the same buffer
+DUMP_CHUNK_SIZE = 64*1024
+
+def dumpToFile(at91, addressStr, sizeStr, filename, resume=False):
+    '''
+    Write memory of the device to the binary file chunk by chunk
+    If resume is set and the file exists continue from the end of the file
+    '''
+    (result, addressInt) = convertToInt(addressStr, 16)
+    if (not result):
+       logger.error("Address '{0}' is not valid hexadecimal integer".format(addressStr))
+       return result
+    (result, sizeInt) = convertToInt(sizeStr, 10)
+    if (not result):
+       logger.error("Size '{0}' is not valid integer".format(sizeStr))
+       return result
+
+    offset = 0
+    if (resume and os.path.exists(filename)):
+        # Continue from the last complete word
+        offset = min(os.path.getsize(filename) & ~3, sizeInt)
+        (result, file) = openFile(filename, "r+b")
+        if (result):
+            file.seek(offset)
+            file.truncate()
+        logger.info("Resume dump of {0} at offset {1}".format(filename, offset))
+    else:
+        (result, file) = openFile(filename, "wb")
+    if (not result):
+        return result
+
+    chunk = bytearray(min(DUMP_CHUNK_SIZE, max(sizeInt, 1)))
+    chunkView = memoryview(chunk)
+    startTime = time.time()
+    while (offset < sizeInt):
+        size = min(len(chunk), sizeInt - offset)
+        (result, count) = at91.dumpInto(addressInt + offset, chunkView[:size])
+        file.write(chunkView[:count])
+        offset = offset + count
+        if ((not result) or (count != size)):
+            result = False
+            logger.error("Failed to dump {0}, {1} bytes are in {2}".format(buildhexstring(addressInt + offset, 8), offset, filename))
+            break
+    file.close()
+
+    if (result):
+        elapsed = max(time.time() - startTime, 1e-6)
+        logger.info("Dump {0} bytes to {1}, {2:.0f} bytes/s".format(offset, filename, offset/elapsed))
+    return result
+
+def runJob(at91, arguments, dumpFilename=None):
+    '''
+    Execute the command line job on the device
+    '''
+    result = True
+    at91.enablePageCache(arguments['--cache'])
+    if (arguments['dump']):
+        # Many devices write to own files in the log directory
+        if (dumpFilename == None):
+            dumpFilename = arguments['--output']
+        if (dumpFilename != None):
+            result = dumpToFile(at91, arguments['--address'], arguments['--size'], dumpFilename, arguments['--resume'])
+        else:
+            (result, wordSize) = convertToInt(arguments['--word'], 10)
+            if (result and (not wordSize in [1, 2, 4])):
+                logger.error("Word size {0} is not 1, 2 or 4".format(wordSize))
+                result = False
+            if (result):
+                result = printDump(at91, arguments['--address'], arguments['--size'], wordSize, arguments['--big-endian'])
+
+    if (arguments['read']):
+        result = readMemory(at91, arguments['--address'])
+        
+    if (arguments['run']):
+        result = executeCode(at91, arguments['--filename'], arguments['--address'], differential=arguments['--diff'], compressed=arguments['--compress'], verify=arguments['--verify'])
+
+    if (arguments['write']):
+        result = writeData(at91, arguments['--address'], arguments['--data'])
+
+    if (arguments['flash']):
+        result = flashImage(at91, arguments['--filename'], arguments['--address'], arguments['--image'], arguments['--flash-address'], arguments['--compress'], arguments['--baudrate'], arguments['--verify'])
+
+    if (arguments['baudrate']):
+        result = setBaudrate(at91, arguments['--filename'], arguments['--address'], arguments['--baudrate'])
+
+    if (arguments['memtest']):
+        result = testMemory(at91, arguments['--filename'], arguments['--address'], arguments['--memory'], arguments['--size'], arguments['--test'], arguments['--pattern'])
+
+    if (arguments['fill']):
+        result = fillMemory(at91, arguments['--filename'], arguments['--address'], arguments['--memory'], arguments['--size'], arguments['--pattern'])
+
+    if (arguments['script']):
+        result = runScript(at91, arguments['--script'])
+
+    return (result == True)
+
+# The daemon listens on this Unix socket, see at91_client.py
+DAEMON_SOCKET = "/tmp/at91_loader.sock"
+# Commands of the interactive mode which the daemon does not execute
+DAEMON_REJECTED_COMMANDS = ["exit", "quit", "EOF"]
+# The daemon returns the output of run after this quiet time, the clients wait for 
+# a known line with the wait command or set wait= of run
+DAEMON_RUN_OUTPUT_TIMEOUT = 0.1
+
+class ThreadOutput(object):
+    '''
+    Replacement of sys.stdout, the threads which registered a writer print to the 
+    writer, the rest of the threads print to the original stdout
+    '''
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.writers = {}
+
+    def register(self, writer):
+        self.writers[threading.current_thread().ident] = writer
+
+    def unregister(self):
+        self.writers.pop(threading.current_thread().ident, None)
+
+    def __getWriter(self):
+        return self.writers.get(threading.current_thread().ident, self.stdout)
+
+    def write(self, data):
+        self.__getWriter().write(data)
+
+    def flush(self):
+        self.__getWriter().flush()
+
+    # The print statement keeps the state of the line in the file object
+    softspace = property(lambda self: getattr(self.__getWriter(), "softspace", 0), 
+        lambda self, value: setattr(self.__getWriter(), "softspace", value))
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+class DaemonOutput(logging.Handler):
+    '''
+    Collect the log messages of the thread which executes the request
+    '''
+    def __init__(self, output):
+        logging.Handler.__init__(self)
+        self.output = output
+        self.errors = 0
+        self.thread = threading.current_thread().ident
+        self.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+
+    def emit(self, record):
+        if (record.thread != self.thread):
+            return
+        if (record.levelno >= logging.ERROR):
+            self.errors = self.errors + 1
+        self.output.write(self.format(record) + "\n")
+
+class DaemonRequestHandler(SocketServer.StreamRequestHandler):
+    '''
+    Every line of the request is a command of the interactive mode, the 
+    response is a line of JSON {"result":bool, "output":str}
+    '''
+    def handle(self):
+        while (True):
+            line = self.rfile.readline()
+            if (line == ""):
+                break
+            line = line.strip()
+            if (line == "shutdown"):
+                self.__respond(True, "")
+                # shutdown() waits for serve_forever() to return
+                threading.Thread(target=self.server.shutdown).start()
+                break
+            (result, output) = self.server.execute(line)
+            if (not self.__respond(result, output)):
+                break
+
+    def __respond(self, result, output):
+        try:
+            self.wfile.write(json.dumps({"result" : result, "output" : output}) + "\n")
+            self.wfile.flush()
+        except socket.error:
+            return False
+        return True
+
+class LoaderDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''
+    Own the serial connection and the AT91 object between the requests of the 
+    clients. The connection is not reopened and the applet stays resident, 
+    a request takes as long as the serial transaction
+    '''
+    daemon_threads = True
+
+    def __init__(self, at91, socketPath=DAEMON_SOCKET):
+        self.socketPath = socketPath
+        self.removeStaleSocket(socketPath)
+        SocketServer.UnixStreamServer.__init__(self, socketPath, DaemonRequestHandler)
+        self.at91 = at91
+        # The output of a request goes to the writer of the request thread, the output 
+        # of the rest of the threads is not mixed into the responses
+        self.stdout = sys.stdout
+        self.output = ThreadOutput(sys.stdout)
+        sys.stdout = self.output
+        self.interpreter = cmdGroundLevel(stdout=self.output)
+        self.interpreter.init(at91)
+        self.interpreter.runOutputTimeout = DAEMON_RUN_OUTPUT_TIMEOUT
+        self.lock = threading.Lock()
+        self.stat = StatManager.Block(socketPath)
+        self.stat.addFieldsInt(["requests", "failed", "rejected"])
+        self.stat.addHistograms(["request"])
+        statManager.addCounters("Daemon", self.stat)
+
+    @staticmethod
+    def removeStaleSocket(socketPath):
+        '''
+        Raises socket.error if another daemon is listening
+        '''
+        if (not os.path.exists(socketPath)):
+            return
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(socketPath)
+            s.close()
+            raise socket.error("Daemon is already listening on {0}".format(socketPath))
+        except socket.error as e:
+            if (e.errno == None):
+                raise
+        os.unlink(socketPath)
+
+    def execute(self, line):
+        '''
+        Execute the command with the interactive interpreter, the requests are executed one by one
+        and the output of the interpreter is collected for the requesting thread
+        Returns tuple (result, output), the result is False if an error is logged
+        '''
+        self.stat.requests = self.stat.requests + 1
+        words = line.split()
+        if ((len(words) > 0) and (words[0] in DAEMON_REJECTED_COMMANDS)):
+            self.stat.rejected = self.stat.rejected + 1
+            return (False, "Command '{0}' is not supported by the daemon\n".format(words[0]))
+
+        startTime = time.time()
+        self.lock.acquire()
+        output = StringIO.StringIO()
+        handler = DaemonOutput(output)
+        logger.addHandler(handler)
+        self.output.register(output)
+        try:
+            self.interpreter.onecmd(self.interpreter.precmd(line))
+        except Exception:
+            logger.error("Command '{0}' failed: {1}".format(line, traceback.format_exc()))
+        finally:
+            self.output.unregister()
+            logger.removeHandler(handler)
+        self.lock.release()
+        self.stat.addLatency("request", time.time() - startTime)
+
+        result = (handler.errors == 0)
+        if (not result):
+            self.stat.failed = self.stat.failed + 1
+        return (result, output.getvalue())
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        sys.stdout = self.stdout
+        if (os.path.exists(self.socketPath)):
+            os.unlink(self.socketPath)
+
+def runDaemon(at91, socketPath):
+    '''
+    Serve the clients until SIGTERM, SIGINT or the shutdown command
+    '''
+    try:
+        daemon = LoaderDaemon(at91, socketPath)
+    except socket.error as e:
+        logger.error("Failed to listen on {0}: {1}".format(socketPath, e))
+        return False
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info("Listen on {0}".format(socketPath))
+    try:
+        daemon.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        daemon.server_close()
+    logger.info("Daemon exits")
+    return True
+
+class DeviceLogFilter(logging.Filter):
+    '''
+    Pass records logged by threads of the device: the worker, the AT91 connection poll 
+    and the output reader, the names of the threads start with the device
+    '''
+    def __init__(self, device):
+        logging.Filter.__init__(self)
+        self.device = device
+
+    def filter(self, record):
+        return (record.threadName.split(":")[0] == self.device)
+
+class ParallelRunner:
+    '''
+    Run the same job on many devices. Every device gets own log file, 
+    own AT91 object with own blocks of statistics
+    '''
+    def __init__(self, devices, jobs, logdir, trace=False, traceSize=WireTrace.DEFAULT_SIZE, output=None):
+        self.devices = devices
+        self.output = output
+        self.trace = trace
+        self.traceSize = traceSize
+        self.jobs = max(1, min(jobs, len(devices)))
+        self.logdir = logdir
+        self.queue = Queue.Queue()
+        self.results = []
+        self.resultsLock = threading.Lock()
+
+    def __deviceFilename(self, device, suffix):
+        return os.path.join(self.logdir, os.path.basename(device) + suffix)
+
+    def __dumpFilename(self, device):
+        '''
+        The dump goes to the log directory unless the output is set, the name of the 
+        device replaces {device} in the output or is added before the extension
+        '''
+        if (self.output == None):
+            return self.__deviceFilename(device, ".bin")
+        name = os.path.basename(device)
+        if ("{device}" in self.output):
+            return self.output.replace("{device}", name)
+        (root, extension) = os.path.splitext(self.output)
+        return "{0}-{1}{2}".format(root, name, extension)
+
+    def __runDevice(self, device, job):
+        threading.current_thread().name = device
+        handler = logging.FileHandler(self.__deviceFilename(device, ".log"))
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        handler.addFilter(DeviceLogFilter(device))
+        logger.addHandler(handler)
+
+        startTime = time.time()
+        result = False
+        at91 = AT91(device)
+        at91.name = device + ":poll"
+        if (self.trace):
+            at91.startTrace(self.__deviceFilename(device, ".trace"), self.traceSize)
+        at91.start()
+        try:
+            if (at91.waitConnection()):
+                result = job(at91, self.__dumpFilename(device))
+            else:
+                logger.error("No connection to {0}".format(device))
+        except Exception:
+            logger.error("Job failed on {0}: {1}".format(device, traceback.format_exc()))
+        at91.cancel()
+        at91.join()
+        elapsed = time.time() - startTime
+
+        logger.removeHandler(handler)
+        handler.close()
+
+        self.resultsLock.acquire()
+        self.results.append((device, result, elapsed, at91))
+        self.resultsLock.release()
+
+    def __worker(self, job):
+        while (True):
+            try:
+                device = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.__runDevice(device, job)
+
+    def run(self, job):
+        '''
+        @param job:function(at91, dumpFilename) which returns True on success
+        Returns True if the job succeeded on all devices
+        '''
+        for device in self.devices:
+            self.queue.put(device)
+        workers = []
+        for _ in range(self.jobs):
+            worker = threading.Thread(target=self.__worker, args=(job,))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+        result = True
+        for (_, deviceResult, _, _) in self.results:
+            result = result and deviceResult
+        return result
+
+    def printSummary(self):
+        fieldPattern = "{:>14}"
+        columns = ["device", "result", "seconds", "failedRead", "failedWrite", "checkFailed", "bulkReadFailed", "bulkWriteFailed"]
+        print " ".join([fieldPattern.format(c) for c in columns])
+        print " ".join(["-"*14 for c in columns])
+        failed = 0
+        for (device, result, elapsed, at91) in sorted(self.results):
+            if (not result):
+                failed = failed + 1
+            fields = [os.path.basename(device), "ok" if result else "FAILED", "{0:.2f}".format(elapsed),
+                      at91.stat.failedRead, at91.stat.failedWrite, at91.stat.checkFailed, 
+                      at91.stat.bulkReadFailed, at91.stat.bulkWriteFailed]
+            print " ".join([fieldPattern.format(f) for f in fields])
+        print "Devices {0}, failed {1}".format(len(self.results), failed)
+
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='AT91 loader 0.1')
 
-    logging.basicConfig()    
-    logger = logging.getLogger('at91_loader')
+    devices = findDevices(arguments['--device'])
+
+    statExporter = None
+    if (arguments['--stats'] != None):
+        (result, interval) = convertToFloat(arguments['--stats-interval'])
+        if ((not result) or (interval <= 0)):
+            logger.error("Interval '{0}' is not valid positive number".format(arguments['--stats-interval']))
+            sys.exit(1)
+        statExporter = StatExporter(statManager, arguments['--stats'], interval)
+        statExporter.start()
+
+    traceSize = WireTrace.DEFAULT_SIZE
+    if (arguments['--trace'] != None):
+        (result, traceSize) = convertToInt(arguments['--trace-size'], 10)
+        if (not result):
+            sys.exit(1)
+
+    if (len(devices) > 1):
+        logging.basicConfig(format="%(threadName)s %(levelname)s:%(name)s:%(message)s")
+    else:
+        logging.basicConfig()    
     logger.setLevel(logging.INFO)    
 
-    device = arguments['--device']
+    if (len(devices) > 1):
+        if (arguments['--interactive'] or arguments['daemon']):
+            logger.error("Interactive and daemon modes require a single device")
+            sys.exit(1)
+        (result, jobs) = convertToInt(arguments['--jobs'], 10)
+        if (not result):
+            sys.exit(1)
+        logger.info("Use devices {0}".format(", ".join(devices)))
+        runner = ParallelRunner(devices, jobs, arguments['--logdir'], arguments['--trace'] != None, traceSize, arguments['--output'])
+        result = runner.run(lambda at91, dumpFilename: runJob(at91, arguments, dumpFilename))
+        runner.printSummary()
+        if (statExporter != None):
+            statExporter.cancel()
+        sys.exit(0 if result else 1)
 
+    device = devices[0]
     
     logger.info("Use device {0}".format(device));
     at91 = AT91(device)
+    if (arguments['--trace'] != None):
+        at91.startTrace(arguments['--trace'], traceSize)
     at91.start()
     
     at91.waitConnection()
-        
-    if (arguments['dump']):
-        printDump(at91, arguments['--address'], arguments['--size'])
-        
-    if (arguments['run']):
-        executeCode(at91, arguments['--filename'], arguments['--address'])
-        self.at91.connectionPollEnable(True)
 
-    if (arguments['write']):
-        writeData(at91, arguments['--address'], arguments['--data'])
+    runJob(at91, arguments)
         
     # Enter main command loop if interactive mode is enabled
-    if (arguments['--interactive']):
+    if (arguments['daemon']):
+        runDaemon(at91, arguments['--socket'])
+        at91.cancel()
+    elif (arguments['--interactive']):
         print "" 
         c = cmdGroundLevel()
         c.init(at91)
         c.cmdloop()
     else:
         at91.cancel()
+
+    if (statExporter != None):
+        statExporter.cancel()
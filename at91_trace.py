@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""AT91 wire trace.
+
+Analyse the serial traffic recorded by at91_loader.py --trace. The traffic
+is split to operations by the marks the loader adds when an operation starts
+
+Usage:
+  at91_trace.py -h | --help
+  at91_trace.py <trace> [--events] [--gap=<FLOAT>]
+
+Options:
+  -h --help            Show this screen.
+  -e --events          Print every record of the trace
+  -g --gap=<FLOAT>     Report idle gaps longer than this number of seconds [default: 0.05]
+"""
+
+import struct
+import binascii
+from docopt import docopt
+
+from at91_loader import WireTrace
+
+
+RECORD_NAMES = {
+    WireTrace.TX : "tx",
+    WireTrace.RX : "rx",
+    WireTrace.FLUSH : "flush",
+    WireTrace.MARK : "mark",
+    WireTrace.RATE : "rate",
+}
+
+
+def readTrace(filename):
+    '''
+    Returns tuple (result, records), records is a list of tuples
+    (type, seconds since the start, data) ordered by time
+    '''
+    with open(filename, "rb") as f:
+        header = f.read(WireTrace.HEADER_SIZE)
+        headerSize = struct.calcsize(WireTrace.HEADER_FORMAT)
+        if (len(header) < headerSize):
+            return (False, [])
+        (magic, version, blockSize, blocks, _) = struct.unpack(WireTrace.HEADER_FORMAT, header[:headerSize])
+        if ((magic != WireTrace.MAGIC) or (version != WireTrace.VERSION)):
+            return (False, [])
+
+        # Sequence numbers restore the order of the blocks in the ring
+        blockHeaderSize = struct.calcsize(WireTrace.BLOCK_HEADER_FORMAT)
+        data = []
+        for _ in range(blocks):
+            block = f.read(blockSize)
+            if (len(block) < blockHeaderSize):
+                break
+            (sequence, ) = struct.unpack(WireTrace.BLOCK_HEADER_FORMAT, block[:blockHeaderSize])
+            if (sequence != 0):
+                data.append((sequence, block))
+
+    records = []
+    recordSize = struct.calcsize(WireTrace.RECORD_FORMAT)
+    for (_, block) in sorted(data):
+        offset = blockHeaderSize
+        while (offset + recordSize <= len(block)):
+            (recordType, size, timestamp) = struct.unpack(WireTrace.RECORD_FORMAT, block[offset:offset+recordSize])
+            if (recordType == WireTrace.END):
+                break
+            offset = offset + recordSize
+            records.append((recordType, timestamp/1000000.0, block[offset:offset+size]))
+            offset = offset + size
+
+    return (True, records)
+
+
+class Operation:
+    '''
+    Traffic between two marks
+    '''
+    def __init__(self, name, startTime):
+        self.name = name
+        self.startTime = startTime
+        self.endTime = startTime
+        self.tx = 0
+        self.txChunks = 0
+        self.rx = 0
+        self.rxChunks = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.roundTrips = []
+        self.gaps = []
+
+
+class Analyser:
+    def __init__(self, gap):
+        self.gap = gap
+        self.operations = []
+
+    def run(self, records):
+        operation = Operation("unmarked", 0.0)
+        self.operations.append(operation)
+        lastTime = None
+        lastTx = None
+        for (recordType, timestamp, data) in records:
+            if (recordType == WireTrace.MARK):
+                operation = Operation(data, timestamp)
+                self.operations.append(operation)
+                lastTime = timestamp
+                lastTx = None
+                continue
+
+            if ((lastTime != None) and (timestamp - lastTime > self.gap)):
+                operation.gaps.append(timestamp - lastTime)
+            lastTime = timestamp
+            operation.endTime = timestamp
+
+            if (recordType == WireTrace.TX):
+                operation.tx = operation.tx + len(data)
+                operation.txChunks = operation.txChunks + 1
+                lastTx = timestamp
+            elif (recordType == WireTrace.RX):
+                operation.rx = operation.rx + len(data)
+                operation.rxChunks = operation.rxChunks + 1
+                # Round trip is the time between a transmit and the first data received after it
+                if (lastTx != None):
+                    operation.roundTrips.append(timestamp - lastTx)
+                    lastTx = None
+            elif (recordType == WireTrace.FLUSH):
+                operation.flushed = operation.flushed + len(data)
+                operation.flushes = operation.flushes + 1
+
+    def printEvents(self, records):
+        for (recordType, timestamp, data) in records:
+            name = RECORD_NAMES.get(recordType, str(recordType))
+            if (recordType == WireTrace.MARK):
+                text = data
+            elif (recordType == WireTrace.RATE):
+                (rate, ) = struct.unpack("<I", data)
+                text = str(rate)
+            else:
+                text = "{0:>6} {1}".format(len(data), binascii.hexlify(data[:32]))
+            print "{0:12.6f} {1:>6} {2}".format(timestamp, name, text)
+
+    def printSummary(self):
+        '''
+        Operations of the same name are summed
+        '''
+        summary = {}
+        for operation in self.operations:
+            if ((operation.tx == 0) and (operation.rx == 0) and (operation.flushes == 0)):
+                continue
+            if (not operation.name in summary):
+                summary[operation.name] = Operation(operation.name, 0.0)
+                summary[operation.name].count = 0
+            total = summary[operation.name]
+            total.count = total.count + 1
+            total.endTime = total.endTime + (operation.endTime - operation.startTime)
+            for field in ["tx", "txChunks", "rx", "rxChunks", "flushed", "flushes"]:
+                setattr(total, field, getattr(total, field) + getattr(operation, field))
+            total.roundTrips.extend(operation.roundTrips)
+            total.gaps.extend(operation.gaps)
+
+        fieldPattern = "{:>14}"
+        columns = ["operation", "count", "seconds", "tx", "txChunks", "rx", "rxChunks", "rtt avg", "rtt max", "gaps", "gaps sec", "flushed"]
+        print " ".join([fieldPattern.format(c) for c in columns])
+        print " ".join(["-"*14 for c in columns])
+        for name in sorted(summary):
+            total = summary[name]
+            rttAvg = "-"
+            rttMax = "-"
+            if (len(total.roundTrips) > 0):
+                rttAvg = "{0:.6f}".format(sum(total.roundTrips)/len(total.roundTrips))
+                rttMax = "{0:.6f}".format(max(total.roundTrips))
+            fields = [name, total.count, "{0:.3f}".format(total.endTime), total.tx, total.txChunks, total.rx, total.rxChunks,
+                      rttAvg, rttMax, len(total.gaps), "{0:.3f}".format(sum(total.gaps)), total.flushed]
+            print " ".join([fieldPattern.format(f) for f in fields])
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__, version='AT91 trace 0.1')
+
+    (result, records) = readTrace(arguments['<trace>'])
+    if (not result):
+        print "File {0} is not a trace".format(arguments['<trace>'])
+        exit(1)
+
+    analyser = Analyser(float(arguments['--gap']))
+    if (arguments['--events']):
+        analyser.printEvents(records)
+    analyser.run(records)
+    analyser.printSummary()
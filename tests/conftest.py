@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from at91_emulator import Emulator
+import at91_loader
+
+
+@pytest.fixture
+def emulator():
+    '''
+    Emulator without pacing and without the applet debug output
+    '''
+    e = Emulator(0, 0, False)
+    e.start()
+    yield e
+    e.cancel()
+    e.join()
+
+
+@pytest.fixture
+def at91(emulator):
+    a = at91_loader.AT91(emulator.getDevice())
+    a.start()
+    assert a.waitConnection()
+    yield a
+    a.cancel()
+    a.join()
@@ -0,0 +1,282 @@
+import os
+import re
+import struct
+import binascii
+import logging
+import sys
+import time
+import threading
+
+import pytest
+
+from docopt import docopt
+
+from at91_emulator import Emulator
+import at91_loader
+from at91_loader import CmdLoop
+
+CODE_ADDRESS = 0x308000
+DATA_ADDRESS = 0x20000000
+
+
+def test_word_write_read(at91, emulator):
+    assert at91.write(DATA_ADDRESS, 0x11AE3255)
+    assert emulator.memory.read(DATA_ADDRESS, 4) == "\x55\x32\xAE\x11"
+    assert at91.read(DATA_ADDRESS) == (True, "\x55\x32\xAE\x11")
+
+
+def test_dump(at91, emulator):
+    data = os.urandom(60)
+    emulator.memory.write(DATA_ADDRESS, data)
+    assert at91.dump(DATA_ADDRESS, len(data)) == (True, data)
+
+
+def test_execute_code_starts_applet(at91, emulator):
+    code = os.urandom(4096)
+    assert at91.executeCode(CODE_ADDRESS, CODE_ADDRESS, code)
+    assert emulator.memory.read(CODE_ADDRESS, len(code)) == code
+    results = at91.appletCommands([(CmdLoop.CMD_PING, None)])
+    assert [result for (result, _, _) in results] == [True]
+
+
+def test_applet_dump(at91, emulator):
+    assert at91.executeCode(CODE_ADDRESS, CODE_ADDRESS, os.urandom(256))
+    data = os.urandom(5000)
+    emulator.memory.write(DATA_ADDRESS, data)
+    assert at91.dump(DATA_ADDRESS, len(data)) == (True, data)
+
+
+def test_bulk_dump_uses_xmodem(at91, emulator):
+    data = os.urandom(3000)
+    emulator.memory.write(DATA_ADDRESS, data)
+    assert at91.dump(DATA_ADDRESS, len(data)) == (True, data)
+    assert at91.stat.bulkRead == 1
+    assert at91.stat.bulkReadFailed == 0
+
+
+def test_bulk_upload_uses_xmodem(at91, emulator):
+    data = os.urandom(3000)
+    assert at91.upload(DATA_ADDRESS, data)
+    assert emulator.memory.read(DATA_ADDRESS, len(data)) == data
+    assert at91.stat.bulkWrite == 1
+    assert at91.stat.bulkWriteFailed == 0
+
+
+def test_differential_reload_sends_changed_blocks(at91, emulator):
+    code = bytearray(os.urandom(5*4096))
+    assert at91.executeCode(CODE_ADDRESS, CODE_ADDRESS, str(code))
+    code[2*4096 + 10] ^= 0xFF
+    (sent, skipped) = (at91.stat.diffBlocksSent, at91.stat.diffBlocksSkipped)
+    assert at91.executeCode(CODE_ADDRESS, CODE_ADDRESS, str(code), differential=True)
+    assert at91.stat.diffBlocksSent - sent == 1
+    assert at91.stat.diffBlocksSkipped - skipped == 4
+    assert emulator.memory.read(CODE_ADDRESS, len(code)) == str(code)
+
+
+def test_applet_block_write(at91, emulator):
+    assert at91.executeCode(CODE_ADDRESS, CODE_ADDRESS, os.urandom(256))
+    data = os.urandom(10000)
+    assert at91.upload(DATA_ADDRESS, data)
+    assert emulator.memory.read(DATA_ADDRESS, len(data)) == data
+    assert at91.stat.appletWrite > 0
+    assert at91.stat.appletBlockFailed == 0
+
+
+def test_pipelined_checksums_match_the_memory(at91, emulator):
+    assert at91.executeCode(CODE_ADDRESS, CODE_ADDRESS, os.urandom(256))
+    data = os.urandom(16*1024)
+    emulator.memory.write(DATA_ADDRESS, data)
+    commands = [(CmdLoop.CMD_CHECKSUM, map(ord, struct.pack("<IIB", DATA_ADDRESS + i*1024, 1024, 1))) for i in range(16)]
+    results = at91.appletCommands(commands, 8)
+    assert all([result for (result, _, _) in results])
+    checksums = [struct.unpack("<I", "".join(map(chr, response)))[0] for (_, response, _) in results]
+    assert checksums == [binascii.crc32(data[i*1024:(i+1)*1024]) & 0xFFFFFFFF for i in range(16)]
+    assert at91.pipeline.stat.retransmits == 0
+
+
+def test_baudrate_switch(at91, emulator):
+    assert at91.executeCode(CODE_ADDRESS, CODE_ADDRESS, os.urandom(256))
+    assert at91.setBaudrate(230400)
+    assert emulator.lineRate == 230400
+    data = os.urandom(2000)
+    emulator.memory.write(DATA_ADDRESS, data)
+    assert at91.dump(DATA_ADDRESS, len(data)) == (True, data)
+
+
+def test_baudrate_mismatch_falls_back(at91, emulator, monkeypatch):
+    assert at91.executeCode(CODE_ADDRESS, CODE_ADDRESS, os.urandom(256))
+    # The adapter keeps the monitor rate, the applet does not hear the confirmation
+    monkeypatch.setattr(emulator, "hostRate", lambda: 115200)
+    assert not at91.setBaudrate(230400)
+    assert at91.getTTY().getRate() == 115200
+    assert at91.stat.baudrateFailed == 1
+    results = at91.appletCommands([(CmdLoop.CMD_PING, None)])
+    assert [result for (result, _, _) in results] == [True]
+
+
+@pytest.fixture
+def emulators():
+    emulators = [Emulator(0, 0, False) for _ in range(2)]
+    for e in emulators:
+        e.start()
+        e.memory.write(DATA_ADDRESS, os.urandom(1024))
+    yield emulators
+    for e in emulators:
+        e.cancel()
+        e.join()
+
+
+def runParallel(emulators, tmpdir, argv, output=None):
+    runner = at91_loader.ParallelRunner([e.getDevice() for e in emulators], len(emulators), str(tmpdir), output=output)
+    arguments = docopt(at91_loader.__doc__, argv=argv)
+    return runner.run(lambda at91, dumpFilename: at91_loader.runJob(at91, arguments, dumpFilename))
+
+
+def test_parallel_script_runs_code(emulators, tmpdir, caplog):
+    caplog.set_level(logging.INFO, logger="at91_loader")
+    code = tmpdir.join("code.bin")
+    code.write(os.urandom(256), "wb")
+    script = tmpdir.join("script.txt")
+    script.write("run {0} 308000\nwrite 20000000 11AE3255\n".format(code))
+    assert runParallel(emulators, tmpdir, ["script", "--script={0}".format(script)])
+    for e in emulators:
+        assert e.memory.read(DATA_ADDRESS, 4) == "\x55\x32\xAE\x11"
+        log = tmpdir.join(os.path.basename(e.getDevice()) + ".log").read()
+        assert "Connection {0} is up".format(e.getDevice()) in log
+        assert "Load Code" in log
+
+
+def test_parallel_dump_output_template(emulators, tmpdir):
+    output = str(tmpdir.join("dump-{device}.bin"))
+    assert runParallel(emulators, tmpdir, ["dump", "--address=20000000", "--size=1024", "--output={0}".format(output)], output)
+    for e in emulators:
+        dump = tmpdir.join("dump-{0}.bin".format(os.path.basename(e.getDevice())))
+        assert dump.read("rb") == e.memory.read(DATA_ADDRESS, 1024)
+
+
+def test_write_command_reports_failure(at91, monkeypatch):
+    assert at91_loader.writeData(at91, "20000000", "11AE3255")
+    monkeypatch.setattr(at91, "write", lambda address, data: False)
+    assert not at91_loader.writeData(at91, "20000000", "11AE3255")
+
+
+def test_output_ring_buffer_wraps_and_drops():
+    reader = at91_loader.OutputReader(None, "test", bufferSize=8)
+    reader.feed("abcde")
+    assert reader.read(3) == "abc"
+    reader.feed("fghij")
+    assert reader.read() == "defghij"
+    reader.feed("0123456789")
+    assert reader.stat.dropped == 2
+    assert reader.read() == "23456789"
+    assert reader.read(timeout=0.01) == ""
+
+
+def test_wait_output_returns_after_quiet_period(at91):
+    at91.getOutputReader().feed("hello\n")
+    startTime = time.time()
+    at91_loader.waitOuput(at91, 0.1)
+    assert 0.1 <= time.time() - startTime < 0.5
+    assert at91.getOutputReader().read() == ""
+
+
+def test_daemon_output_of_request(at91, emulator, tmpdir):
+    emulator.memory.write(DATA_ADDRESS, "\x55\x32\xAE\x11")
+    daemon = at91_loader.LoaderDaemon(at91, str(tmpdir.join("daemon.sock")))
+    try:
+        (result, output) = daemon.execute("read 20000000")
+        assert result
+        assert "5532AE11" in output.upper()
+        code = tmpdir.join("code.bin")
+        code.write(os.urandom(256), "wb")
+        startTime = time.time()
+        (result, output) = daemon.execute("run wait=0.05 {0} 308000".format(code))
+        assert result
+        assert time.time() - startTime < 0.5
+        # Printing of other threads does not go to the responses
+        printer = threading.Thread(target=lambda: sys.stdout.write("other thread\n"))
+        printer.start()
+        printer.join()
+        (result, output) = daemon.execute("read 20000000")
+        assert "other thread" not in output
+    finally:
+        daemon.server_close()
+    assert not isinstance(sys.stdout, at91_loader.ThreadOutput)
+
+
+def uploadCompressed(at91, emulator, data):
+    assert at91.executeCode(CODE_ADDRESS, CODE_ADDRESS, os.urandom(256))
+    guard = os.urandom(64)
+    emulator.memory.write(DATA_ADDRESS + len(data), guard)
+    compressedUpload = at91.stat.compressedUpload
+    assert at91.upload(DATA_ADDRESS, data, compressed=True)
+    assert emulator.memory.read(DATA_ADDRESS, len(data)) == data
+    assert emulator.memory.read(DATA_ADDRESS + len(data), len(guard)) == guard
+    return at91.stat.compressedUpload - compressedUpload
+
+
+def test_compressed_upload(at91, emulator):
+    data = "".join([struct.pack("<I", i & 0xFF) for i in range(4096)])
+    assert uploadCompressed(at91, emulator, data) == 1
+
+
+def test_compressed_upload_of_incompressible_data(at91, emulator):
+    assert uploadCompressed(at91, emulator, os.urandom(8192)) == 0
+
+
+def test_compressed_upload_which_overlaps_the_end(at91, emulator):
+    data = "\x00"*8192 + os.urandom(200)
+    (compressed, offset) = at91_loader.compressImage(data)
+    assert len(compressed) < len(data)
+    assert offset + len(compressed) > len(data)
+    # The head is decompressed, the tail is written as is
+    assert uploadCompressed(at91, emulator, data) == 1
+
+
+def flashImage(at91, tmpdir, image, compressed=False, verify=False):
+    applet = tmpdir.join("applet.bin")
+    applet.write(os.urandom(256), "wb")
+    imageFile = tmpdir.join("image.bin")
+    imageFile.write(image, "wb")
+    return at91_loader.flashImage(at91, str(applet), "308000", str(imageFile), "10000", compressed, verify=verify)
+
+
+def test_flash_image(at91, emulator, tmpdir):
+    image = os.urandom(150000)
+    assert flashImage(at91, tmpdir, image)
+    assert emulator.flash.read(0x10000, len(image)) == image
+
+
+def test_flash_compressed_image(at91, emulator, tmpdir):
+    image = os.urandom(70000) + "\xFF"*100000
+    assert flashImage(at91, tmpdir, image, compressed=True, verify=True)
+    assert emulator.flash.read(0x10000, len(image)) == image
+    assert at91.stat.compressedUpload > 0
+
+
+def test_flash_requires_applet_with_flash_commands(at91, emulator, tmpdir):
+    del emulator.commands[Emulator.CMD_FLASH_INIT]
+    image = os.urandom(4096)
+    assert not flashImage(at91, tmpdir, image)
+    assert emulator.memory.read(at91_loader.FLASH_BUFFER_ADDRESS, len(image)) != image
+
+
+def test_flash_verification_finds_corrupted_block(at91, emulator, tmpdir, caplog):
+    image = os.urandom(150000)
+    flashWrite = emulator.commands[Emulator.CMD_FLASH_WRITE]
+    address = 0x10000 + 70000
+    def corruptingFlashWrite(commandId, payload):
+        flashWrite(commandId, payload)
+        # A bit of the second block is not programmed
+        (flashAddress, _, size) = struct.unpack("<III", payload)
+        if (flashAddress <= address < flashAddress + size):
+            emulator.flash.write(address, chr(ord(emulator.flash.read(address, 1)) ^ 0x01))
+    emulator.commands[Emulator.CMD_FLASH_WRITE] = corruptingFlashWrite
+    assert not flashImage(at91, tmpdir, image, verify=True)
+    # The mismatch is narrowed down to a block of 256 bytes at most
+    regions = [re.search("Serial flash ([0-9A-F]+)-([0-9A-F]+) differs", r.getMessage()) for r in caplog.records]
+    regions = [(int(m.group(1), 16), int(m.group(2), 16)) for m in regions if m]
+    assert len(regions) == 1
+    (start, end) = regions[0]
+    assert start <= address <= end
+    assert end - start < 256